@@ -0,0 +1,124 @@
+#!/usr/bin/env python2.7
+"""
+ZManager during a backlog flush: a burst where most messages are
+already expired, as after a pause or with a sender clock behind, against
+the same burst of fresh messages.
+
+Expired messages should cost the broker less than forwarded ones, not
+more, and fresh messages in between should not wait for them. Reported
+are broker CPU per message, messages handled per second and latency of
+the fresh ones.
+
+Usage: python benchmarks/backlog.py [count] [expired_share] 2> log
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+PUB_ADDR = 'tcp://127.0.0.1:18881'
+SUB_ADDR = 'tcp://127.0.0.1:18882'
+
+
+def client(count, expired_share):
+    # Runs in a separate process so that only ZManager uses our CPU.
+    import threading
+    import zmq
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from pyzbus import zenvelope
+
+    context = zmq.Context()
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.connect(PUB_ADDR)
+    sub.setsockopt(zmq.SUBSCRIBE, b'|bench|')
+    pub = context.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.connect(SUB_ADDR)
+    time.sleep(1)
+
+    key = zenvelope.routing_key('bench')
+    body = json.dumps({'Message': 'Bench', 'To': 'bench', 'From': 'bench',
+                       'Payload': 'x' * 256})
+    # Every n-th message is fresh, the rest is a minute old.
+    every = int(round(1 / (1 - expired_share))) if expired_share < 1 else 0
+    fresh = count // every if every else 0
+    latencies = []
+
+    def receiver():
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        while len(latencies) < fresh:
+            if not poller.poll(5000):
+                break
+            frames = sub.recv_multipart()
+            latencies.append(
+                time.time() - zenvelope.unpack(frames[1]).send_time)
+
+    thread = threading.Thread(target=receiver)
+    thread.start()
+    started = time.time()
+    for i in range(count):
+        now = time.time()
+        if every and i % every == 0:
+            envelope = zenvelope.pack(now, 60, message='Bench')
+        else:
+            envelope = zenvelope.pack(now - 60, 5, message='Bench')
+        pub.send_multipart([key, envelope, body])
+    thread.join()
+    latencies.sort()
+    print(json.dumps({
+        'fresh': fresh,
+        'received': len(latencies),
+        'elapsed': time.time() - started,
+        'latency_p50_ms': round(latencies[len(latencies) // 2] * 1e3, 2)
+        if latencies else None,
+        'latency_p99_ms': round(latencies[
+            min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1e3, 2)
+        if latencies else None,
+    }))
+
+
+def main(count, expired_share):
+    import gevent.subprocess
+    import logging
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from pyzbus.zmanager import ZManager
+
+    # What the broker logs about expired messages is part of the cost.
+    logging.basicConfig(stream=sys.stderr)
+
+    manager = ZManager({
+        'PubAddr': PUB_ADDR,
+        'SubAddr': SUB_ADDR,
+        'RcvHWM': 0,
+        'KeepAlive': 0,
+    })
+    for name, share in (('fresh', 0.0), ('backlog', expired_share)):
+        expired = sum(manager.stat_expired.values.values())
+        cpu_started = sum(os.times()[:2])
+        proc = gevent.subprocess.Popen(
+            [sys.executable, __file__, '--client', str(count), str(share)],
+            stdout=gevent.subprocess.PIPE)
+        out, _ = proc.communicate()
+        cpu = sum(os.times()[:2]) - cpu_started
+        res = json.loads(out)
+        print(json.dumps({
+            'run': name,
+            'count': count,
+            'expired': sum(manager.stat_expired.values.values()) - expired,
+            'fresh_received': res['received'],
+            'msgs_per_sec': round(count / (res['elapsed'] or 1e-9)),
+            'cpu_us_per_msg': round(cpu / count * 1e6, 2),
+            'fresh_latency_p50_ms': res['latency_p50_ms'],
+            'fresh_latency_p99_ms': res['latency_p99_ms'],
+        }, sort_keys=True))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--client':
+        client(int(sys.argv[2]), float(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+             float(sys.argv[2]) if len(sys.argv) > 2 else 0.9)
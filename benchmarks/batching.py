@@ -0,0 +1,102 @@
+#!/usr/bin/env python2.7
+"""
+Compare ZActor.tell throughput and sender CPU per message with and
+without batching.
+
+Usage: python benchmarks/batching.py [count] [payload_size]
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+
+PUB_ADDR = 'tcp://127.0.0.1:18881'
+SUB_ADDR = 'tcp://127.0.0.1:18882'
+
+# (BatchSize, BatchInterval)
+MODES = [(0, 0), (10, 5), (100, 5), (1000, 20)]
+
+
+def client(batch_size, batch_interval, count, payload_size):
+    # Runs in a separate process so that the actor has its own settings.
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    import gevent
+    import time
+    import zmq.green as zmq
+    from pyzbus.zactor import ZActor
+
+    actor = ZActor(settings={
+        'UID': 'bench-sender',
+        'SubAddr': PUB_ADDR,
+        'PubAddr': SUB_ADDR,
+        'RunMinimalMode': True,
+        'MessageExpireTime': 3600,
+        'BatchSize': batch_size,
+        'BatchInterval': batch_interval,
+    })
+    sub = actor.context.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.connect(PUB_ADDR)
+    sub.setsockopt(zmq.SUBSCRIBE, b'|bench|')
+    gevent.sleep(1)
+
+    result = {'received': 0, 'last': None}
+
+    def receiver():
+        while result['received'] < count:
+            frames = sub.recv_multipart()
+            result['received'] += len(frames) // 3
+            result['last'] = time.time()
+
+    greenlet = gevent.spawn(receiver)
+    payload = 'x' * payload_size
+    started = time.time()
+    cpu_started = sum(os.times()[:2])
+    for i in range(count):
+        actor.tell({'Message': 'Bench', 'To': 'bench', 'Payload': payload})
+        if not i % 1000:
+            gevent.sleep(0)
+    actor.flush()
+    cpu = sum(os.times()[:2]) - cpu_started
+    greenlet.join(timeout=10)
+    elapsed = (result['last'] or started) - started
+    received = result['received'] or 1
+    print(json.dumps({
+        'batch_size': batch_size,
+        'batch_interval': batch_interval,
+        'count': count,
+        'payload_size': payload_size,
+        'received': result['received'],
+        'msgs_per_sec': round(received / (elapsed or 1e-9)),
+        'sender_cpu_us_per_msg': round(cpu / count * 1e6, 2),
+    }))
+    sys.stdout.flush()
+    actor.stop(exit=False)
+
+
+def main(count, payload_size):
+    import gevent.subprocess
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from pyzbus.zmanager import ZManager
+
+    ZManager({
+        'PubAddr': PUB_ADDR,
+        'SubAddr': SUB_ADDR,
+        'MessageExpireTime': 3600,
+        'KeepAlive': 0,
+    })
+    for batch_size, batch_interval in MODES:
+        proc = gevent.subprocess.Popen(
+            [sys.executable, __file__, '--client', str(batch_size),
+             str(batch_interval), str(count), str(payload_size)],
+            stdout=gevent.subprocess.PIPE)
+        out, _ = proc.communicate()
+        print(out.strip())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--client':
+        client(*[int(arg) for arg in sys.argv[2:6]])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+             int(sys.argv[2]) if len(sys.argv) > 2 else 128)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2.7
+"""
+CPU cost against bytes saved of body compression for a few kinds of
+payloads, for every compressor that is installed (zlib, lz4, zstd).
+
+Bodies are encoded the way ZActor sends them, then compressed and
+expanded count times each.
+
+Usage: python benchmarks/compression.py [count]
+"""
+from __future__ import print_function
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pyzbus import zcodec, zcompress
+
+
+def payloads():
+    rnd = random.Random(42)
+    words = ['call', 'queue', 'agent', 'status', 'ringing', 'answered',
+             'hangup', 'sip', 'trunk', 'peer', 'registered', 'timeout']
+    records = [{
+        'Id': i,
+        'Peer': 'SIP/{}'.format(rnd.randint(100, 999)),
+        'Status': rnd.choice(words),
+        'Duration': rnd.random() * 100,
+        'Time': 1500000000 + i,
+    } for i in range(200)]
+    log = '\n'.join(' '.join(rnd.choice(words) for _ in range(12))
+                    for _ in range(300))
+    return [
+        ('small_json', {'Message': 'Event', 'Status': 'ringing', 'Id': 1}),
+        ('json_records', {'Message': 'Report', 'Records': records}),
+        ('log_text', {'Message': 'Log', 'Text': log}),
+        ('random_base64', {'Message': 'Blob', 'Data': base64.b64encode(
+            os.urandom(16384))}),
+    ]
+
+
+def run(count):
+    codec = zcodec.get_codec('json')
+    for name, msg in payloads():
+        body = codec.encode(msg)
+        for compressor in sorted(zcompress.compressors_by_name.values(),
+                                 key=lambda compressor: compressor.tag):
+            started = time.time()
+            for _ in range(count):
+                compressed = compressor.compress(body)
+            compress = (time.time() - started) / count
+            started = time.time()
+            for _ in range(count):
+                compressor.decompress(compressed)
+            decompress = (time.time() - started) / count
+            saved = len(body) - len(compressed)
+            print(json.dumps({
+                'payload': name,
+                'compressor': compressor.name,
+                'body_bytes': len(body),
+                'compressed_bytes': len(compressed),
+                'ratio': round(float(len(compressed)) / len(body), 3),
+                'compress_us': round(compress * 1e6, 1),
+                'decompress_us': round(decompress * 1e6, 1),
+                # Both ends pay, compare with what a byte costs on the link.
+                'saved_bytes_per_cpu_ms': round(
+                    saved / ((compress + decompress) * 1000), 1),
+            }, sort_keys=True))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python2.7
+"""
+Compare ZManager forwarding of enveloped messages (body passed through)
+against the JSON round-trip used for messages without envelope.
+
+Usage: python benchmarks/forwarding.py [count] [payload_size]
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+PUB_ADDR = 'tcp://127.0.0.1:18881'
+SUB_ADDR = 'tcp://127.0.0.1:18882'
+
+
+def client(mode, count, payload_size):
+    # Runs in a separate process so that only ZManager uses our CPU.
+    import threading
+    import zmq
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from pyzbus import zenvelope
+
+    context = zmq.Context()
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.connect(PUB_ADDR)
+    sub.setsockopt(zmq.SUBSCRIBE, b'|bench|')
+    pub = context.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.connect(SUB_ADDR)
+    time.sleep(1)
+
+    msg = {
+        'Message': 'Bench',
+        'To': 'bench',
+        'From': 'bench',
+        'SendTime': time.time(),
+        'Payload': 'x' * payload_size,
+    }
+    body = json.dumps(msg)
+    if mode == 'json':
+        frames = [body]
+    else:
+        frames = [zenvelope.routing_key('bench'),
+                  zenvelope.pack(msg['SendTime'], 0), body]
+
+    result = {'received': 0, 'first': None, 'last': None}
+
+    def receiver():
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        while result['received'] < count:
+            if not poller.poll(2000):
+                break
+            sub.recv_multipart()
+            result['last'] = time.time()
+            if result['first'] is None:
+                result['first'] = result['last']
+            result['received'] += 1
+
+    thread = threading.Thread(target=receiver)
+    thread.start()
+    started = time.time()
+    for _ in range(count):
+        pub.send_multipart(frames)
+    thread.join()
+    elapsed = (result['last'] or started) - started
+    print(json.dumps({
+        'received': result['received'],
+        'elapsed': elapsed,
+    }))
+
+
+def main(count, payload_size):
+    import gevent.subprocess
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from pyzbus.zmanager import ZManager
+
+    ZManager({
+        'PubAddr': PUB_ADDR,
+        'SubAddr': SUB_ADDR,
+        'MessageExpireTime': 3600,
+        'KeepAlive': 0,
+    })
+    results = []
+    for mode in ('json', 'envelope'):
+        cpu_started = sum(os.times()[:2])
+        proc = gevent.subprocess.Popen(
+            [sys.executable, __file__, '--client', mode,
+             str(count), str(payload_size)],
+            stdout=gevent.subprocess.PIPE)
+        out, _ = proc.communicate()
+        cpu = sum(os.times()[:2]) - cpu_started
+        res = json.loads(out)
+        received = res['received'] or 1
+        results.append({
+            'mode': mode,
+            'count': count,
+            'payload_size': payload_size,
+            'received': res['received'],
+            'msgs_per_sec': round(received / (res['elapsed'] or 1e-9)),
+            'cpu_us_per_msg': round(cpu / received * 1e6, 2),
+        })
+    for res in results:
+        print(json.dumps(res))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--client':
+        client(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+             int(sys.argv[2]) if len(sys.argv) > 2 else 1024)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2.7
+"""
+Startup time and memory per actor of LightActors on one ZHost against
+full ZActors, each with its own sockets and greenlets.
+
+Every run is a fresh process with ZManager over inproc. Actors are
+started, then count messages are told to them round robin and timed
+until all are handled.
+
+Usage: python benchmarks/light_actors.py [light_actors] [full_actors]
+           [count]
+"""
+from __future__ import print_function
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PUB_ADDR = 'inproc://pyzbus-bench-pub'
+SUB_ADDR = 'inproc://pyzbus-bench-sub'
+
+
+def run_worker(kind, actors, count):
+    sys.path.insert(0, ROOT)
+    import gevent
+    import zmq.green as zmq
+    from pyzbus.zactor import ZActor
+    from pyzbus.zhost import LightActor, ZHost
+    from pyzbus.zmanager import ZManager
+    from pyzbus.zstats import process_resident_memory_bytes
+
+    delivered = [0]
+    settings = {
+        'SubAddr': PUB_ADDR,
+        'PubAddr': SUB_ADDR,
+        'RunMinimalMode': True,
+        'MessageExpireTime': 60,
+        'SequenceCheck': False,
+    }
+
+    class BenchLight(LightActor):
+        __slots__ = ()
+
+        def on_Bench(self, msg):
+            delivered[0] += 1
+
+    class BenchActor(ZActor):
+
+        def on_Bench(self, msg):
+            delivered[0] += 1
+
+    context = zmq.Context()
+    ZManager({
+        'PubAddr': PUB_ADDR,
+        'SubAddr': SUB_ADDR,
+        'MessageExpireTime': 60,
+        'KeepAlive': 0,
+    }, context=context)
+    sender = ZActor(settings=dict(settings, UID='bench-sender'),
+                    context=context)
+
+    if kind == 'light':
+        # Started once, not counted per actor.
+        host = ZHost(settings=dict(settings, UID='bench-host'),
+                     context=context)
+    rss = process_resident_memory_bytes()
+    started = time.time()
+    if kind == 'light':
+        uids = ['bench-{}'.format(i) for i in range(actors)]
+        objects = [BenchLight(host, uid) for uid in uids]
+    else:
+        objects = [BenchActor(settings=dict(settings,
+                                            UID='bench-{}'.format(i)),
+                              context=context) for i in range(actors)]
+        uids = [actor.uid for actor in objects]
+    startup = time.time() - started
+    memory = process_resident_memory_bytes() - rss
+    gevent.sleep(1) # Subscriptions reach the manager.
+
+    started = time.time()
+    for i in range(count):
+        sender.tell({'Message': 'Bench', 'To': uids[i % len(uids)]})
+    while delivered[0] < count and time.time() - started < 60:
+        gevent.sleep(0.01)
+    elapsed = time.time() - started
+
+    print(json.dumps({
+        'kind': kind,
+        'actors': actors,
+        'startup_seconds': round(startup, 3),
+        'startup_us_per_actor': round(startup / actors * 1e6, 1),
+        'rss_bytes_per_actor': memory // actors,
+        'count': count,
+        'delivered': delivered[0],
+        'deliveries_per_sec': round(delivered[0] / elapsed),
+    }, sort_keys=True))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main():
+    light = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    full = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    for kind, actors in (('light', light), ('full', full)):
+        print(subprocess.check_output([
+            sys.executable, __file__, '--worker', kind, str(actors),
+            str(count)]).strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        run_worker(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2.7
+"""
+Append and replay throughput of the ZManager replay log.
+
+Units are appended the way ZManager logs them, then replayed in full and
+filtered by routing key, for a few payload sizes.
+
+Usage: python benchmarks/replay_log.py [count] [segment_size]
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pyzbus import zenvelope
+from pyzbus.zlog import ReplayLog
+
+PAYLOADS = [64, 1024, 16384]
+KEYS = 10 # Destinations, replay by key reads 1 of KEYS units.
+
+
+def run(count, payload_size, segment_size):
+    directory = tempfile.mkdtemp(prefix='pyzbus-log-')
+    try:
+        log = ReplayLog(directory, segment_size, retention_bytes=0,
+                        retention_age=0)
+        keys = [zenvelope.routing_key('bench-{}'.format(i))
+                for i in range(KEYS)]
+        envelope = zenvelope.pack(time.time(), 5, sender='bench-sender',
+                                  message='Bench')
+        body = json.dumps({'Message': 'Bench', 'Payload': 'x' * payload_size})
+        size = 0
+
+        started = time.time()
+        for i in range(count):
+            unit = [keys[i % KEYS], envelope, body]
+            log.append(unit)
+            size += sum(len(frame) for frame in unit)
+        append = time.time() - started
+
+        started = time.time()
+        replayed = sum(1 for _ in log.replay())
+        replay = time.time() - started
+
+        started = time.time()
+        by_key = sum(1 for _ in log.replay(keys=set([keys[0]])))
+        replay_key = time.time() - started
+
+        result = {
+            'payload_size': payload_size,
+            'count': count,
+            'segments': len(log.segments),
+            'append_msgs_per_sec': round(count / append),
+            'append_mb_per_sec': round(size / append / 1e6, 1),
+            'replay_msgs_per_sec': round(replayed / replay),
+            'replay_mb_per_sec': round(size / replay / 1e6, 1),
+            'replay_by_key_msgs_per_sec': round(by_key / replay_key),
+        }
+        log.close()
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    segment_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024 * 1024
+    for payload_size in PAYLOADS:
+        print(json.dumps(run(count, payload_size, segment_size),
+                         sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
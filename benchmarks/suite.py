@@ -0,0 +1,263 @@
+#!/usr/bin/env python2.7
+"""
+Throughput and latency benchmark suite for the bus.
+
+Every combination of transport, payload size, number of actors and
+fan-out degree runs in a fresh worker process on localhost. A worker
+starts ZManager (in its own process for tcp and ipc so its CPU can be
+measured, in the worker for inproc), N receiving actors and one sender,
+then measures:
+
+  - tell throughput (messages and deliveries per second)
+  - ask latency p50 / p99
+  - broker CPU per forwarded message (tcp and ipc only)
+  - memory growth of the worker and the broker during a mixed run
+
+Results are written as JSON lines or CSV, one row per combination, with
+the git commit so runs can be compared between commits.
+
+Usage:
+    python benchmarks/suite.py --transports tcp,ipc,inproc \\
+        --payloads 64,1024,16384 --actors 1,4 --fanout 1,4 \\
+        --count 10000 --asks 1000 --duration 10 --format csv \\
+        --output results.csv
+"""
+from __future__ import print_function
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ADDRS = {
+    # transport: (manager PubAddr, manager SubAddr)
+    'tcp': ('tcp://127.0.0.1:18881', 'tcp://127.0.0.1:18882'),
+    'ipc': ('ipc:///tmp/pyzbus-bench-pub', 'ipc:///tmp/pyzbus-bench-sub'),
+    'inproc': ('inproc://pyzbus-bench-pub', 'inproc://pyzbus-bench-sub'),
+}
+
+MAX_IN_FLIGHT = 500
+
+FIELDS = ['commit', 'transport', 'payload_size', 'actors', 'fanout',
+          'count', 'delivered', 'tell_msgs_per_sec', 'deliveries_per_sec',
+          'asks', 'ask_p50_ms', 'ask_p99_ms', 'broker_cpu_us_per_msg',
+          'duration', 'worker_rss_growth_bytes', 'broker_rss_growth_bytes']
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_manager(pub_addr, sub_addr):
+    sys.path.insert(0, ROOT)
+    from pyzbus.zmanager import ZManager
+    ZManager({
+        'PubAddr': pub_addr,
+        'SubAddr': sub_addr,
+        'MessageExpireTime': 60,
+        'KeepAlive': 0,
+    }).run()
+
+
+def run_worker(transport, payload_size, actors, fanout, count, asks,
+               duration):
+    sys.path.insert(0, ROOT)
+    import gevent
+    import gevent.subprocess
+    import zmq.green as zmq
+    from pyzbus.zactor import ZActor
+    from pyzbus.zmanager import ZManager
+    from pyzbus.zstats import process_resident_memory_bytes
+
+    class BenchActor(ZActor):
+        delivered = [0]
+
+        def on_Bench(self, msg):
+            self.delivered[0] += 1
+
+    pub_addr, sub_addr = ADDRS[transport]
+    context = manager = None
+    if transport == 'inproc':
+        context = zmq.Context()
+        ZManager({
+            'PubAddr': pub_addr,
+            'SubAddr': sub_addr,
+            'MessageExpireTime': 60,
+            'KeepAlive': 0,
+        }, context=context)
+    else:
+        manager = gevent.subprocess.Popen(
+            [sys.executable, __file__, '--manager', pub_addr, sub_addr])
+        gevent.sleep(1)
+
+    settings = {
+        'SubAddr': pub_addr,
+        'PubAddr': sub_addr,
+        'RunMinimalMode': True,
+        'MessageExpireTime': 60,
+    }
+    receivers = []
+    for i in range(actors):
+        settings['UID'] = 'bench-{}'.format(i)
+        receivers.append(BenchActor(settings=dict(settings), context=context))
+    if fanout > 1:
+        for receiver in receivers[:fanout]:
+            receiver.subscribe('bench-group')
+    settings['UID'] = 'bench-sender'
+    sender = ZActor(settings=dict(settings), context=context)
+    gevent.sleep(1)
+
+    def broker_stats():
+        return sender.ask({'Message': 'Stats', 'To': 'ZManager'},
+                          attempts=1)
+
+    sent = [0]
+
+    def tell(i, payload):
+        if fanout > 1:
+            to = 'bench-group'
+        else:
+            to = 'bench-{}'.format(i % actors)
+        sender.tell({'Message': 'Bench', 'To': to, 'Payload': payload})
+        sent[0] += 1
+        if not i % 100:
+            # Keep in-flight messages under socket high-water marks, we
+            # measure sustainable throughput and not drops.
+            while (sent[0] - BenchActor.delivered[0] // max(fanout, 1) >
+                   MAX_IN_FLIGHT):
+                gevent.sleep(0.0005)
+            gevent.sleep(0)
+
+    result = {
+        'transport': transport,
+        'payload_size': payload_size,
+        'actors': actors,
+        'fanout': fanout,
+        'count': count,
+        'asks': asks,
+        'duration': duration,
+    }
+    payload = 'x' * payload_size
+    expected = count * max(fanout, 1)
+
+    # Tell throughput
+    before = broker_stats()
+    started = time.time()
+    for i in range(count):
+        tell(i, payload)
+    while BenchActor.delivered[0] < expected and time.time() - started < 30:
+        gevent.sleep(0.001)
+    elapsed = time.time() - started
+    after = broker_stats()
+    result['delivered'] = BenchActor.delivered[0]
+    result['tell_msgs_per_sec'] = round(count / elapsed)
+    result['deliveries_per_sec'] = round(BenchActor.delivered[0] / elapsed)
+    if manager and before and after:
+        forwarded = (sum(after['messages_forwarded_total'].values()) -
+                     sum(before['messages_forwarded_total'].values()))
+        result['broker_cpu_us_per_msg'] = round(
+            (after['process_cpu_seconds_total'] -
+             before['process_cpu_seconds_total']) / max(forwarded, 1) * 1e6,
+            2)
+
+    # Ask latency
+    latencies = []
+    for i in range(asks):
+        t = time.time()
+        if sender.ask({'Message': 'Ping', 'To': 'bench-0'}, attempts=1):
+            latencies.append(time.time() - t)
+    if latencies:
+        result['ask_p50_ms'] = round(percentile(latencies, 50) * 1000, 3)
+        result['ask_p99_ms'] = round(percentile(latencies, 99) * 1000, 3)
+
+    # Memory growth during a mixed tell / ask run
+    if duration:
+        before = broker_stats()
+        rss = process_resident_memory_bytes()
+        started = time.time()
+        for i in itertools.count():
+            if time.time() - started > duration:
+                break
+            tell(i, payload)
+            if not i % 10:
+                sender.ask({'Message': 'Ping', 'To': 'bench-0'}, attempts=1)
+        gevent.sleep(1)
+        after = broker_stats()
+        result['worker_rss_growth_bytes'] = (
+            process_resident_memory_bytes() - rss)
+        if manager and before and after:
+            result['broker_rss_growth_bytes'] = (
+                after['process_resident_memory_bytes'] -
+                before['process_resident_memory_bytes'])
+
+    print(json.dumps(result))
+    sys.stdout.flush()
+    if manager:
+        manager.kill()
+    os._exit(0)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--transports', default='tcp,ipc,inproc')
+    parser.add_argument('--payloads', default='64,1024,16384')
+    parser.add_argument('--actors', default='1,4')
+    parser.add_argument('--fanout', default='1,4')
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--asks', type=int, default=1000)
+    parser.add_argument('--duration', type=int, default=10,
+                        help='Seconds of the memory growth run, 0 to skip.')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    parser.add_argument('--output', help='File name, stdout by default.')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    writer = None
+    if args.format == 'csv':
+        writer = csv.DictWriter(output, FIELDS)
+        writer.writeheader()
+    commit = git_commit()
+
+    for transport, payload_size, actors, fanout in itertools.product(
+            args.transports.split(','),
+            [int(x) for x in args.payloads.split(',')],
+            [int(x) for x in args.actors.split(',')],
+            [int(x) for x in args.fanout.split(',')]):
+        if fanout > actors:
+            continue
+        out = subprocess.check_output([
+            sys.executable, __file__, '--worker', transport,
+            str(payload_size), str(actors), str(fanout), str(args.count),
+            str(args.asks), str(args.duration)])
+        result = json.loads(out.strip().splitlines()[-1])
+        result['commit'] = commit
+        if writer:
+            writer.writerow(result)
+        else:
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--manager':
+        run_manager(*sys.argv[2:4])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        run_worker(sys.argv[2], *[int(arg) for arg in sys.argv[3:9]])
+    else:
+        main()
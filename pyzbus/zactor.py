@@ -1,27 +1,57 @@
 import gevent
 from gevent.monkey import patch_all; patch_all()
 from gevent.queue import Queue
-from gevent.event import Event
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+import collections
 from datetime import datetime
+import itertools
 import json
 import logging
 import os
+import random
 import signal
 import subprocess
 import sys
 import time
 import uuid
+import weakref
 import zmq.green as zmq
+from zmq.utils.monitor import recv_monitor_message
+
+from . import (zcache, zcodec, zcompress, zenvelope, zlane, zstats, zstream,
+               ztopic, ztrace)
+from .zask import AskError, AskPool, Disconnected, NoRoute
+from .zseq import RecentIds, SendBuffer, SequenceWindow, is_sequence
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 logger = logging.getLogger(__name__)
 
+# Actors of this process by UID for local delivery.
+local_actors = weakref.WeakValueDictionary()
+
+# gevent.signal is signal_handler since gevent 1.5.
+signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+
+
+def to_bytes(name):
+    # Names from JSON are unicode, routing keys are byte strings.
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
 # Decorators
 def check_reply(func):
     def wrapper(agent, msg, *args, **kwargs):
         res = func(agent, msg, *args, **kwargs)
         if msg.get('ReplyTo'):
+            if 'Hops' in msg:
+                # Traced, the reply goes on with the hops of the request.
+                res = res or {}
+                res['Hops'] = msg['Hops'] + [
+                    ztrace.stamp(ztrace.HANDLER_END)]
             for to in msg.get('ReplyTo'):
                 if not res:
                     res = {}
@@ -36,6 +66,18 @@ def check_reply(func):
     return wrapper
 
 
+def stream_reply(func):
+    # For generator handlers answering ask_stream: every dict the handler
+    # yields is sent to the asker as a chunk, when the asker has credits.
+    def wrapper(agent, msg, *args, **kwargs):
+        chunks = func(agent, msg, *args, **kwargs)
+        if msg.get('ReplyTo'):
+            agent._produce_stream(msg, chunks)
+        else:
+            chunks.close() # Nobody to stream to.
+    return wrapper
+
+
 
 class ZActor(object):
     version = 2
@@ -46,7 +88,6 @@ class ZActor(object):
     sent_message_count = 0
     last_msg_time = time.time()
     last_msg_time_sum = 0
-    ask_pool = {} # Here we keep requests that we want replies
     last_pub_sub_reconnect = None
     pub_socket = sub_socket = None
 
@@ -55,18 +96,97 @@ class ZActor(object):
         'UID': False,
         'SubAddr': 'tcp://127.0.0.1:8881',
         'PubAddr': 'tcp://127.0.0.1:8882',
-        'HeartbeatInterval': 120,
+        # ZMTP heartbeats on manager connections, handled by libzmq I/O
+        # threads. A connection without PONG in HeartbeatTimeout seconds
+        # is dropped and reconnected, 0 interval to disable.
+        'HeartbeatInterval': 10,
         'HeartbeatTimeout': 5,
+        'AskReconnectPolicy': 'resend', # resend or fail pending asks.
+        # Ask the manager replay log for messages missed while away.
+        'ReplayOnReconnect': False,
+        'ManagerUID': 'ZManager',
         'IdleTimeout': 180,
         'Trace': False,
         'Debug': False,
         'RunMinimalMode': False,
         'CacheDir': None, # Must be set for caching.
         'MessageExpireTime': 5, # seconds
+        'ExpiryReportInterval': 10, # Seconds between expired summaries.
         'AskTimeout': 5,
+        'AskTimerResolution': 0.1, # Precision of ask timeouts, seconds.
+        # Reply cache and single flight for idempotent asks, see zcache.
+        # AskCache is TTL seconds by message name, 0 to share requests in
+        # flight only. AskCacheSize 0 disables both.
+        'AskCache': {},
+        'AskCacheSize': 0,
+        'StreamCredits': 16, # Chunks of ask_stream in flight.
+        # Stop a stream producer when the asker grants no credits for so
+        # many seconds, it has probably gone away.
+        'StreamCreditTimeout': 60,
+        'HandlerPoolSize': 1000, # Max on_* handlers running at once.
+        'HandlerQueueSize': 10000, # Messages waiting for a free handler.
+        'HandlerOverflow': 'block', # block, drop_oldest or reject
+        'StatsAddr': None, # host:port for Prometheus metrics over HTTP.
+        # Deliver messages to actors of this process without the manager,
+        # LocalMirror also sends a copy through the manager for observers.
+        'LocalDelivery': False,
+        'LocalMirror': False,
+        'NoRouteReply': True, # Ask manager to fail asks nobody can receive.
+        'Envelope': True, # Send binary envelope frame, see zenvelope.
+        'Codec': 'json', # Body codec when Envelope is set, see zcodec.
+        'BatchSize': 0, # Send up to BatchSize messages in one multipart.
+        'BatchInterval': 5, # Flush a pending batch after milliseconds.
+        # Compress bodies of CompressionThreshold bytes and more with zlib,
+        # lz4 or zstd, None to send as is. CompressionByMessage overrides
+        # both by message name, e.g.
+        # {'Report': {'Compression': 'zstd', 'Threshold': 512}}
+        'Compression': None,
+        'CompressionThreshold': 4096,
+        'CompressionByMessage': {},
+        # Number messages per destination and keep the last ones to send
+        # again on request of a receiver that found a gap, 0 to disable.
+        'RetransmitBufferSize': 0,
+        # Drop duplicates and ask senders for missing messages.
+        'SequenceCheck': True,
+        'SequenceWindow': 1024, # Out of order numbers kept per sender.
+        # Ids of the last received messages without DestSequence, replayed
+        # ones among them are dropped. 0 to disable.
+        'ReplayDedupSize': 10000,
+        # Flow control: socket high-water marks in messages and a queue
+        # for sends the PUB socket cannot take right now. SendOverflow is
+        # block, drop_newest or drop_oldest when the queue is full too.
+        # Without SendQueueSize sends block the greenlet at SndHWM.
+        'SndHWM': 1000,
+        'RcvHWM': 1000,
+        'SendQueueSize': 0,
+        'SendOverflow': 'block',
+        # ZManager QueueAddr for join_queue, heartbeats must come more
+        # often than its QueueMemberTimeout.
+        'QueueAddr': 'tcp://127.0.0.1:8883',
+        'QueueHeartbeatInterval': 2,
+        # Control lane, see zlane: ControlMessages and their replies go
+        # over own sockets to ZManager ControlSubAddr / from its
+        # ControlPubAddr, read first and handled outside the handler pool.
+        # None to disable, ZManager must have the lane too.
+        'ControlSubAddr': None,
+        'ControlPubAddr': None,
+        'ControlMessages': ['Ping', 'Pong', 'KeepAlive', 'UpdateSettings',
+                            'Retransmit', 'StreamCredit', 'StreamCancel'],
+        # Data is read in batches of what is ready and dispatched by
+        # msg['Priority'], PriorityWeights[priority] messages per round.
+        'ReceiveBatch': 100,
+        'PriorityWeights': [1, 4, 16],
+        # Sampled tracing, see ztrace: share of asks and tells we send
+        # with hop stamps, 0 to disable. on_Traces sums them up by message
+        # type, the last TraceKeep are kept for a timeline.
+        'TraceSampleRate': 0,
+        'TraceKeep': 100,
     }
 
     def __init__(self, *args, **kwargs):
+        # Own copies, class attributes are shared by all instances.
+        self.settings = dict(self.settings)
+        self.greenlets = []
         # Load local settings.
         self.load_settings()
         # Override local settings if given
@@ -94,49 +214,239 @@ class ZActor(object):
         else:
             self.uid = str(uuid.getnode())
         logger.info('UID: {}.'.format(self.uid))
-
-        self.context = zmq.Context()
+        local_actors[self.uid] = self
+
+        self.codec = zcodec.get_codec(self.settings.get('Codec'))
+        # (compressor, threshold) by message name, see _compression.
+        self._compression_cache = {}
+        # Message ids are a random prefix and a counter, cheaper than uuid4.
+        self._id_prefix = uuid.uuid4().hex[:16]
+        self._id_counter = itertools.count(1)
+        self._send_time_human = (None, None)
+        self._batch = []
+        self._batch_units = 0
+        self._batch_flusher = None
+        # Message handlers by message name, on_Ping handles Ping.
+        self.handlers = dict((name[3:], getattr(self, name))
+                             for name in dir(self) if name.startswith('on_'))
+        self.handler_pool = Pool(self.settings.get('HandlerPoolSize'))
+        self.handler_queue = collections.deque()
+        self.handler_concurrency = collections.defaultdict(int)
+        self.handler_dropped = self.handler_rejected = 0
+        # Here we keep requests that we want replies
+        self.ask_pool = AskPool(self._resend,
+                                self.settings.get('AskTimerResolution'))
+        self.reply_cache = None
+        if self.settings.get('AskCacheSize'):
+            self.reply_cache = zcache.ReplyCache(
+                self.settings.get('AskCacheSize'))
+        self.asks_in_flight = {} # AsyncResult by zcache.request_key.
+        self.ask_followers = {} # Askers sharing an AsyncResult in flight.
+        self.tracer = ztrace.Tracer(self.settings.get('TraceKeep'))
+        # (To, Message) of asks responders have declared cacheable.
+        self.cacheable_asks = set()
+        # Open streams by request Id, ours of ask_stream and the ones we
+        # produce for others.
+        self.streams = {}
+        self.producers = {}
+        self.send_buffer = None
+        if self.settings.get('RetransmitBufferSize'):
+            self.send_buffer = SendBuffer(
+                self.settings.get('RetransmitBufferSize'), self._id_prefix)
+        # SequenceWindow by (sender, destination)
+        self.sequence_windows = {}
+        self.recent_ids = None
+        if self.settings.get('ReplayDedupSize'):
+            self.recent_ids = RecentIds(self.settings.get('ReplayDedupSize'))
+        # Green sockets take one waiting greenlet only, blocking sends on
+        # the PUB and the work queue socket wait for their turn here.
+        self.pub_lock = Semaphore()
+        self.queue_lock = Semaphore()
+        self.send_queue = None
+        if self.settings.get('SendQueueSize'):
+            self.send_queue = Queue(self.settings.get('SendQueueSize'))
+        self._init_stats()
+        self.expiry = zlane.Expiry(logger,
+                                   self.settings.get('ExpiryReportInterval'),
+                                   self.stat_nearly_expired)
+
+        # Exact subscription keys and topic patterns, see subscribe.
+        self.subscriptions = set()
+        self.topics = ztopic.TopicTrie()
+        # Work queues we are a member of, see join_queue.
+        self.work_queues = set()
+        self.queue_socket = None
+        # Pass a shared context for inproc:// addresses.
+        self.context = kwargs.get('context') or zmq.Context()
         self.last_pub_sub_reconnect = time.time()
+        self.disconnected = set() # Names of sockets without connection.
+        self.disconnected_at = None
         self._connect_sub_socket()
         self._connect_pub_socket()
+        self.control_sub_socket = self.control_pub_socket = None
+        self.control_messages = set(self.settings.get('ControlMessages'))
+        if self.settings.get('ControlSubAddr'):
+            self._connect_control_sockets()
 
         # Spawn receive loop
         self.greenlets.append(gevent.spawn(self.receive))
+        self.greenlets.append(gevent.spawn(self.ask_pool.wheel.run))
+        if self.expiry.interval:
+            self.greenlets.append(gevent.spawn(self.expiry.run))
+        if self.send_queue is not None:
+            self.greenlets.append(gevent.spawn(self.send_queued))
+        self.greenlets.append(gevent.spawn(self.monitor, self.pub_socket,
+                                           'PUB'))
+        self.greenlets.append(gevent.spawn(self.monitor, self.sub_socket,
+                                           'SUB'))
         gevent.sleep(0.5) # Give receiver time to complete connection.
 
         if not self.settings.get('RunMinimalMode'):
             self.greenlets.append(gevent.spawn(self.check_idle))
-            self.greenlets.append(gevent.spawn(self.heartbeat))
         # Install signal handler
-        gevent.signal(signal.SIGINT, self.stop)
-        gevent.signal(signal.SIGTERM, self.stop)
-
+        signal_handler(signal.SIGINT, self.stop)
+        signal_handler(signal.SIGTERM, self.stop)
+
+
+    def _init_stats(self):
+        self.stats = zstats.Stats()
+        self.stat_received = self.stats.counter(
+            'messages_received_total', 'message')
+        self.stat_senders = self.stats.counter(
+            'messages_by_sender_total', 'sender')
+        self.stat_sent = self.stats.counter('messages_sent_total', 'message')
+        self.stat_expired = self.stats.counter(
+            'messages_expired_total', 'message')
+        self.stat_nearly_expired = self.stats.counter(
+            'messages_nearly_expired_total', 'message')
+        self.stat_unsupported = self.stats.counter(
+            'envelopes_unsupported_total', 'version')
+        self.stat_ask_latency = self.stats.histogram('ask_latency_seconds')
+        self.stat_disconnects = self.stats.counter('disconnects_total',
+                                                   'socket')
+        self.stat_gaps = self.stats.counter('sequence_gaps_total', 'sender')
+        self.stat_duplicates = self.stats.counter(
+            'duplicates_dropped_total', 'sender')
+        self.stat_lost = self.stats.counter('messages_lost_total', 'sender')
+        self.stat_retransmitted = self.stats.counter(
+            'messages_retransmitted_total')
+        self.stat_compression_in = self.stats.counter(
+            'compression_input_bytes_total', 'compressor')
+        self.stat_compression_out = self.stats.counter(
+            'compression_output_bytes_total', 'compressor')
+        self.stat_send_dropped = self.stats.counter(
+            'messages_send_dropped_total', 'policy')
+        self.stats.gauge('send_queue_depth', lambda: self.send_queue.qsize()
+                         if self.send_queue is not None else 0)
+        self.stats.gauge('ask_pool_size', lambda: len(self.ask_pool))
+        self.stat_cache_hits = self.stats.counter(
+            'ask_cache_hits_total', 'message')
+        self.stat_cache_shared = self.stats.counter(
+            'ask_cache_shared_total', 'message')
+        self.stat_cache_misses = self.stats.counter(
+            'ask_cache_misses_total', 'message')
+        self.stat_cache_evictions = self.stats.counter(
+            'ask_cache_evictions_total')
+        self.stats.gauge('ask_cache_size', lambda: len(self.reply_cache)
+                         if self.reply_cache is not None else 0)
+        self.stats.gauge('streams_open', lambda: len(self.streams))
+        self.stats.gauge('streams_producing', lambda: len(self.producers))
+        self.stats.gauge('handlers_running', lambda: len(self.handler_pool))
+        self.stats.gauge('handler_queue_depth',
+                         lambda: len(self.handler_queue))
+        self.stats.gauge('greenlets', lambda: len(self.greenlets) +
+                         len(self.handler_pool))
+        if self.settings.get('StatsAddr'):
+            self.stats_server = self.stats.serve(
+                self.settings.get('StatsAddr'))
+
+
+    def _set_heartbeat(self, socket):
+        interval = self.settings.get('HeartbeatInterval')
+        if not interval or not hasattr(zmq, 'HEARTBEAT_IVL'):
+            return
+        timeout = self.settings.get('HeartbeatTimeout')
+        socket.setsockopt(zmq.HEARTBEAT_IVL, int(interval * 1000))
+        socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, int(timeout * 1000))
+        # Manager drops us if our PINGs stop for longer.
+        socket.setsockopt(zmq.HEARTBEAT_TTL, int((interval + timeout) * 1000))
 
     def _connect_pub_socket(self):
-        self.pub_socket = self.context.socket(zmq.PUB)
+        # XPUB with NODROP is PUB that reports a full pipe with EAGAIN
+        # instead of dropping silently.
+        self.pub_socket = self.context.socket(zmq.XPUB)
+        self.pub_socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self.pub_socket.setsockopt(zmq.SNDHWM, self.settings.get('SndHWM'))
         self.pub_socket.setsockopt(zmq.RECONNECT_IVL, 1000)
+        self._set_heartbeat(self.pub_socket)
         self.pub_socket.connect(self.settings.get('PubAddr'))
         self.pub_socket.setsockopt(zmq.IDENTITY, self.uid)
         logger.debug('Connected PUB socket.')
 
     def _connect_sub_socket(self):
         self.sub_socket = self.context.socket(zmq.SUB)
+        self.sub_socket.setsockopt(zmq.RCVHWM, self.settings.get('RcvHWM'))
+        # Subscriptions are all SUB sends, none may be dropped.
+        self.sub_socket.setsockopt(zmq.SNDHWM, 0)
         self.sub_socket.setsockopt(zmq.RECONNECT_IVL, 1000)
+        self._set_heartbeat(self.sub_socket)
         self.sub_socket.connect(self.settings.get('SubAddr'))
         self.sub_socket.setsockopt(zmq.IDENTITY, self.uid)
         # Subscribe to messages for actor and also broadcasts
         self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'|{}|'.format(self.uid))
+        self.subscriptions.add(b'|{}|'.format(self.uid))
         if not self.settings.get('RunMinimalMode'):
             self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'|*|')
+            self.subscriptions.add(b'|*|')
         logger.debug('Connected SUB socket.')
 
 
+    def _connect_control_sockets(self):
+        self.control_sub_socket = self.context.socket(zmq.SUB)
+        self.control_sub_socket.setsockopt(zmq.SNDHWM, 0)
+        self.control_sub_socket.setsockopt(zmq.RECONNECT_IVL, 1000)
+        self._set_heartbeat(self.control_sub_socket)
+        self.control_sub_socket.connect(self.settings.get('ControlSubAddr'))
+        self.control_sub_socket.setsockopt(zmq.SUBSCRIBE,
+                                           b'|{}|'.format(self.uid))
+        if not self.settings.get('RunMinimalMode'):
+            self.control_sub_socket.setsockopt(zmq.SUBSCRIBE, b'|*|')
+        self.control_pub_socket = self.context.socket(zmq.PUB)
+        self.control_pub_socket.setsockopt(zmq.RECONNECT_IVL, 1000)
+        self._set_heartbeat(self.control_pub_socket)
+        self.control_pub_socket.connect(self.settings.get('ControlPubAddr'))
+        logger.debug('Connected control sockets.')
+
+    def _disconnect_control_sockets(self):
+        for socket in (self.control_sub_socket, self.control_pub_socket):
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
+        logger.debug('Disconnected control sockets.')
+
     def _disconnect_pub_socket(self):
+        self.pub_socket.disable_monitor()
         self.pub_socket.setsockopt(zmq.LINGER, 0)
         self.pub_socket.close()
         logger.debug('Disconnected PUB socket.')
 
+    def _connect_queue_socket(self):
+        self.queue_socket = self.context.socket(zmq.DEALER)
+        # ZManager sends work to this identity.
+        self.queue_socket.setsockopt(zmq.IDENTITY, self.uid)
+        self.queue_socket.setsockopt(zmq.RECONNECT_IVL, 1000)
+        self._set_heartbeat(self.queue_socket)
+        self.queue_socket.connect(self.settings.get('QueueAddr'))
+        self.greenlets.append(gevent.spawn(self.receive_queue))
+        self.greenlets.append(gevent.spawn(self.queue_heartbeat))
+        logger.debug('Connected work queue socket.')
+
+    def _disconnect_queue_socket(self):
+        self.queue_socket.setsockopt(zmq.LINGER, 0)
+        self.queue_socket.close()
+        logger.debug('Disconnected work queue socket.')
+
     def _disconnect_sub_socket(self):
+        self.sub_socket.disable_monitor()
         self.sub_socket.setsockopt(zmq.LINGER, 0)
         self.sub_socket.close()
         logger.debug('Disconnected SUB socket.')
@@ -189,15 +499,30 @@ class ZActor(object):
         if new_debug:
             logger.info('Changing Debug to {}'.format(new_debug))
             logger.setLevel(level=logging.DEBUG if new_debug else logging.INFO)
+        # Switch body codec, receivers decode by the envelope tag.
+        new_codec = new_settings.get('Codec')
+        if new_codec:
+            self.codec = zcodec.get_codec(new_codec)
+            logger.info('Changing Codec to {}'.format(new_codec))
+        if any(name in new_settings for name in (
+                'Compression', 'CompressionThreshold', 'CompressionByMessage')):
+            self._compression_cache = {}
 
 
     def stop(self, exit=True):
         logger.info('Stopping...')
         self.save_settings()
+        self.flush()
         sys.stdout.flush()
         sys.stderr.flush()
         self._disconnect_sub_socket()
         self._disconnect_pub_socket()
+        if self.control_sub_socket is not None:
+            self._disconnect_control_sockets()
+        if self.queue_socket is not None:
+            if self.work_queues:
+                self._queue_send([b'LEAVE'] + sorted(self.work_queues))
+            self._disconnect_queue_socket()
         if exit:
             sys.exit(0)
 
@@ -241,91 +566,486 @@ class ZActor(object):
 
 
     def subscribe(self, s):
-        # Add additional subscriptions here.
+        # Add additional subscriptions here. s is a name or a topic pattern
+        # like orders.eu.* or orders.#, see ztopic.
+        s = to_bytes(s)
+        if ztopic.is_pattern(s):
+            if not self.topics.add(s):
+                return
+            prefix = ztopic.subscription_prefix(s)
+        else:
+            prefix = b'|{}|'.format(s)
+            if prefix in self.subscriptions:
+                return
+            self.subscriptions.add(prefix)
         logger.info('Subscribed for {}.'.format(s))
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'|{}|'.format(s))
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, prefix)
+        if self.control_sub_socket is not None:
+            # Control messages to the topic take the control lane.
+            self.control_sub_socket.setsockopt(zmq.SUBSCRIBE, prefix)
 
     def unsubscribe(self, s):
-        # Add additional subscriptions here.
+        s = to_bytes(s)
+        if ztopic.is_pattern(s):
+            if not self.topics.remove(s):
+                return
+            prefix = ztopic.subscription_prefix(s)
+        else:
+            prefix = b'|{}|'.format(s)
+            if prefix not in self.subscriptions:
+                return
+            self.subscriptions.remove(prefix)
         logger.info('Unsubscribed from {}.'.format(s))
-        self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, b'|{}|'.format(s))
+        self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, prefix)
+        if self.control_sub_socket is not None:
+            self.control_sub_socket.setsockopt(zmq.UNSUBSCRIBE, prefix)
+
+    def subscribed(self):
+        # Names and patterns we are subscribed to.
+        return sorted([key[1:-1] for key in self.subscriptions] +
+                      self.topics.patterns())
+
+    def join_queue(self, name):
+        # Take a share of messages to name from the ZManager work queue,
+        # each goes to one member only. They are acked when the handler
+        # is done, what a member had unacked when it died goes to others.
+        name = to_bytes(name)
+        if self.queue_socket is None:
+            self._connect_queue_socket()
+        self.work_queues.add(name)
+        logger.info('Joined work queue {}.'.format(name))
+        self._queue_heartbeat()
+
+    def leave_queue(self, name):
+        name = to_bytes(name)
+        if name not in self.work_queues:
+            return
+        self.work_queues.remove(name)
+        logger.info('Left work queue {}.'.format(name))
+        self._queue_send([b'LEAVE', name])
+
+    def _queue_send(self, frames):
+        with self.queue_lock:
+            self.queue_socket.send_multipart(frames)
+
+    def _queue_load(self):
+        return str(len(self.handler_pool) + len(self.handler_queue))
+
+    def _queue_heartbeat(self):
+        self._queue_send(
+            [b'HEARTBEAT', self._queue_load()] + sorted(self.work_queues))
+
+    def queue_heartbeat(self):
+        # Joins again after a ZManager restart too.
+        while True:
+            gevent.sleep(self.settings.get('QueueHeartbeatInterval'))
+            if self.work_queues and not self.queue_socket.closed:
+                self._queue_heartbeat()
+
+    def _ack(self, msg):
+        # Work queue message is done, ZManager can send the next one.
+        if 'DeliveryTag' in msg and self.queue_socket is not None and \
+                not self.queue_socket.closed:
+            self._queue_send(
+                [b'ACK', msg['DeliveryTag'], self._queue_load()])
+
+    def _accepts(self, key):
+        # Pattern prefixes let through topics the wildcards don't match.
+        return not self.topics or key in self.subscriptions or \
+            self.topics.match(key[1:-1])
 
 
     def receive(self):
-        # Actor sibscription receive loop
+        # Actor sibscription receive loop. The control lane is read first,
+        # data in batches of what is ready, dispatched by priority.
         logger.debug('Receiver has been started.')
+        poller = zmq.Poller()
+        poller.register(self.sub_socket, zmq.POLLIN)
+        if self.control_sub_socket is not None:
+            poller.register(self.control_sub_socket, zmq.POLLIN)
+        drain = zlane.PriorityDrain(self.settings.get('PriorityWeights'))
         while True:
             try:
-                header, msg = self.sub_socket.recv_multipart()
-                # Update counters
-                self.receive_message_count +1
-                self.last_msg_time = time.time()
-                self.last_msg_time_sum = 0
-
-                msg = json.loads(msg)
-                msg.update({'Received': time.time()})
-
-                if self.settings.get('Trace'):
-                    logger.debug('Received: {}'.format(
-                        json.dumps(msg, indent=4)
-                    ))
+                poller.poll()
+                control = []
+                if self.control_sub_socket is not None:
+                    control = zlane.recv_batch(
+                        self.control_sub_socket,
+                        self.settings.get('ReceiveBatch'), copy=False)
+                # Not copied, attachments are handed out as memoryviews.
+                data = zlane.recv_batch(self.sub_socket,
+                                        self.settings.get('ReceiveBatch'),
+                                        copy=False)
+            except zmq.ZMQError as e:
+                if self.sub_socket.closed:
+                    # Closed by stop().
+                    return
+                logger.warning('SUB socket error: {}'.format(e))
+                gevent.sleep(0.1)
+                continue
+            # Update counters, the time is of the whole batch.
+            now = self.last_msg_time = time.time()
+            self.last_msg_time_sum = 0
+
+            # A bad message must not stop the loop, the rest of the batch
+            # and later ones are fine.
+            for frames in control:
+                for msg in self._unpack(frames, now):
+                    self.receive_message_count += 1
+                    try:
+                        self._dispatch(msg, control=True)
+                    except Exception as e:
+                        self._receive_error(e)
+            for frames in data:
+                for msg in self._unpack(frames, now):
+                    # Checked in order of arrival, dispatched by priority.
+                    try:
+                        if self._check_received(msg):
+                            drain.put(self._priority(msg), msg)
+                    except Exception as e:
+                        self._receive_error(e)
+            for msg in drain:
+                self.receive_message_count += 1
+                try:
+                    self._dispatch(msg)
+                except Exception as e:
+                    self._receive_error(e)
+
+
+    def _receive_error(self, e):
+        if self.settings.get('Debug'):
+            logger.exception(e)
+        else:
+            logger.error('Receive error: {}'.format(e))
+
+
+    def _check_received(self, msg):
+        # Returns False for a duplicate. Replays overlap with what we have
+        # got before the disconnect.
+        if 'DestSequence' in msg and self.settings.get('SequenceCheck'):
+            return self._check_sequence(msg)
+        if self.recent_ids is not None and 'Id' in msg and \
+                not self.recent_ids.add(msg['Id']) and msg.get('Replayed'):
+            self.stat_duplicates.inc(msg.get('From'))
+            return False
+        return True
 
-                # Check expiration
-                time_diff = abs(time.time() - float(msg.get('SendTime', 0)))
-                logger.debug('Time difference: {}'.format(time_diff))
-                exp_time = float(self.settings.get('MessageExpireTime'))
-                threashold = 1
-                if time_diff >= exp_time and time_diff <= exp_time + threashold:
-                    # Give a WARNING on 1 second before discard
-                    logger.warning(
-                        'Nearly expired ({} seconds) message {}.'.format(
-                            time_diff, json.dumps(msg, indent=4)))
-                elif time_diff > exp_time + threashold:
-                    logger.error(
-                        'Discarding expired ({} seconds) message {}.'.format(
-                            time_diff, json.dumps(msg, indent=4)))
-                    # Next message please...
-                    continue
 
+    def _priority(self, msg):
+        try:
+            return zlane.priority(msg.get('Priority'))
+        except ValueError:
+            return 0 # Sender without the check.
+
+
+    def _unpack(self, frames, now):
+        # Messages we accept of a received multipart message.
+        try:
+            if len(frames) == 2:
+                # Published without envelope.
+                msgs = [self._decode_json(frames[1].bytes, now)
+                        if self._accepts(frames[0].bytes) else None]
+            else:
+                # One or more [key, envelope, body, ...] units.
+                msgs = [self._decode(now, *unit) for unit in zenvelope.units(
+                    frames, lambda frame: frame.bytes)
+                    if self._accepts(unit[0].bytes)]
+        except Exception as e:
+            self._receive_error(e)
+            return []
+        return [msg for msg in msgs if msg is not None]
+
+
+    def receive_queue(self):
+        # Messages of work queues we have joined.
+        logger.debug('Work queue receiver has been started.')
+        while True:
+            try:
+                frames = self.queue_socket.recv_multipart(copy=False)
+                now = time.time()
+                tag = frames[1].bytes
+                msg = self._decode(now, *frames[2:])
             except zmq.ZMQError as e:
-                # This can be error due to ping() closing SUB socket.
-                if self.last_pub_sub_reconnect - time.time() > 1:
-                    self._disconnect_sub_socket()
-                    self._connect_sub_socket()
-                    logger.warning('SUB socket error: {}'.format(e))
+                if self.queue_socket.closed:
+                    return
+                logger.warning('Work queue socket error: {}'.format(e))
+                gevent.sleep(0.1)
                 continue
-
             except Exception as e:
-                if self.settings.get('Debug'):
-                    logger.exception(e)
-                else:
-                    error('Receive error: {}'.format(e))
+                logger.error('Work queue receive error: {}'.format(e))
+                msg = None
+            if msg is None:
+                # Expired or broken, nothing to do but ack.
+                self._ack({'DeliveryTag': tag})
                 continue
+            # No sequence check, every member gets a part of them.
+            msg['DeliveryTag'] = tag
+            self.last_msg_time = now
+            self.receive_message_count += 1
+            self._dispatch(msg)
+            if msg.get('ReplyToId') or \
+                    msg.get('Message') not in self.handlers:
+                self._ack(msg) # Done already, no handler to wait for.
+
+
+    def _decode(self, now, key, envelope, body, *attachments):
+        # Frames are zmq.Frame, check expiration before the body is decoded.
+        # now is when the batch was received.
+        key = key.bytes
+        try:
+            envelope = zenvelope.unpack(envelope.bytes)
+        except zenvelope.UnsupportedVersion as e:
+            # Sender of a version we cannot read, the rest of the batch
+            # may be fine.
+            self.stat_unsupported.inc(e.version)
+            return
+        if envelope.flags & zenvelope.MIRROR and \
+                envelope.sender in local_actors:
+            # We have got it already by local delivery.
+            return
+        if not envelope.flags & zenvelope.REPLAY and \
+                self._is_expired(abs(now - envelope.send_time),
+                                 envelope.message, now):
+            self.stat_expired.inc(envelope.message)
+            return
+        msg = zcodec.get_codec_by_tag(envelope.codec).decode(
+            zcompress.decompress(envelope.flags, body.bytes))
+        msg.update({'Received': now})
+        if envelope.flags & zenvelope.REPLAY:
+            msg['Replayed'] = True
+        if envelope.flags & zenvelope.REDELIVERED:
+            msg['Redelivered'] = True
+        if envelope.flags & zenvelope.TRACED:
+            msg['Hops'] = msg.get('Hops', []) + ztrace.unpack(
+                envelope.trace) + [ztrace.stamp(ztrace.RECEIVE)]
+        if self.settings.get('Trace'):
+            logger.debug('Received: {}'.format(
+                json.dumps(msg, indent=4)
+            ))
+        if attachments:
+            # Views keep the received frames alive, no copy is made.
+            msg['Attachments'] = [frame.buffer for frame in attachments]
+        return msg
 
-            # Check if it is a reply
-            reply_to_id = msg.get('ReplyToId')
-            if reply_to_id:
-                # Yes, find who is waiting for it.
-                if self.ask_pool.get(reply_to_id):
-                    self.ask_pool[reply_to_id][
-                        'result'] = msg
-                    self.ask_pool[reply_to_id]['event'].set()
-                else:
-                    logger.error('Got an unexpected reply: {}'.format(
-                        json.dumps(msg, indent=4)
-                    ))
-                continue
-            # It's not a reply, so find for message handler
+
+    def _decode_json(self, data, now):
+        msg = json.loads(data)
+        msg.update({'Received': now})
+        if self.settings.get('Trace'):
+            logger.debug('Received: {}'.format(
+                json.dumps(msg, indent=4)
+            ))
+        if self._is_expired(abs(now - float(msg.get('SendTime', 0))),
+                            msg.get('Message'), now):
+            self.stat_expired.inc(msg.get('Message'))
+            return
+        return msg
+
+
+    def _check_sequence(self, msg):
+        # Returns False for a duplicate, asks the sender for gaps.
+        sender = msg.get('From')
+        stream = (sender, msg.get('Retransmit') or msg.get('To'))
+        seq = msg['DestSequence']
+        if not is_sequence(seq):
+            # Not numbered by us, nothing to check it against.
+            logger.warning('Bad DestSequence {!r} of {} from {}.'.format(
+                seq, msg.get('Message'), sender))
+            return True
+        epoch = msg.get('SequenceEpoch')
+        window = self.sequence_windows.get(stream)
+        if window is None or window.epoch != epoch:
+            # First message from the sender or from its new run, nothing
+            # to compare.
+            if window is not None:
+                logger.info('{} has restarted, numbers start over.'.format(
+                    sender))
+            self.sequence_windows[stream] = SequenceWindow(
+                seq, self.settings.get('SequenceWindow'), epoch)
+            return True
+        new, gap = window.receive(seq)
+        if not new:
+            if msg.get('ReplyTo') and not msg.get('Retransmit') and \
+                    not msg.get('Replayed'):
+                # Sender retries an ask, its reply could be lost.
+                return True
+            self.stat_duplicates.inc(sender)
+            logger.debug('Duplicate {} #{} from {}.'.format(
+                msg.get('Message'), seq, sender))
+            return False
+        if gap:
+            self.stat_gaps.inc(sender)
+            logger.warning('Missing #{}-{} from {} to {}.'.format(
+                gap[0], gap[1], sender, stream[1]))
+            gevent.spawn(self._request_retransmit, stream, gap, window)
+        lost = window.overflow()
+        if lost:
+            self.stat_lost.inc(sender, lost)
+        return True
+
+
+    def _request_retransmit(self, stream, gap, window):
+        sender, to = stream
+        try:
+            res = self.ask_async({
+                'Message': 'Retransmit',
+                'To': sender,
+                'Stream': to,
+                'First': gap[0],
+                'Last': gap[1],
+                'Epoch': window.epoch, # Run of the sender we missed.
+            }, attempts=2).get()
+            # Sender does not have these anymore.
+            oldest = res.get('Oldest', gap[0])
+            missing = res.get('Missing') or []
+        except AskError:
+            oldest, missing = gap[1] + 1, []
+        if self.sequence_windows.get(stream) is not window:
+            # Sender has restarted meanwhile.
+            return
+        lost = window.skip(gap[0], oldest - 1) if oldest > gap[0] else 0
+        for seq in missing:
+            lost += window.skip(seq, seq)
+        if lost:
+            self.stat_lost.inc(sender, lost)
+            logger.warning('Lost {} messages from {} to {}.'.format(
+                lost, sender, to))
+
+
+    def _deliver_local(self, msg):
+        # Message from an actor of this process, nothing to decode. The
+        # copy is shallow so handlers must not change nested values.
+        msg = dict(msg, Received=time.time())
+        if 'Hops' in msg:
+            msg['Hops'] = msg['Hops'] + [ztrace.stamp(ztrace.RECEIVE)]
+        self.last_msg_time = msg['Received']
+        self.last_msg_time_sum = 0
+        self.receive_message_count += 1
+        self._dispatch(msg)
+
+
+    def _is_expired(self, time_diff, message, now):
+        # Expired messages are logged as a summary, see zlane.Expiry.
+        return self.expiry.check(
+            time_diff, float(self.settings.get('MessageExpireTime')),
+            message, now)
+
+
+    def _dispatch(self, msg, control=False):
+        self.stat_received.inc(msg.get('Message'))
+        self.stat_senders.inc(msg.get('From'))
+        # Check if it is a reply
+        reply_to_id = msg.get('ReplyToId')
+        if reply_to_id:
+            # Yes, find who is waiting for it.
+            stream = self.streams.get(reply_to_id)
+            if stream is not None:
+                stream.put(msg)
+                return
+            if msg.get('Error') == 'NoRoute':
+                ask = self.ask_pool.reject(msg, NoRoute(reply_to_id))
             else:
-                # Yes, a bit of magic here for easier use IMHO.
-                if hasattr(self, 'on_{}'.format(msg.get('Message'))):
-                    gevent.spawn(
-                        getattr(
-                            self, 'on_{}'.format(msg.get('Message'))), msg)
-                else:
-                    logger.debug('Don\'t know how to handle message: {}'.format(
-                        json.dumps(msg, indent=4)))
-                    continue
+                ask = self.ask_pool.resolve(msg)
+                if ask and self.reply_cache is not None:
+                    self._cache_reply(ask.msg, msg)
+            if ask:
+                self.stat_ask_latency.observe(
+                    time.time() - ask.msg['SendTime'])
+                if 'Hops' in msg:
+                    msg['Hops'].append(ztrace.stamp(ztrace.RESOLVE))
+                    self.tracer.record(ask.msg.get('Message'), msg['Hops'])
+            else:
+                # Late after a timeout or a retry, don't dump them all.
+                logger.warning('Got an unexpected {} from {}.'.format(
+                    msg.get('Message'), msg.get('From')))
+        # Credits and cancels are handled here, not in the handler pool
+        # that producers waiting for credits may have filled.
+        elif msg.get('Message') in ('StreamCredit', 'StreamCancel'):
+            self._stream_control(msg)
+        # It's not a reply, so find for message handler
+        else:
+            handler = self.handlers.get(msg.get('Message'))
+            if handler:
+                self._submit(handler, msg, control)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Don\'t know how to handle message: {}'.format(
+                    json.dumps(msg, indent=4, default=repr)))
+
+
+    def _submit(self, handler, msg, control=False):
+        # Run handler in the pool or apply HandlerOverflow policy. Control
+        # lane handlers don't wait for the pool.
+        if control:
+            gevent.spawn(self._run, handler, msg)
+            return
+        if not self.handler_pool.full():
+            self.handler_pool.spawn(self._handle, handler, msg)
+            return
+        policy = self.settings.get('HandlerOverflow')
+        if policy == 'block':
+            # Receive loop waits here for a free greenlet.
+            self.handler_pool.spawn(self._handle, handler, msg)
+        elif len(self.handler_queue) < self.settings.get('HandlerQueueSize'):
+            self.handler_queue.append((handler, msg))
+        elif policy == 'drop_oldest':
+            self.handler_dropped += 1
+            dropped = self.handler_queue.popleft()[1]
+            logger.warning('Handler queue is full, dropped {} from {}.'.format(
+                dropped.get('Message'), dropped.get('From')))
+            self._ack(dropped)
+            self.handler_queue.append((handler, msg))
+        else:
+            self.handler_rejected += 1
+            logger.warning('Handler queue is full, rejected {} from {}.'.format(
+                msg.get('Message'), msg.get('From')))
+            self._ack(msg)
+            for to in msg.get('ReplyTo') or []:
+                self.tell({
+                    'To': to,
+                    'Message': '{}Reply'.format(msg.get('Message')),
+                    'ReplyToId': msg['Id'],
+                    'Error': 'Overloaded',
+                })
+
+
+    def _handle(self, handler, msg):
+        # Runs in the handler pool, takes queued messages when done.
+        while True:
+            self._run(handler, msg)
+            if not self.handler_queue:
+                return
+            handler, msg = self.handler_queue.popleft()
+
+
+    def _run(self, handler, msg):
+        name = msg.get('Message')
+        hops = msg.get('Hops')
+        if hops is not None:
+            hops.append(ztrace.stamp(ztrace.HANDLER_START))
+        self.handler_concurrency[name] += 1
+        try:
+            handler(msg)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.handler_concurrency[name] -= 1
+            self._ack(msg)
+        if hops is not None and not msg.get('ReplyTo'):
+            # Asks are traced by the asker when the reply comes.
+            hops.append(ztrace.stamp(ztrace.HANDLER_END))
+            self.tracer.record(name, hops)
+
+
+    def handler_stats(self):
+        return {
+            'PoolSize': self.handler_pool.size,
+            'Running': len(self.handler_pool),
+            'QueueDepth': len(self.handler_queue),
+            'Dropped': self.handler_dropped,
+            'Rejected': self.handler_rejected,
+            'Concurrency': dict((name, count) for name, count in
+                                self.handler_concurrency.items() if count),
+        }
 
 
 
@@ -333,103 +1053,611 @@ class ZActor(object):
         res = msg.copy()
         for key in msg:
             if key in ['Id', 'ReplyToId', 'To', 'Received', 'From', 'Message',
-                       'SendTime', 'Sequence']:
+                       'SendTime', 'Sequence', 'DestSequence']:
                 res.pop(key)
         return res
 
 
 
-    def tell(self, msg):
-        # This is used to send a message to the bus.
+    def _new_id(self):
+        return '{}{:016x}'.format(self._id_prefix, next(self._id_counter))
+
+
+    def _human_time(self, now):
+        # strftime only once a second.
+        second, human = self._send_time_human
+        if second != int(now):
+            human = datetime.strftime(datetime.fromtimestamp(now),
+                                      '%Y-%m-%d %H:%M:%S')
+            self._send_time_human = (int(now), human)
+        return human
+
+
+    def _send(self, msg):
+        if 'Priority' in msg:
+            msg['Priority'] = zlane.priority(msg['Priority'])
+        self.stat_sent.inc(msg.get('Message'))
+        flags = 0
+        if self.settings.get('LocalDelivery'):
+            target = local_actors.get(msg.get('To'))
+            if target is not None:
+                target._deliver_local(msg)
+                if not self.settings.get('LocalMirror') or \
+                        not self.settings.get('Envelope'):
+                    return
+                flags = zenvelope.MIRROR
+        if msg.get('ReplyTo') and self.settings.get('NoRouteReply'):
+            flags |= zenvelope.NOROUTE
+        trace = None
+        if 'Hops' in msg:
+            flags |= zenvelope.TRACED
+            trace = ztrace.pack(ztrace.SEND)
+        attachments = msg.get('Attachments') or []
+        if not self.settings.get('Envelope'):
+            if attachments:
+                raise ValueError('Attachments need Envelope.')
+            # Plain JSON for managers without envelope support.
+            self._write([json.dumps(msg)])
+            return
+        body = msg
+        if attachments:
+            body = dict(msg)
+            del body['Attachments']
+        body = self.codec.encode(body)
+        compressor, threshold = self._compression(msg.get('Message'))
+        if compressor is not None and len(body) >= threshold:
+            compressed = compressor.compress(body)
+            self.stat_compression_in.inc(compressor.name, len(body))
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= zcompress.envelope_flags(compressor)
+            self.stat_compression_out.inc(compressor.name, len(body))
+        frames = [
+            zenvelope.routing_key(msg.get('To')),
+            zenvelope.pack(msg['SendTime'],
+                           self.settings.get('MessageExpireTime'),
+                           codec=self.codec.tag, flags=flags,
+                           sender=self.uid, message=msg.get('Message'),
+                           attachments=len(attachments),
+                           priority=msg.get('Priority') or 0,
+                           trace=trace),
+            body]
+        # Any buffer protocol object, libzmq takes it with one memcpy.
+        frames.extend(attachments)
+        if self._is_control(msg.get('Message')):
+            # Not batched or queued behind data.
+            self.control_pub_socket.send_multipart(frames)
+            return
+        batch_size = self.settings.get('BatchSize')
+        if not batch_size or msg.get('To') == self.settings.get('ManagerUID'):
+            # Alone, every manager shard gets messages to the manager.
+            self._write(frames)
+            return
+        # Batching: units are sent back to back in one multipart message.
+        self._batch.extend(frames)
+        self._batch_units += 1
+        if self._batch_units >= batch_size:
+            self.flush()
+        elif self._batch_flusher is None:
+            self._batch_flusher = gevent.spawn_later(
+                self.settings.get('BatchInterval') / 1000.0, self.flush)
+
+
+    def _compression(self, message):
+        # Returns (compressor or None, threshold) for message name.
+        try:
+            return self._compression_cache[message]
+        except KeyError:
+            pass
+        override = (self.settings.get('CompressionByMessage') or {}).get(
+            message, {})
+        name = override.get('Compression', self.settings.get('Compression'))
+        threshold = override.get('Threshold',
+                                 self.settings.get('CompressionThreshold'))
+        compressor = zcompress.get_compressor(name) if name else None
+        self._compression_cache[message] = (compressor, threshold or 0)
+        return self._compression_cache[message]
+
+
+    def flush(self):
+        # Send pending batch now.
+        flusher, self._batch_flusher = self._batch_flusher, None
+        if flusher is not None and flusher is not gevent.getcurrent():
+            flusher.kill(block=False)
+        if not self._batch:
+            return
+        frames, self._batch = self._batch, []
+        self._batch_units = 0
+        self._write(frames)
+
+
+    def _write(self, frames):
+        # Frames are copied into libzmq: zero-copy sends of str above
+        # copy_threshold go through the pyzmq gc thread, which blocks the
+        # hub when threads are monkey patched.
+        if self.send_queue is None:
+            # Waits for the socket when the pipe is at SndHWM.
+            with self.pub_lock:
+                self.pub_socket.send_multipart(frames)
+            return
+        if self.send_queue.empty():
+            try:
+                self.pub_socket.send_multipart(frames, zmq.NOBLOCK)
+                return
+            except zmq.Again:
+                pass
+        if not self.send_queue.full():
+            self.send_queue.put(frames)
+            return
+        policy = self.settings.get('SendOverflow')
+        if policy == 'block':
+            self.send_queue.put(frames)
+            return
+        self.stat_send_dropped.inc(policy)
+        if policy == 'drop_oldest':
+            self.send_queue.get()
+            self.send_queue.put(frames)
+        if self.stat_send_dropped.values[policy] % 1000 == 1:
+            logger.warning('Send queue is full, {} dropped so far ({}).'.format(
+                self.stat_send_dropped.values[policy], policy))
+
+
+    def send_queued(self):
+        # Writes queued sends as the socket takes them.
+        while True:
+            frames = self.send_queue.peek()
+            try:
+                with self.pub_lock:
+                    self.pub_socket.send_multipart(frames)
+            except zmq.ZMQError as e:
+                if self.pub_socket.closed:
+                    return
+                logger.warning('PUB socket error: {}'.format(e))
+                gevent.sleep(0.1)
+                continue
+            # Could be replaced by drop_oldest while we were waiting.
+            if not self.send_queue.empty() and \
+                    self.send_queue.peek() is frames:
+                self.send_queue.get()
+
+
+    def tell(self, msg, sender=None):
+        # This is used to send a message to the bus. Binary data goes to
+        # msg['Attachments'], a list of bytes, memoryview or any buffer
+        # protocol object (numpy arrays too). They are sent as frames of
+        # their own and handlers get them as memoryviews. sender is the
+        # UID of a zhost actor sending through us.
         self.sent_message_count += 1
+        now = time.time()
         msg.update({
-            'Id': uuid.uuid4().hex,
-            'SendTime': time.time(),
-            'From': self.uid,
+            'Id': self._new_id(),
+            'SendTime': now,
+            'From': sender or self.uid,
             'Sequence': self.sent_message_count,
-            'SendTimeHuman': datetime.strftime(datetime.now(),
-                                               '%Y-%m-%d %H:%M:%S')
+            'SendTimeHuman': self._human_time(now),
         })
+        self._stamp(msg)
+        self._sample(msg)
         if self.settings.get('Trace'):
             logger.debug('Telling: {}'.format(json.dumps(
-                msg, indent=4
+                msg, indent=4, default=repr
             )))
-        self.pub_socket.send_json(msg)
+        self._send(msg)
         return msg
 
 
-    def ask(self, msg, attempts=2, timeout=None):
-        # This is used to send a message to the bus and wait for reply
+    def ask_async(self, msg, attempts=2, timeout=None, sender=None):
+        # Send a message and return AsyncResult for the reply. The message
+        # is sent again on every timeout until attempts are exhausted, then
+        # the result fails with AskTimeout. It fails with NoRoute if the
+        # manager knows nobody is subscribed to the destination.
+        # Cacheable asks are answered from the reply cache or share the
+        # identical request in flight, with its attempts and timeout.
+        key = self._cache_key(msg, sender or self.uid)
+        if key is None:
+            return self._ask_async(msg, attempts, timeout, sender)
+        name = msg.get('Message')
+        reply = self.reply_cache.get(key)
+        if reply is not None:
+            self.stat_cache_hits.inc(name)
+            result = AsyncResult()
+            result.set(dict(reply))
+            return result
+        leader = self.asks_in_flight.get(key)
+        if leader is not None and not leader.ready():
+            # A ready one was cancelled or is just being cleaned up.
+            self.stat_cache_shared.inc(name)
+            self.ask_followers[leader] = self.ask_followers.get(leader, 0) + 1
+            result = AsyncResult()
+            leader.rawlink(lambda leader: self._share_reply(leader, result))
+            return result
+        self.stat_cache_misses.inc(name)
+        result = self._ask_async(msg, attempts, timeout, sender)
+        self.asks_in_flight[key] = result
+        result.rawlink(lambda result: self._ask_done(key, result))
+        return result
+
+
+    def _share_reply(self, leader, result):
+        # Every asker gets a copy it may change.
+        if leader.successful():
+            result.set(dict(leader.value))
+        else:
+            result.set_exception(leader.exception)
+
+
+    def _ask_done(self, key, result):
+        if self.asks_in_flight.get(key) is result:
+            del self.asks_in_flight[key]
+        self.ask_followers.pop(result, None)
+
+
+    def _cache_key(self, msg, sender):
+        # Request key if msg is a cacheable ask, otherwise None.
+        if self.reply_cache is None:
+            return None
+        name = msg.get('Message')
+        if name not in self.settings.get('AskCache') and \
+                (msg.get('To'), name) not in self.cacheable_asks:
+            return None
+        return zcache.request_key(msg, sender)
+
+
+    def _cache_reply(self, request, reply):
+        # CacheTTL of the reply overrides AskCache, 0 not to cache.
+        name = request.get('Message')
+        ttl = reply.get('CacheTTL')
+        if ttl is not None:
+            if ttl:
+                self.cacheable_asks.add((request.get('To'), name))
+            else:
+                self.cacheable_asks.discard((request.get('To'), name))
+        else:
+            ttl = self.settings.get('AskCache').get(name)
+        if not ttl or reply.get('Error'):
+            return
+        key = zcache.request_key(request, request.get('From'))
+        if key is None:
+            return
+        evicted = self.reply_cache.put(key, dict(reply), ttl)
+        if evicted:
+            self.stat_cache_evictions.inc(value=evicted)
+
+
+    def _ask_async(self, msg, attempts, timeout, sender):
+        if not timeout:
+            timeout = self.settings.get('AskTimeout')
+        self.sent_message_count += 1
+        now = time.time()
+        msg.update({
+            'Id': self._new_id(),
+            'SendTime': now,
+            'From': sender or self.uid,
+            'ReplyTo': [sender or self.uid],
+            'Sequence': self.sent_message_count,
+            'SendTimeHuman': self._human_time(now),
+        })
+        self._stamp(msg)
+        self._sample(msg)
+        if self.settings.get('Trace'):
+            logger.debug('Asking: {}'.format(json.dumps(
+                msg, indent=4, default=repr
+            )))
+        result = self.ask_pool.add(msg, attempts, timeout)
+        if self.disconnected and \
+                self.settings.get('AskReconnectPolicy') == 'fail':
+            self.ask_pool.cancel(msg['Id'], Disconnected(msg['Id']))
+            return result
+        self._send(msg)
+        return result
+
+
+    def ask_stream(self, msg, credits=None, timeout=None):
+        # Send a request to a stream_reply handler and return a generator
+        # of reply chunks. Chunks have ReplyToId and StreamChunk, their
+        # number from 0. At most credits chunks are in flight, more are
+        # granted as they are consumed. Closing the generator before the
+        # end cancels the stream. Raises AskTimeout when no chunk comes
+        # in timeout seconds and AskError if the producer failed. The
+        # request is sent when the first chunk is asked for, a generator
+        # dropped before that leaves nothing behind.
+        if not credits:
+            credits = self.settings.get('StreamCredits')
         if not timeout:
             timeout = self.settings.get('AskTimeout')
+        return self._consume_stream(msg, credits, timeout)
+
+
+    def _consume_stream(self, msg, credits, timeout):
         self.sent_message_count += 1
-        msg_id = uuid.uuid4().hex
+        now = time.time()
         msg.update({
-            'Id': msg_id,
-            'SendTime': time.time(),
+            'Id': self._new_id(),
+            'SendTime': now,
             'From': self.uid,
             'ReplyTo': [self.uid],
-            'SendTimeHuman': datetime.strftime(datetime.now(),
-                                               '%Y-%m-%d %H:%M:%S')
+            'Sequence': self.sent_message_count,
+            'SendTimeHuman': self._human_time(now),
+            'StreamCredits': credits,
         })
+        self._stamp(msg)
         if self.settings.get('Trace'):
-            logger.debug('Asking: {}'.format(json.dumps(
-                msg, indent=4
+            logger.debug('Asking stream: {}'.format(json.dumps(
+                msg, indent=4, default=repr
             )))
-        self.ask_pool[msg_id] = {}
-        self.ask_pool[msg_id] = {
-            'event': Event(),
-            'result': {},
+        if self.disconnected and \
+                self.settings.get('AskReconnectPolicy') == 'fail':
+            raise Disconnected(msg['Id'])
+        stream = zstream.Consumer(credits)
+        self.streams[msg['Id']] = stream
+        producer = msg.get('To')
+        try:
+            self._send(msg)
+            while True:
+                chunk = stream.get(timeout)
+                producer = chunk.get('From', producer)
+                if chunk.get('Error') == 'NoRoute':
+                    stream.ended = True
+                    raise NoRoute(msg['Id'])
+                if chunk.get('Error'):
+                    stream.ended = True
+                    raise AskError(chunk['Error'])
+                if chunk.get('StreamEnd'):
+                    stream.ended = True
+                    return
+                yield chunk
+                credits = stream.consumed()
+                if credits:
+                    self.tell({
+                        'Message': 'StreamCredit',
+                        'To': producer,
+                        'StreamId': msg['Id'],
+                        'Credits': credits,
+                    })
+        finally:
+            self.streams.pop(msg['Id'], None)
+            if not stream.ended:
+                self.tell({
+                    'Message': 'StreamCancel',
+                    'To': producer,
+                    'StreamId': msg['Id'],
+                })
+
+
+    def _produce_stream(self, msg, chunks):
+        # Send chunks of a stream_reply handler as credits allow.
+        producer = zstream.Producer(msg.get('StreamCredits') or 1)
+        self.producers[msg['Id']] = producer
+        reply = {
+            'To': msg['ReplyTo'][0],
+            'Message': '{}Chunk'.format(msg.get('Message')),
+            'ReplyToId': msg['Id'],
         }
-        self.pub_socket.send_json(msg)
-        if self.ask_pool[msg_id]['event'].wait(timeout=timeout):
-            # We got a reply
-            result = self.ask_pool[msg_id]['result']
-            del self.ask_pool[msg_id]
-            if self.settings.get('Trace'):
-                logger.debug('Reply received: {}'.format(
-                    json.dumps(result, indent=4)
-                ))
-            return result
+        seq = 0
+        end = dict(reply, StreamEnd=True)
+        try:
+            for chunk in chunks:
+                if not producer.take(self.settings.get('StreamCreditTimeout')):
+                    if not producer.cancelled:
+                        logger.warning('No credits for stream {} of {}, '
+                                       'stopped.'.format(msg['Id'],
+                                                         reply['To']))
+                        end['Error'] = 'NoCredits'
+                    break
+                chunk = dict(chunk or {})
+                chunk.update(reply)
+                chunk['StreamChunk'] = seq
+                self.tell(chunk)
+                seq += 1
+        except Exception as e:
+            logger.exception(e)
+            end['Error'] = str(e) or e.__class__.__name__
+        finally:
+            chunks.close()
+            self.producers.pop(msg['Id'], None)
+        if not producer.cancelled:
+            end['StreamChunk'] = seq
+            self.tell(end)
+
+
+    def _stream_control(self, msg):
+        producer = self.producers.get(msg.get('StreamId'))
+        if producer is None:
+            logger.debug('{} for unknown stream {}.'.format(
+                msg.get('Message'), msg.get('StreamId')))
+        elif msg.get('Message') == 'StreamCredit':
+            producer.grant(msg.get('Credits') or 1)
         else:
+            producer.cancel()
+
+
+    def _is_control(self, name):
+        # Goes on the control lane.
+        return self.control_pub_socket is not None and \
+            zlane.is_control(name, self.control_messages)
+
+
+    def _stamp(self, msg):
+        # Sequence for gap detection, not for messages that overtake data:
+        # on the control lane or with a Priority.
+        if self.send_buffer is not None and not msg.get('Priority') and \
+                not self._is_control(msg.get('Message')):
+            self.send_buffer.stamp(msg)
+
+
+    def _sample(self, msg):
+        # Trace TraceSampleRate of new messages, replies go on with the
+        # hops of their request.
+        rate = self.settings.get('TraceSampleRate')
+        if rate and 'ReplyToId' not in msg and 'Hops' not in msg and \
+                random.random() < rate:
+            msg['Hops'] = []
+
+
+    def _resend(self, msg):
+        now = time.time()
+        msg.update({
+            'SendTime': now,
+            'SendTimeHuman': self._human_time(now),
+        })
+        self._send(msg)
+
+
+    def ask(self, msg, attempts=2, timeout=None, sender=None):
+        # This is used to send a message to the bus and wait for reply
+        try:
+            result = self.ask_async(msg, attempts, timeout, sender).get()
+        except AskError as e:
             # No reply was received
-            logger.debug('No reply was received for {}'.format(
-                json.dumps(msg, indent=4)
+            logger.debug('No reply was received ({}) for {}'.format(
+                e.__class__.__name__, json.dumps(msg, indent=4, default=repr)
             ))
             return {}
+        if self.settings.get('Trace'):
+            logger.debug('Reply received: {}'.format(
+                json.dumps(result, indent=4)
+            ))
+        return result
+
+
+    def ask_many(self, msg, uids, quorum=None, attempts=1, timeout=None):
+        # Ask every UID and return {uid: reply} as soon as quorum replies
+        # (all by default) are received or the rest have timed out.
+        results = {}
+        sent = {} # Id by result of requests we have sent ourselves.
+        for uid in uids:
+            request = dict(msg, To=uid)
+            result = self.ask_async(request, attempts, timeout)
+            results[result] = uid
+            if request.get('Id') != msg.get('Id'):
+                # Got a new Id, not answered from the cache or shared with
+                # an ask in flight.
+                sent[result] = request['Id']
+        if quorum is None or quorum > len(results):
+            quorum = len(results)
+        replies = {}
+        for result in gevent.iwait(list(results)):
+            if result.successful():
+                replies[results[result]] = result.value
+                if len(replies) >= quorum:
+                    break
+        # Forget requests we don't wait for anymore. The ones other askers
+        # share go on for them and fill the cache.
+        for result, msg_id in sent.items():
+            if not result.ready() and not self.ask_followers.get(result):
+                self.ask_pool.cancel(msg_id)
+        return replies
+
+
+
+    def monitor(self, socket, name):
+        # Follow connection events of PUB / SUB socket. libzmq reconnects
+        # by itself, here we only decide what happens to pending asks.
+        monitor = socket.get_monitor_socket(
+            zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED |
+            zmq.EVENT_MONITOR_STOPPED)
+        while True:
+            event = recv_monitor_message(monitor)
+            if event['event'] == zmq.EVENT_MONITOR_STOPPED:
+                break
+            if event['event'] == zmq.EVENT_DISCONNECTED:
+                self._connection_lost(name, event['endpoint'])
+            elif name in self.disconnected:
+                self._connection_restored(name, event['endpoint'])
+        monitor.close(linger=0)
+
+
+    def _connection_lost(self, name, endpoint):
+        logger.warning('{} socket disconnected from {}.'.format(
+            name, endpoint))
+        if not self.disconnected:
+            self.disconnected_at = time.time()
+        self.disconnected.add(name)
+        self.stat_disconnects.inc(name)
+        if self.settings.get('AskReconnectPolicy') == 'fail':
+            failed = self.ask_pool.fail_all(Disconnected(endpoint))
+            if failed:
+                logger.warning('Failed {} pending asks.'.format(failed))
+
+
+    def _connection_restored(self, name, endpoint):
+        logger.info('{} socket reconnected to {}.'.format(name, endpoint))
+        self.disconnected.discard(name)
+        self.last_pub_sub_reconnect = time.time()
+        if self.disconnected:
+            return
+        if self.settings.get('AskReconnectPolicy') == 'resend':
+            # Let SUB subscriptions reach the manager before replies do.
+            gevent.spawn_later(0.1, self._resend_pending)
+        if self.settings.get('ReplayOnReconnect'):
+            # Messages could be lost since the last heartbeat before.
+            since = self.disconnected_at - (
+                self.settings.get('HeartbeatInterval') or 0) - (
+                self.settings.get('HeartbeatTimeout') or 0)
+            gevent.spawn_later(0.1, self.replay, since=since)
+
+
+    def _resend_pending(self):
+        if self.disconnected:
+            # Lost again, wait for the next reconnect.
+            return
+        resent = self.ask_pool.resend_all()
+        if resent:
+            logger.info('Resent {} pending asks.'.format(resent))
 
 
 
-    def heartbeat(self):
-        gevent.sleep(1) # Delay before 1-st ping, also allows
-        # HeartbeatInterval to be received from settings.
-        heartbeat_interval = self.settings.get('HeartbeatInterval')
-        if not heartbeat_interval:
-            logger.info('Heartbeat disabled.')
-            return
-        else:
-            logger.debug('Starting heartbeat every {} seconds.'.format(heartbeat_interval))
-        gevent.sleep(2) # Give time for subscriber to setup
-
-        def reconnect_pub_sub():
-            self._disconnect_pub_socket()
-            self._disconnect_sub_socket()
-            self._connect_sub_socket()
-            self._connect_pub_socket()
+    def replay(self, since=None, sender=None, sequence=None, keys=None,
+               timeout=None):
+        # Ask the manager to send again messages for us from its replay
+        # log, since timestamp and / or from sender starting at sequence.
+        # keys are extra subscriptions, our UID and broadcasts are always
+        # replayed. Replayed messages are not expired.
+        msg = {
+            'Message': 'Replay',
+            'To': self.settings.get('ManagerUID'),
+        }
+        if since:
+            msg['Since'] = since
+        if sender:
+            msg['SinceSender'] = sender
+            msg['SinceSequence'] = sequence or 0
+        if keys:
+            msg['Keys'] = list(keys)
+        res = self.ask(msg, attempts=1, timeout=timeout)
+        if res.get('Error'):
+            logger.warning('Replay failed: {}'.format(res.get('Error')))
+        elif res:
+            logger.info('Replayed {} messages.'.format(res.get('Count')))
+        return res
 
-        while True:
-            ret = self.ask({
-                'Message': 'Ping',
-                'To': self.uid,
-            }, timeout=self.settings.get('HeartbeatTimeout'))
-            if not ret:
-                self.last_pub_sub_reconnect = time.time()
-                reconnect_pub_sub()
-                logger.warning('PUB / SUB sockets reconnected.')
-                gevent.sleep(1)
 
-            gevent.sleep(heartbeat_interval)
 
+    @check_reply
+    def on_Retransmit(self, msg):
+        # Send again what we still have of a range a receiver has missed,
+        # to the receiver only.
+        first, last = msg.get('First'), msg.get('Last')
+        if not is_sequence(first) or not is_sequence(last) or first > last:
+            return {'Error': 'BadRange'}
+        if self.send_buffer is None or \
+                msg.get('Epoch') != self.send_buffer.epoch:
+            # Nothing, or numbers of our run before restart.
+            return {'Missing': [], 'Oldest': last + 1}
+        # Nothing older than the buffer can be there.
+        start = max(first, last - self.send_buffer.size + 1)
+        missing = []
+        for seq in range(start, last + 1):
+            sent = self.send_buffer.get(msg.get('To'), msg.get('Stream'), seq)
+            if sent is None:
+                missing.append(seq)
+                continue
+            now = time.time()
+            self._send(dict(sent, To=msg.get('From'),
+                            Retransmit=msg.get('Stream'), SendTime=now,
+                            SendTimeHuman=self._human_time(now)))
+            self.stat_retransmitted.inc()
+        return {'Missing': missing, 'Oldest': start}
 
 
     @check_reply
@@ -469,14 +1697,41 @@ class ZActor(object):
             logger.info('Settings updated.')
 
 
+    @check_reply
+    def on_Stats(self, msg):
+        res = self.stats.as_dict()
+        res['Handlers'] = self.handler_stats()
+        return res
+
+
+    @check_reply
+    def on_Traces(self, msg):
+        # Latency by message type and hop, Timeline for chrome://tracing.
+        res = {'Traces': self.tracer.as_dict()}
+        if msg.get('Timeline'):
+            res['Timeline'] = self.tracer.chrome_trace()
+        return res
+
+
     def on_KeepAlive(self, msg):
         logger.debug('KeepAlive received.')
 
 
-    # TODO: Ideas
+    @check_reply
     def on_Subscribe(self, msg):
-        # TODO: Remote subscrube / unsubscribe
-        pass
+        # Remote subscribe to Topics, a list of names or patterns, e.g.
+        # to join a group that gets one copy of every message published
+        # for it.
+        for topic in msg.get('Topics') or []:
+            self.subscribe(topic)
+        return {'Subscriptions': self.subscribed()}
+
+
+    @check_reply
+    def on_Unsubscribe(self, msg):
+        for topic in msg.get('Topics') or []:
+            self.unsubscribe(topic)
+        return {'Subscriptions': self.subscribed()}
 
 
     def on_Start(self, msg):
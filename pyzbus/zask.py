@@ -0,0 +1,178 @@
+"""
+Pending asks.
+
+Every ask is kept in AskPool until its reply arrives or it runs out of
+attempts. Deadlines are tracked by one TimerWheel per pool instead of a
+waiting greenlet per ask, so a pending ask costs one small record.
+"""
+import gevent
+from gevent.event import AsyncResult
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AskError(Exception):
+    pass
+
+
+class AskTimeout(AskError):
+    pass
+
+
+class NoRoute(AskError):
+    # ZManager has no subscriber for the destination.
+    pass
+
+
+class Disconnected(AskError):
+    # Connection to ZManager was lost while waiting for reply.
+    pass
+
+
+class AskCancelled(AskError):
+    # The asker does not wait for the reply anymore.
+    pass
+
+
+class TimerWheel(object):
+    # Hashed timer wheel, keys expire with resolution precision.
+
+    def __init__(self, callback, resolution=0.1, size=512):
+        self.callback = callback
+        self.resolution = resolution
+        self.slots = [set() for _ in range(size)]
+        self.current = int(time.time() / resolution) # Last processed tick.
+        self.deadlines = {} # key: (deadline, slot)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, timeout):
+        self.cancel(key)
+        deadline = time.time() + timeout
+        slot = int(math.ceil(deadline / self.resolution)) % len(self.slots)
+        self.slots[slot].add(key)
+        self.deadlines[key] = (deadline, slot)
+
+    def cancel(self, key):
+        entry = self.deadlines.pop(key, None)
+        if entry:
+            self.slots[entry[1]].discard(key)
+
+    def run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            now = time.time()
+            target = int(now / self.resolution)
+            # Catch up with ticks missed while the loop was busy.
+            first = max(self.current + 1, target - len(self.slots) + 1)
+            for tick in range(first, target + 1):
+                self.expire(self.slots[tick % len(self.slots)], now)
+            self.current = target
+
+    def expire(self, slot, now):
+        for key in list(slot):
+            entry = self.deadlines.get(key)
+            if entry is None:
+                # Cancelled by a callback.
+                continue
+            if entry[0] > now:
+                # Not yet, wait for the next round.
+                continue
+            slot.discard(key)
+            del self.deadlines[key]
+            try:
+                self.callback(key)
+            except Exception as e:
+                logger.exception(e)
+
+
+class PendingAsk(object):
+    __slots__ = ('msg', 'result', 'attempts', 'timeout')
+
+    def __init__(self, msg, attempts, timeout):
+        self.msg = msg
+        self.result = AsyncResult()
+        self.attempts = attempts
+        self.timeout = timeout
+
+
+class AskPool(object):
+
+    def __init__(self, resend, resolution=0.1):
+        # resend(msg) is called to send a request again on timeout.
+        self.resend = resend
+        self.pending = {}
+        self.wheel = TimerWheel(self.expire, resolution)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, msg, attempts, timeout):
+        ask = PendingAsk(msg, max(1, attempts), timeout)
+        self.pending[msg['Id']] = ask
+        self.wheel.schedule(msg['Id'], timeout)
+        return ask.result
+
+    def resolve(self, reply):
+        # Returns resolved PendingAsk or None if nobody waits for reply.
+        msg_id = reply.get('ReplyToId')
+        ask = self.pending.pop(msg_id, None)
+        if ask is None:
+            return
+        self.wheel.cancel(msg_id)
+        ask.result.set(reply)
+        return ask
+
+    def reject(self, reply, exc):
+        # Fail the ask with exc, returns None if nobody waits for reply.
+        msg_id = reply.get('ReplyToId')
+        ask = self.pending.pop(msg_id, None)
+        if ask is None:
+            return
+        self.wheel.cancel(msg_id)
+        ask.result.set_exception(exc)
+        return ask
+
+    def cancel(self, msg_id, exc=None):
+        # Forget the ask and fail it with exc, AskCancelled by default, so
+        # whoever else waits for the result is let go.
+        self.wheel.cancel(msg_id)
+        ask = self.pending.pop(msg_id, None)
+        if ask is None:
+            return False
+        ask.result.set_exception(exc or AskCancelled(msg_id))
+        return True
+
+    def resend_all(self):
+        # Send every pending ask again, e.g. after reconnect. Deadlines
+        # start over, attempts are not spent.
+        for msg_id, ask in list(self.pending.items()):
+            self.wheel.schedule(msg_id, ask.timeout)
+            self.resend(ask.msg)
+        return len(self.pending)
+
+    def fail_all(self, exc):
+        # Fail every pending ask with exc, returns how many were failed.
+        pending, self.pending = self.pending, {}
+        for msg_id, ask in pending.items():
+            self.wheel.cancel(msg_id)
+            ask.result.set_exception(exc)
+        return len(pending)
+
+    def expire(self, msg_id):
+        ask = self.pending.get(msg_id)
+        if ask is None:
+            return
+        ask.attempts -= 1
+        if ask.attempts > 0:
+            logger.debug('Retrying {} to {}, {} attempts left.'.format(
+                ask.msg.get('Message'), ask.msg.get('To'), ask.attempts))
+            self.wheel.schedule(msg_id, ask.timeout)
+            self.resend(ask.msg)
+            return
+        del self.pending[msg_id]
+        ask.result.set_exception(AskTimeout(msg_id))
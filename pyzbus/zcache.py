@@ -0,0 +1,79 @@
+"""
+Reply cache.
+
+Opt-in requester side layer of ZActor.ask for idempotent requests: the
+same Message with the same body from and to the same UID. Identical asks
+in flight at once share one request and its reply (single flight),
+replies are kept for a TTL in an LRU of AskCacheSize entries. LightActors
+of a ZHost share its cache, a reply can depend on who asks.
+
+Requests are cacheable by name in AskCache, {'GetConfig': 30} keeps
+GetConfigReply for 30 seconds, 0 shares in flight requests only. A
+responder can declare its reply cacheable instead, or set another TTL:
+
+    @check_reply
+    def on_GetConfig(self, msg):
+        return {'Config': self.config, 'CacheTTL': 30}
+
+From then on identical GetConfig asks to it are single flight too.
+Replies with an Error are never kept.
+"""
+from collections import OrderedDict
+import json
+import time
+
+# Fields that differ between identical requests.
+HEADERS = frozenset([
+    'Id', 'From', 'ReplyTo', 'SendTime', 'SendTimeHuman', 'Sequence',
+    'DestSequence', 'SequenceEpoch', 'Received', 'Priority', 'Hops'])
+
+
+def request_key(msg, sender=None):
+    # Same key for the same request of sender, None if it can't be
+    # compared.
+    if msg.get('Attachments'):
+        return None
+    body = dict((key, value) for key, value in msg.items()
+                if key not in HEADERS)
+    if sender:
+        body['From'] = sender
+    try:
+        return json.dumps(body, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ReplyCache(object):
+    # LRU of (expires, reply) by request key, expired entries go when
+    # looked up or pushed out.
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= (now or time.time()):
+            return None
+        self.entries[key] = entry # Most recently used goes last.
+        return entry[1]
+
+    def put(self, key, reply, ttl, now=None):
+        # Returns how many entries were evicted to make room.
+        self.entries.pop(key, None)
+        self.entries[key] = ((now or time.time()) + ttl, reply)
+        evicted = 0
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def clear(self):
+        self.entries.clear()
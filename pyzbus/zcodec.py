@@ -0,0 +1,63 @@
+"""
+Message body codecs.
+
+The codec used to encode a body is selected by the 'Codec' setting and its
+tag is written to the envelope, so receivers always decode with the codec
+the sender used and actors with different settings can share one bus.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+    name = 'json'
+    tag = 0
+
+    def encode(self, msg):
+        return json.dumps(msg)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    tag = 1
+
+    def encode(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs_by_name = {}
+codecs_by_tag = {}
+
+
+def register(codec):
+    codecs_by_name[codec.name] = codec
+    codecs_by_tag[codec.tag] = codec
+
+
+register(JsonCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
+
+
+def get_codec(name):
+    try:
+        return codecs_by_name[name]
+    except KeyError:
+        raise ValueError('Codec {} is not available.'.format(name))
+
+
+def get_codec_by_tag(tag):
+    try:
+        return codecs_by_tag[tag]
+    except KeyError:
+        raise ValueError('Codec with tag {} is not available.'.format(tag))
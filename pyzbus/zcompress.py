@@ -0,0 +1,107 @@
+"""
+Body compression.
+
+Bodies above a size threshold can be compressed by the sender. The
+compressor tag goes to the high bits of the envelope flags, so ZManager
+forwards compressed bodies as they are and receivers know how to expand
+them. zlib is always there, lz4 and zstandard are used if installed.
+"""
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Envelope flag bits holding the compressor tag, 0 is not compressed.
+MASK = 0x30
+SHIFT = 4
+
+
+class ZlibCompressor(object):
+    name = 'zlib'
+    tag = 1
+
+    def __init__(self, level=1):
+        self.level = level # Fast, bandwidth is saved mostly on JSON.
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(object):
+    name = 'lz4'
+    tag = 2
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+class ZstdCompressor(object):
+    name = 'zstd'
+    tag = 3
+
+    def __init__(self, level=3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+compressors_by_name = {}
+compressors_by_tag = {}
+
+
+def register(compressor):
+    compressors_by_name[compressor.name] = compressor
+    compressors_by_tag[compressor.tag] = compressor
+
+
+register(ZlibCompressor())
+if lz4 is not None:
+    register(Lz4Compressor())
+if zstandard is not None:
+    register(ZstdCompressor())
+
+
+def get_compressor(name):
+    try:
+        return compressors_by_name[name]
+    except KeyError:
+        raise ValueError('Compressor {} is not available.'.format(name))
+
+
+def get_compressor_by_tag(tag):
+    try:
+        return compressors_by_tag[tag]
+    except KeyError:
+        raise ValueError(
+            'Compressor with tag {} is not available.'.format(tag))
+
+
+def envelope_flags(compressor):
+    # Envelope flags of a body compressed by compressor.
+    return compressor.tag << SHIFT
+
+
+def decompress(flags, data):
+    # Returns body data as sent, expanded if envelope flags say so.
+    tag = (flags & MASK) >> SHIFT
+    if not tag:
+        return data
+    return get_compressor_by_tag(tag).decompress(data)
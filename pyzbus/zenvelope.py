@@ -0,0 +1,133 @@
+"""
+Message envelope.
+
+Every message on the bus travels as a multipart message:
+
+    [b'|To|', envelope, body, attachment, ...]
+
+Attachments are optional binary frames passed through as they are, the
+envelope says how many follow the body. A batch is several such units
+sent back to back in one multipart message.
+
+The envelope is a small binary header that carries everything ZManager
+needs to route, expire and account a message, so the body frame can be
+passed through without decoding it. A fixed struct is followed by the
+sender UID and the message name separated by a zero byte. Traced
+messages have one more zero byte and the hop stamps of ztrace.
+
+Envelopes of older versions with sender and message names (3 and up)
+are read too, what they lack is 0. Others raise UnsupportedVersion for
+receivers to count and drop.
+"""
+from collections import namedtuple
+import struct
+
+VERSION = 6
+
+# Version, body codec tag, flags, priority, SendTime, MessageExpireTime
+# of the sender, number of attachment frames.
+ENVELOPE = struct.Struct('!BBBBdfH')
+PRIORITY_OFFSET = 3
+ATTACHMENTS = struct.Struct('!H')
+
+# Layouts we can read by version. 3 has no attachments, 4 no priority,
+# 5 no hop stamps.
+LAYOUTS = {
+    3: struct.Struct('!BBBdf'),
+    4: struct.Struct('!BBBdfH'),
+    5: ENVELOPE,
+    6: ENVELOPE,
+}
+
+# Flags
+MIRROR = 0x01 # Copy of a message delivered in the sender's process.
+NOROUTE = 0x02 # Sender wants a NoRoute error reply if nobody subscribes.
+REPLAY = 0x04 # Sent again from the ZManager replay log, never expires.
+REDELIVERED = 0x08 # Work queue message of a member that went away.
+# Bits 0x30 are the zcompress tag of a compressed body.
+TRACED = 0x40 # Hop stamps follow the message name, see ztrace.
+FORWARDED = 0x80 # Came from a peer ZManager, never sent to peers again.
+
+Envelope = namedtuple('Envelope', [
+    'codec', 'flags', 'send_time', 'expire_time', 'sender', 'message',
+    'attachments', 'priority', 'trace'])
+
+
+class UnsupportedVersion(ValueError):
+
+    def __init__(self, version):
+        super(UnsupportedVersion, self).__init__(
+            'Unsupported envelope version {}.'.format(version))
+        self.version = version
+
+
+def pack(send_time, expire_time, codec=0, flags=0, sender='', message='',
+         attachments=0, priority=0, trace=None):
+    data = '{}{}\x00{}'.format(
+        ENVELOPE.pack(VERSION, codec, flags, priority, send_time,
+                      expire_time or 0, attachments),
+        sender, message)
+    if trace is not None:
+        data = '{}\x00{}'.format(data, trace)
+    return data
+
+
+def unpack(data):
+    version = ord(data[0])
+    layout = LAYOUTS.get(version)
+    if layout is None:
+        raise UnsupportedVersion(version)
+    fields = layout.unpack_from(data)
+    if version >= 5:
+        _, codec, flags, priority, send_time, expire_time, attachments = \
+            fields
+    elif version == 4:
+        _, codec, flags, send_time, expire_time, attachments = fields
+        priority = 0
+    else:
+        _, codec, flags, send_time, expire_time = fields
+        priority = attachments = 0
+    names = data[layout.size:].split('\x00', 2)
+    trace = names[2] if flags & TRACED else None
+    return Envelope(codec, flags, send_time, expire_time, names[0],
+                    names[1], attachments, priority, trace)
+
+
+def priority(data):
+    # Priority of a packed envelope, 0 is the lowest.
+    if ord(data[0]) < 5:
+        return 0
+    return ord(data[PRIORITY_OFFSET])
+
+
+def attachment_count(data):
+    # Attachment frames after the body, versions before 4 have none.
+    version = ord(data[0])
+    if version < 4 or version not in LAYOUTS:
+        return 0
+    return ATTACHMENTS.unpack_from(
+        data, LAYOUTS[version].size - ATTACHMENTS.size)[0]
+
+
+def units(frames, data=str):
+    # Splits a multipart message into units, data(frame) gives the bytes
+    # of a frame (zmq.Frame needs lambda frame: frame.bytes).
+    i = 0
+    while i < len(frames):
+        end = i + 3
+        if end <= len(frames):
+            end += attachment_count(data(frames[i + 1]))
+        if end > len(frames):
+            raise ValueError('Truncated unit of {} frames.'.format(
+                len(frames) - i))
+        yield frames[i:end]
+        i = end
+
+
+def add_flags(data, flags):
+    # Returns packed envelope with flags set, the rest is kept as is.
+    return '{}{}{}'.format(data[:2], chr(ord(data[2]) | flags), data[3:])
+
+
+def routing_key(to):
+    return '|{}|'.format(to)
@@ -0,0 +1,181 @@
+"""
+Many actors over one connection.
+
+A ZActor has its own sockets, greenlets and heartbeats, fine for a few
+services but not for an actor per device or session. ZHost is a ZActor
+that hosts any number of LightActors: it subscribes their UIDs and
+topics on its own SUB socket, sends for them on its PUB socket and runs
+their on_* handlers in its handler pool. A LightActor is two slots and
+costs nothing to start.
+
+    class Device(LightActor):
+        __slots__ = () # Keep it compact, no __dict__.
+
+        @check_reply
+        def on_Status(self, msg):
+            return {'Online': True}
+
+    host = ZHost(settings={'UID': 'devices'})
+    for uid in uids:
+        Device(host, uid)
+
+Messages for a LightActor without a handler of their name are handled
+by the host, so Ping, Stats and Retransmit work for every UID.
+"""
+import collections
+import functools
+import logging
+import zmq.green as zmq
+
+from .zactor import ZActor, local_actors, to_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class LightActor(object):
+    __slots__ = ('uid', 'host')
+
+    def __init__(self, host, uid):
+        self.uid = uid
+        self.host = host
+        host.register(self)
+
+    def tell(self, msg):
+        return self.host.tell(msg, sender=self.uid)
+
+    def ask_async(self, msg, attempts=2, timeout=None):
+        return self.host.ask_async(msg, attempts, timeout, sender=self.uid)
+
+    def ask(self, msg, attempts=2, timeout=None):
+        return self.host.ask(msg, attempts, timeout, sender=self.uid)
+
+    def subscribe(self, topic):
+        self.host.subscribe_actor(self, topic)
+
+    def unsubscribe(self, topic):
+        self.host.unsubscribe_actor(self, topic)
+
+    def _produce_stream(self, msg, chunks):
+        # stream_reply handlers, chunks come from the host UID.
+        self.host._produce_stream(msg, chunks)
+
+    def stop(self):
+        self.host.unregister(self)
+
+
+class ZHost(ZActor):
+
+    def __init__(self, *args, **kwargs):
+        self.actors = {} # LightActor by UID.
+        # UIDs of LightActors by topic name or pattern they subscribe.
+        self.members = collections.defaultdict(set)
+        # on_* handlers by message name per LightActor class.
+        self.actor_handlers = {}
+        super(ZHost, self).__init__(*args, **kwargs)
+        self.stats.gauge('hosted_actors', lambda: len(self.actors))
+
+    def register(self, actor):
+        if actor.uid in self.actors or actor.uid == self.uid:
+            raise ValueError('UID {} is taken.'.format(actor.uid))
+        self.actors[actor.uid] = actor
+        local_actors[actor.uid] = self # Local delivery comes to us.
+        # Not subscribe(), it logs every one of thousands.
+        key = b'|{}|'.format(actor.uid)
+        self.subscriptions.add(key)
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, key)
+        if self.control_sub_socket is not None:
+            self.control_sub_socket.setsockopt(zmq.SUBSCRIBE, key)
+        logger.debug('Registered {}.'.format(actor.uid))
+
+    def unregister(self, actor):
+        for topic in [topic for topic, uids in self.members.items()
+                      if actor.uid in uids]:
+            self.unsubscribe_actor(actor, topic)
+        key = b'|{}|'.format(actor.uid)
+        self.subscriptions.discard(key)
+        self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, key)
+        if self.control_sub_socket is not None:
+            self.control_sub_socket.setsockopt(zmq.UNSUBSCRIBE, key)
+        local_actors.pop(actor.uid, None)
+        del self.actors[actor.uid]
+        logger.debug('Unregistered {}.'.format(actor.uid))
+
+    def subscribe_actor(self, actor, topic):
+        # One SUB subscription however many actors share the topic.
+        topic = to_bytes(topic)
+        if not self.members[topic]:
+            self.subscribe(topic)
+        self.members[topic].add(actor.uid)
+
+    def unsubscribe_actor(self, actor, topic):
+        topic = to_bytes(topic)
+        uids = self.members.get(topic)
+        if not uids or actor.uid not in uids:
+            return
+        uids.remove(actor.uid)
+        if not uids:
+            del self.members[topic]
+            self.unsubscribe(topic)
+
+    def _recipients(self, to):
+        # LightActors a message to UID, topic or broadcast goes to.
+        actor = self.actors.get(to)
+        if actor is not None:
+            return [actor]
+        if to == '*':
+            return self.actors.values()
+        uids = set(self.members.get(to, ()))
+        if self.topics:
+            for pattern in self.topics.matches(to):
+                uids.update(self.members.get(pattern, ()))
+        return [self.actors[uid] for uid in uids]
+
+    def _handlers_of(self, cls):
+        # Looked up once per class, not per message.
+        handlers = self.actor_handlers.get(cls)
+        if handlers is None:
+            handlers = self.actor_handlers[cls] = dict(
+                (name[3:], getattr(cls, name))
+                for name in dir(cls) if name.startswith('on_'))
+        return handlers
+
+    def _dispatch(self, msg, control=False):
+        # Replies and stream control are ours, the ask pool is shared.
+        name = msg.get('Message')
+        if msg.get('ReplyToId') or name in ('StreamCredit', 'StreamCancel'):
+            return super(ZHost, self)._dispatch(msg, control)
+        # Retransmitted copies come to the host UID, Retransmit is where
+        # they were sent first. Names of subscriptions are byte strings.
+        to = to_bytes(msg.get('Retransmit') or msg.get('To'))
+        recipients = self._recipients(to)
+        handlers = []
+        for actor in recipients:
+            handler = self._handlers_of(actor.__class__).get(name)
+            if handler is not None:
+                handlers.append(functools.partial(handler, actor))
+        host = to == '*' or not handlers and len(recipients) <= 1
+        if host:
+            # Host handlers take broadcasts and what actors don't handle.
+            super(ZHost, self)._dispatch(msg, control)
+        elif handlers:
+            self.stat_received.inc(name)
+            self.stat_senders.inc(msg.get('From'))
+        shared = host or len(handlers) > 1
+        for index, handler in enumerate(handlers):
+            self._submit(handler, self._member_copy(msg, index == 0)
+                         if shared else msg, control)
+
+    def _member_copy(self, msg, first):
+        # Every member of a topic or broadcast handles its own copy, hops
+        # are stamped per member. A work queue message is acked once, by
+        # the first.
+        msg = dict(msg)
+        if 'Hops' in msg:
+            msg['Hops'] = list(msg['Hops'])
+        if not first:
+            msg.pop('DeliveryTag', None)
+        return msg
+
+    def subscribed(self):
+        return sorted(set(super(ZHost, self).subscribed()) -
+                      set(self.actors))
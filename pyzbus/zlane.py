@@ -0,0 +1,142 @@
+"""
+Lanes and priorities.
+
+Control messages (Ping, KeepAlive, UpdateSettings, ...) can travel on a
+control lane: own sockets between actors and ZManager that receive loops
+read before anything else, so they never wait behind bulk data. Data is
+read in batches of what is ready and handled by priority, see
+PriorityDrain. The clock is read once per batch and expired messages
+are counted and summed up in the log now and then, see Expiry.
+"""
+import collections
+import json
+import time
+
+import gevent
+import zmq.green as zmq
+
+
+class PriorityDrain(object):
+    # Items by priority, drained in rounds that take up to weights[p]
+    # items of priority p, highest first. The last weight is for any
+    # higher priority. High priority goes first but never starves the
+    # rest.
+
+    def __init__(self, weights=None):
+        self.weights = weights or [1]
+        self.buckets = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, priority, item):
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets[priority] = collections.deque()
+        bucket.append(item)
+        self.size += 1
+
+    def weight(self, priority):
+        return self.weights[min(priority, len(self.weights) - 1)]
+
+    def __iter__(self):
+        while self.size:
+            for priority in sorted(self.buckets, reverse=True):
+                bucket = self.buckets[priority]
+                for _ in range(min(self.weight(priority), len(bucket))):
+                    self.size -= 1
+                    yield bucket.popleft()
+                if not bucket:
+                    del self.buckets[priority]
+
+
+def priority(value):
+    # Message Priority as an int 0..255 of the envelope, None is 0.
+    # Raises ValueError for what is not a number.
+    try:
+        value = int(value or 0)
+    except (TypeError, ValueError):
+        raise ValueError('Priority must be a number 0..255, not {!r}.'.format(
+            value))
+    return max(0, min(value, 255))
+
+
+def recv_batch(socket, limit, copy=True):
+    # Up to limit multipart messages ready on socket, without waiting.
+    batch = []
+    while len(batch) < limit:
+        try:
+            batch.append(socket.recv_multipart(zmq.NOBLOCK, copy=copy))
+        except zmq.Again:
+            break
+    return batch
+
+
+def is_control(message, names):
+    # Control messages and their replies.
+    if not message:
+        return False
+    return message in names or (
+        message.endswith('Reply') and message[:-len('Reply')] in names)
+
+
+class Expiry(object):
+    # Expiry check of receive loops. Messages older than their expire
+    # time are expired, up to NEARLY seconds more only nearly. Both are
+    # counted by message name and logged as one summary every interval
+    # seconds, not one by one: under a backlog or clock skew there are
+    # many of them.
+    NEARLY = 1
+
+    def __init__(self, logger, interval=10, nearly_counter=None):
+        self.logger = logger
+        self.interval = interval
+        self.nearly_counter = nearly_counter # zstats.Counter by name.
+        self.expired = collections.Counter()
+        self.nearly = collections.Counter()
+        self.oldest = 0
+        self.reported = 0
+
+    def check(self, age, expire_time, name, now):
+        # age is abs(now - SendTime), clocks of senders may be ahead.
+        if age < expire_time:
+            return False
+        self.oldest = max(self.oldest, age)
+        expired = age > expire_time + self.NEARLY
+        if expired:
+            self.expired[name] += 1
+        else:
+            self.nearly[name] += 1
+            if self.nearly_counter is not None:
+                self.nearly_counter.inc(name)
+        if now - self.reported >= self.interval:
+            self.report(now)
+        return expired
+
+    def run(self):
+        # What was counted since the last report goes to the log when
+        # traffic stops too.
+        while True:
+            gevent.sleep(self.interval)
+            self.flush(time.time())
+
+    def flush(self, now):
+        if (self.expired or self.nearly) and \
+                now - self.reported >= self.interval:
+            self.report(now)
+
+    def report(self, now):
+        if self.expired:
+            self.logger.error(
+                'Discarded {} expired messages, oldest {:.3f} seconds: '
+                '{}.'.format(sum(self.expired.values()), self.oldest,
+                             json.dumps(self.expired, sort_keys=True)))
+        if self.nearly:
+            self.logger.warning('{} nearly expired messages: {}.'.format(
+                sum(self.nearly.values()),
+                json.dumps(self.nearly, sort_keys=True)))
+        self.expired.clear()
+        self.nearly.clear()
+        self.oldest = 0
+        self.reported = now
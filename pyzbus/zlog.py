@@ -0,0 +1,186 @@
+"""
+Replay log.
+
+ZManager appends every routed [key, envelope, body] unit to fixed size
+segment files mapped into memory. A record is a small header followed by
+the raw frames, so replay reads them back in large sequential passes and
+publishes them without encoding. Segments are removed oldest first when
+the log grows over its size or age limit.
+
+Record layout:
+
+    [length, arrival time] [frame length, frame] ...
+
+A zero length marks the end of a segment. The header is written after
+the frames, records cut short by a crash are ignored on recovery.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('!Id') # Length of frames, arrival time.
+FRAME = struct.Struct('!I')
+
+
+class Segment(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.index = int(os.path.basename(path).split('.')[0])
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.removed = False
+        self.position = 0
+        self.count = 0
+        self.first_time = self.last_time = None
+        # Find the end of records written before restart.
+        for record_time, start, end in self.scan():
+            self.position = end
+            self.count += 1
+            if self.first_time is None:
+                self.first_time = record_time
+            self.last_time = record_time
+
+    def scan(self, position=0):
+        # Yields (arrival time, start, end) of frames of every record.
+        # Stops when the segment is removed by retention between two
+        # steps, its map is closed then.
+        while not self.removed and position + RECORD.size <= self.size:
+            length, record_time = RECORD.unpack_from(self.map, position)
+            start = position + RECORD.size
+            if not length or start + length > self.size:
+                return
+            yield record_time, start, start + length
+            position = start + length
+
+    def frame(self, position):
+        # Returns (frame, position of the next frame).
+        length, = FRAME.unpack_from(self.map, position)
+        start = position + FRAME.size
+        return self.map[start:start + length], start + length
+
+    def append(self, frames, now):
+        # Returns False if the record does not fit.
+        length = sum(FRAME.size + len(frame) for frame in frames)
+        start = self.position + RECORD.size
+        if start + length + RECORD.size > self.size:
+            # Keep room for the end marker.
+            return False
+        position = start
+        for frame in frames:
+            FRAME.pack_into(self.map, position, len(frame))
+            position += FRAME.size
+            self.map[position:position + len(frame)] = frame
+            position += len(frame)
+        RECORD.pack_into(self.map, self.position, length, now)
+        self.position = position
+        self.count += 1
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.removed = True
+        self.close()
+        os.remove(self.path)
+
+
+class ReplayLog(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 retention_bytes=1024 ** 3, retention_age=3600):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.segments = [
+            Segment(os.path.join(directory, name), segment_size)
+            for name in sorted(os.listdir(directory))
+            if name.endswith('.log')]
+        if self.segments:
+            logger.info('Recovered {} records in {} log segments.'.format(
+                sum(segment.count for segment in self.segments),
+                len(self.segments)))
+        else:
+            self.roll()
+
+    def __len__(self):
+        return sum(segment.count for segment in self.segments)
+
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def roll(self):
+        index = self.segments[-1].index + 1 if self.segments else 0
+        self.segments.append(Segment(os.path.join(
+            self.directory, '{:012d}.log'.format(index)), self.segment_size))
+        logger.debug('Log segment {} started.'.format(index))
+        self.retain()
+
+    def append(self, frames, now=None):
+        # frames are str or buffers, returns False if too big to log.
+        now = now or time.time()
+        if self.segments[-1].append(frames, now):
+            return True
+        if not self.segments[-1].count:
+            logger.warning('Message of {} bytes is too big to log.'.format(
+                sum(len(frame) for frame in frames)))
+            return False
+        self.roll()
+        return self.segments[-1].append(frames, now)
+
+    def retain(self, now=None):
+        # Remove oldest segments over size or age limits, never the last.
+        now = now or time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_old = self.retention_age and oldest.last_time is not None \
+                and oldest.last_time < now - self.retention_age
+            too_big = self.retention_bytes and \
+                self.size() > self.retention_bytes
+            if not too_old and not too_big:
+                break
+            logger.debug('Removing log segment {} ({} records).'.format(
+                oldest.index, oldest.count))
+            self.segments.pop(0).remove()
+
+    def replay(self, since=None, keys=None):
+        # Yields (arrival time, frames) of records since timestamp, only
+        # for routing keys in keys if given.
+        segments = list(self.segments)
+        if since:
+            # Start from the last segment begun before since.
+            while len(segments) > 1 and segments[1].first_time is not None \
+                    and segments[1].first_time <= since:
+                segments.pop(0)
+        for segment in segments:
+            for record_time, start, end in segment.scan():
+                if since and record_time < since:
+                    continue
+                key, position = segment.frame(start)
+                if keys is not None and key not in keys:
+                    continue
+                frames = [key]
+                while position < end:
+                    frame, position = segment.frame(position)
+                    frames.append(frame)
+                yield record_time, frames
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
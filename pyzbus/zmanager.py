@@ -2,99 +2,957 @@
 
 import gevent
 from gevent.monkey import patch_all; patch_all()
-from gevent import wsgi, spawn, joinall
-from gevent.event import Event
+import multiprocessing
+from gevent import spawn, joinall
+from gevent.lock import Semaphore
 from datetime import datetime
 import json
 import logging
 import os
 import setproctitle
-import sys
+import tempfile
 import time
+import zlib
+import zmq as native_zmq
 import zmq.green as zmq
 
+from . import (zcodec, zcompress, zenvelope, zlane, zlog, zqueue, zstats,
+               ztrace)
+
 
 logger = logging.getLogger(__name__)
 
+# Length of the routing key prefix shards are split by, '|' and two bytes.
+SHARD_PREFIX = 3
+
 
 class ZManager(object):
 
     settings = {
         'PubAddr': 'tcp://127.0.0.1:8881', # Sending messages to agents
         'SubAddr': 'tcp://127.0.0.1:8882', # Collecting agent messages
+        # Additional ipc:// endpoints for actors on the same host.
+        'IpcPubAddr': None,
+        'IpcSubAddr': None,
+        'IpcMode': None, # Permissions of ipc socket files, e.g. 0o770
         'MessageExpireTime': 5, # Discard all messages older then 10 seconds
+        'ExpiryReportInterval': 10, # Seconds between expired summaries.
         'Trace': False,
         'Debug': False,
         'KeepAlive': 170,
+        # ZMTP heartbeats to actors, dead peers are dropped together with
+        # their subscriptions after HeartbeatTimeout seconds without PONG.
+        'HeartbeatInterval': 10,
+        'HeartbeatTimeout': 5,
         'LocalSettingsFile': None,
+        'Codec': 'json', # Codec for messages sent by the manager itself.
+        'UID': 'ZManager', # Messages to this UID are handled by manager.
+        'StatsAddr': None, # host:port for Prometheus metrics over HTTP.
+        # Forwarder processes sharing routing keys by hash of the first two
+        # bytes of the name, 0 to forward in this process. Shards talk to
+        # PubAddr / SubAddr through proxies bound on ShardInAddr /
+        # ShardOutAddr, a shard subscribes to the key prefixes it owns and
+        # only receives their traffic. A batch goes to the shard of its
+        # first key. Stats of all shards are summed up over ShardStatsAddr,
+        # a format string taking the shard index. None for ipc files in the
+        # temp dir named after UID and the manager process.
+        'Shards': 0,
+        'ShardInAddr': None,
+        'ShardOutAddr': None,
+        'ShardStatsAddr': None,
+        # Replay log of routed messages, see zlog. Disabled without LogDir,
+        # shards keep their logs in LogDir/shard-N.
+        'LogDir': None,
+        'LogSegmentSize': 64 * 1024 * 1024, # bytes
+        'LogRetentionBytes': 1024 ** 3,
+        'LogRetentionAge': 3600, # seconds
+        'ReplayBatchSize': 100, # Units per published replay message.
+        # Flow control: socket high-water marks in messages and what to do
+        # when a subscriber is at SndHWM. drop lets libzmq drop it for that
+        # subscriber only, messages to the own key of an actor go with
+        # XPUB_NODROP so drops are counted by peer. block waits for the
+        # subscriber (and holds up everybody), lossy drops uncounted.
+        'SndHWM': 10000,
+        'RcvHWM': 10000,
+        'PubOverflow': 'drop',
+        'SlowConsumerWarning': 10, # Seconds between warnings per key.
+        # Work queues, see zqueue. Actors join them on this ROUTER address,
+        # None to disable. Not available with Shards.
+        'QueueAddr': None,
+        'QueueDispatch': 'least_loaded', # least_loaded or round_robin
+        'QueuePrefetch': 10, # Unacked messages per member.
+        'QueueBacklog': 10000, # Messages per queue waiting for a member.
+        # Unacked messages of a member without heartbeat for so many
+        # seconds go to other members.
+        'QueueMemberTimeout': 6,
+        # Federation: peer managers connect to PeerAddr and subscribe for
+        # keys of their actors, we connect to their PeerAddr in Peers and
+        # subscribe for keys of ours. A message crosses to a peer only if
+        # an actor behind it subscribes. Peers must be a full mesh, what
+        # comes from a peer is never sent to peers again. None to disable,
+        # not available with Shards.
+        'PeerAddr': None,
+        'Peers': [],
+        'PeerHWM': 10000, # Messages to a peer beyond are dropped.
+        # Control lane, see zlane: own sockets for Ping, KeepAlive and such,
+        # read before data. Actors must use the lane too, None to disable.
+        # Not logged, queued or sent to peers, not available with Shards.
+        'ControlPubAddr': None,
+        'ControlSubAddr': None,
+        # Data is read in batches of what is ready, forwarded by envelope
+        # priority with PriorityWeights[priority] messages per round.
+        'ReceiveBatch': 100,
+        'PriorityWeights': [1, 4, 16],
     }
 
     pub_socket = sub_socket = None
     greenlets = []
 
-    def __init__(self, settings={}):
+    def __init__(self, settings={}, context=None, shard=None):
+        # Own copies, class attributes are shared by all instances.
+        self.settings = dict(self.settings)
         self.settings.update(settings)
+        self.greenlets = []
         self.load_settings()
         logger.setLevel(
             logging.DEBUG if self.settings.get('Debug') else logging.INFO)
-        self.context = zmq.Context()
-        # Create publish socket
-        self.pub_socket = self.context.socket(zmq.PUB)
+        # (index, count) when running as a shard process.
+        self.shard = shard
+        self.processes = []
+        if not shard and self.settings.get('Shards') > 1:
+            self.start_shards()
+            return
+        self.codec = zcodec.get_codec(self.settings.get('Codec'))
+        self.key = zenvelope.routing_key(self.settings.get('UID'))
+        self.work = None
+        if self.settings.get('QueueAddr') and not shard:
+            self.work = zqueue.WorkQueues(
+                self.settings.get('QueueDispatch'),
+                self.settings.get('QueuePrefetch'),
+                self.settings.get('QueueBacklog'),
+                self.settings.get('QueueMemberTimeout'))
+        self.log = None
+        if self.settings.get('LogDir'):
+            log_dir = self.settings.get('LogDir')
+            if shard:
+                log_dir = os.path.join(log_dir, 'shard-{}'.format(shard[0]))
+            self.log = zlog.ReplayLog(
+                log_dir, self.settings.get('LogSegmentSize'),
+                self.settings.get('LogRetentionBytes'),
+                self.settings.get('LogRetentionAge'))
+        self._init_stats()
+        # Pass a shared context for inproc:// addresses.
+        self.context = context or zmq.Context()
+        if shard:
+            # Other shards ask for our stats here.
+            self.shard_stats_socket = self.context.socket(zmq.REP)
+            self.shard_stats_socket.bind(
+                self.settings.get('ShardStatsAddr').format(shard[0]))
+        # Create publish socket, XPUB reports subscriptions to us.
+        self.routes = Subscriptions()
+        self.pub_socket = self.context.socket(zmq.XPUB)
         self.pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
-        self.pub_socket.bind(self.settings.get('PubAddr'))
+        self.pub_socket.setsockopt(zmq.SNDHWM, self.settings.get('SndHWM'))
+        # Subscriptions are all XPUB receives, none may be dropped.
+        self.pub_socket.setsockopt(zmq.RCVHWM, 0)
+        if self.settings.get('PubOverflow') == 'drop' and \
+                zmq.zmq_version_info() < (4, 3, 3):
+            # Older XPUB keeps a full pipe matched after EAGAIN and then
+            # fails every send until that subscriber catches up.
+            logger.warning('PubOverflow drop needs libzmq 4.3.3+, using '
+                           'lossy.')
+            self.settings['PubOverflow'] = 'lossy'
+        # XPUB_NODROP fails a send for all subscribers when one is full,
+        # drop sets it per send for keys of one peer, see send().
+        self.pub_nodrop = self.settings.get('PubOverflow') == 'block'
+        self.pub_socket.setsockopt(zmq.XPUB_NODROP, int(self.pub_nodrop))
+        # Last drop time by peer at SndHWM.
+        self.slow_consumers = {}
+        # Green sockets take one waiting greenlet only: forwarding, replays
+        # and our own messages wait for their turn here, see write().
+        self.pub_lock = Semaphore()
+        self.slow_warned = {}
+        set_heartbeat(self.pub_socket, self.settings.get('HeartbeatInterval'),
+                      self.settings.get('HeartbeatTimeout'))
         # Subscribe socket for accepting messages
         self.sub_socket = self.context.socket(zmq.SUB)
         self.sub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
-        self.sub_socket.subscribe(b'')
-        self.sub_socket.bind(self.settings.get('SubAddr'))
+        self.sub_socket.setsockopt(zmq.RCVHWM, self.settings.get('RcvHWM'))
+        set_heartbeat(self.sub_socket, self.settings.get('HeartbeatInterval'),
+                      self.settings.get('HeartbeatTimeout'))
+        if shard:
+            # Every shard gets messages to the manager, shard 0 the JSON
+            # ones. libzmq must keep all prefix subscriptions.
+            self.sub_socket.setsockopt(zmq.SNDHWM, 0)
+            for prefix in shard_prefixes(*shard):
+                self.sub_socket.subscribe(prefix)
+            self.sub_socket.subscribe(self.key)
+            if shard[0] == 0:
+                self.sub_socket.subscribe(b'{')
+        else:
+            self.sub_socket.subscribe(b'')
+        if shard:
+            self.pub_socket.connect(self.settings.get('ShardOutAddr'))
+            self.sub_socket.connect(self.settings.get('ShardInAddr'))
+        else:
+            bind(self.pub_socket, [self.settings.get('PubAddr'),
+                                   self.settings.get('IpcPubAddr')],
+                 self.settings.get('IpcMode'))
+            bind(self.sub_socket, [self.settings.get('SubAddr'),
+                                   self.settings.get('IpcSubAddr')],
+                 self.settings.get('IpcMode'))
+        if self.work is not None:
+            # Members are DEALERs, unknown identities fail the send.
+            self.queue_socket = self.context.socket(zmq.ROUTER)
+            self.queue_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            self.queue_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            set_heartbeat(self.queue_socket,
+                          self.settings.get('HeartbeatInterval'),
+                          self.settings.get('HeartbeatTimeout'))
+            bind(self.queue_socket, [self.settings.get('QueueAddr')])
+        self.batch_clock = ztrace.clock() # When the last batch was read.
+        self.expiry = zlane.Expiry(logger,
+                                   self.settings.get('ExpiryReportInterval'),
+                                   self.stat_nearly_expired)
+        self.control_routes = Subscriptions()
+        self.control_pub_socket = self.control_sub_socket = None
+        if self.settings.get('ControlPubAddr') and not shard:
+            self.connect_control()
+        self.peer_routes = Subscriptions()
+        self.peer_pub_socket = self.peer_sub_socket = None
+        if self.settings.get('PeerAddr') and not shard:
+            self.connect_peers()
         # Init greenlets
-        self.greenlets.append(spawn(self.do_KeepAlive))
+        if not shard or shard[0] == 0:
+            self.greenlets.append(spawn(self.do_KeepAlive))
         self.greenlets.append(spawn(self.sub_receive))
+        self.greenlets.append(spawn(self.xpub_receive))
+        if self.expiry.interval:
+            self.greenlets.append(spawn(self.expiry.run))
+        if self.log is not None:
+            self.greenlets.append(spawn(self.retain_log))
+        if self.work is not None:
+            self.greenlets.append(spawn(self.queue_receive))
+            self.greenlets.append(spawn(self.queue_expire))
+        if self.peer_pub_socket is not None:
+            self.greenlets.append(spawn(self.peer_receive))
+            self.greenlets.append(spawn(self.peer_xpub_receive))
+        if self.control_pub_socket is not None:
+            self.greenlets.append(spawn(self.control_xpub_receive))
+        if shard:
+            self.greenlets.append(spawn(self.serve_shard_stats))
+
+
+    def connect_control(self):
+        heartbeat = (self.settings.get('HeartbeatInterval'),
+                     self.settings.get('HeartbeatTimeout'))
+        self.control_pub_socket = self.context.socket(zmq.XPUB)
+        self.control_pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        self.control_pub_socket.setsockopt(zmq.RCVHWM, 0)
+        set_heartbeat(self.control_pub_socket, *heartbeat)
+        bind(self.control_pub_socket, [self.settings.get('ControlPubAddr')],
+             self.settings.get('IpcMode'))
+        self.control_sub_socket = self.context.socket(zmq.SUB)
+        self.control_sub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        set_heartbeat(self.control_sub_socket, *heartbeat)
+        self.control_sub_socket.subscribe(b'')
+        bind(self.control_sub_socket, [self.settings.get('ControlSubAddr')],
+             self.settings.get('IpcMode'))
+
+
+    def connect_peers(self):
+        heartbeat = (self.settings.get('HeartbeatInterval'),
+                     self.settings.get('HeartbeatTimeout'))
+        # Peers subscribe here for keys of their actors.
+        self.peer_pub_socket = self.context.socket(zmq.XPUB)
+        self.peer_pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        self.peer_pub_socket.setsockopt(zmq.SNDHWM,
+                                        self.settings.get('PeerHWM'))
+        self.peer_pub_socket.setsockopt(zmq.RCVHWM, 0)
+        set_heartbeat(self.peer_pub_socket, *heartbeat)
+        bind(self.peer_pub_socket, [self.settings.get('PeerAddr')])
+        # Subscriptions of our actors are passed on from xpub_receive.
+        self.peer_sub_socket = self.context.socket(zmq.SUB)
+        self.peer_sub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        self.peer_sub_socket.setsockopt(zmq.RCVHWM,
+                                        self.settings.get('PeerHWM'))
+        self.peer_sub_socket.setsockopt(zmq.SNDHWM, 0)
+        set_heartbeat(self.peer_sub_socket, *heartbeat)
+        for addr in self.settings.get('Peers') or []:
+            self.peer_sub_socket.connect(addr)
+            logger.info('Peering with {}.'.format(addr))
+
+
+    def start_shards(self):
+        count = self.settings.get('Shards')
+        logger.info('Starting {} shards.'.format(count))
+        if self.settings.get('QueueAddr'):
+            logger.warning('Work queues are not available with Shards.')
+        if self.settings.get('PeerAddr'):
+            logger.warning('Peers are not available with Shards.')
+        if self.settings.get('ControlPubAddr'):
+            logger.warning('Control lane is not available with Shards.')
+        heartbeat = (self.settings.get('HeartbeatInterval'),
+                     self.settings.get('HeartbeatTimeout'))
+        # Two managers on a host must not share ipc files.
+        base = 'ipc://{}'.format(os.path.join(
+            tempfile.gettempdir(), 'pyzbus-{}-{}'.format(
+                self.settings.get('UID'), os.getpid())))
+        for name, suffix in (('ShardInAddr', 'shard-in'),
+                             ('ShardOutAddr', 'shard-out'),
+                             ('ShardStatsAddr', 'shard-{}-stats')):
+            if not self.settings.get(name):
+                self.settings[name] = '{}-{}'.format(base, suffix)
+        # Actors -> SubAddr -> shards, split by the shard subscriptions.
+        self.processes.append(multiprocessing.Process(
+            target=run_proxy, args=(
+                [self.settings.get('SubAddr'),
+                 self.settings.get('IpcSubAddr')],
+                [self.settings.get('ShardInAddr')],
+                self.settings.get('IpcMode'), heartbeat, True)))
+        # Shards -> PubAddr -> actors
+        self.processes.append(multiprocessing.Process(
+            target=run_proxy, args=(
+                [self.settings.get('ShardOutAddr')],
+                [self.settings.get('PubAddr'),
+                 self.settings.get('IpcPubAddr')],
+                self.settings.get('IpcMode'), heartbeat)))
+        for index in range(count):
+            settings = dict(self.settings)
+            if settings.get('StatsAddr'):
+                # Every shard serves its stats on the next port.
+                host, port = settings['StatsAddr'].rsplit(':', 1)
+                settings['StatsAddr'] = '{}:{}'.format(host, int(port) + index)
+            self.processes.append(multiprocessing.Process(
+                target=run_shard, args=(settings, index, count)))
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+
+    def is_owner(self, key):
+        # Shard owning routing key, all keys are ours without sharding.
+        if not self.shard:
+            return True
+        index, count = self.shard
+        return shard_of(key, count) == index
+
+
+    def _init_stats(self):
+        self.stats = zstats.Stats()
+        self.stat_forwarded = self.stats.counter(
+            'messages_forwarded_total', 'message')
+        self.stat_senders = self.stats.counter(
+            'messages_by_sender_total', 'sender')
+        self.stat_expired = self.stats.counter(
+            'messages_expired_total', 'message')
+        self.stat_nearly_expired = self.stats.counter(
+            'messages_nearly_expired_total', 'message')
+        self.stat_forward_latency = self.stats.histogram(
+            'forward_latency_seconds')
+        self.stat_unroutable = self.stats.counter(
+            'messages_unroutable_total')
+        self.stat_unsupported = self.stats.counter(
+            'envelopes_unsupported_total', 'version')
+        self.stats.gauge('greenlets', lambda: len(self.greenlets))
+        self.stats.gauge('subscriptions', lambda: len(self.routes))
+        self.stats.gauge('peer_subscriptions', lambda: len(self.peer_routes))
+        self.stat_peer_sent = self.stats.counter('peer_messages_sent_total')
+        self.stat_peer_received = self.stats.counter(
+            'peer_messages_received_total')
+        self.stat_control = self.stats.counter(
+            'control_messages_total', 'message')
+        self.stat_control_dropped = self.stats.counter(
+            'control_messages_dropped_total')
+        self.stat_dropped = self.stats.counter('messages_dropped_total',
+                                               'peer')
+        self.stats.gauge('slow_consumers', lambda: sum(
+            1 for last in self.slow_consumers.values()
+            if time.time() - last < 60))
+        if self.work is not None:
+            self.stat_queued = self.stats.counter(
+                'messages_queued_total', 'message')
+            self.stats.gauge('queue_members', lambda: len(self.work.members))
+            self.stats.gauge('queue_pending', self.work.pending)
+            self.stats.gauge('queue_unacked', self.work.unacked)
+            self.stats.gauge('queue_dropped', lambda: self.work.dropped)
+            self.stats.gauge('queue_redelivered',
+                             lambda: self.work.redelivered)
+        if self.log is not None:
+            self.stat_logged = self.stats.counter('messages_logged_total')
+            self.stat_replayed = self.stats.counter('messages_replayed_total')
+            self.stats.gauge('log_bytes', self.log.size)
+        if self.settings.get('StatsAddr'):
+            self.stats_server = self.stats.serve(
+                self.settings.get('StatsAddr'))
 
 
     def run(self):
         logger.info('ZManager has been started.')
+        if self.processes:
+            for process in self.processes:
+                process.join()
         joinall(self.greenlets)
 
 
     def sub_receive(self):
-        # Create a socket to collect incoming agent messages
+        # Collect incoming agent messages, control lane first, then a batch
+        # of data by priority.
         logger.debug('Starting receiver.')
+        poller = zmq.Poller()
+        poller.register(self.sub_socket, zmq.POLLIN)
+        if self.control_sub_socket is not None:
+            poller.register(self.control_sub_socket, zmq.POLLIN)
+        drain = zlane.PriorityDrain(self.settings.get('PriorityWeights'))
         while True:
             try:
-                msg = self.sub_socket.recv_json()
-                if self.settings.get('Trace'):
-                    if msg.get('ReplyToId'):
-                        logger.debug('[REPLIED] {}'.format(
-                            json.dumps(msg, indent=4)))
-                    else:
-                        logger.debug('[RECEIVED] {}'.format(
-                            json.dumps(msg, indent=4)))
-                # Check expiration
-                time_diff = abs(time.time() - msg.get('SendTime', 0))
-                logger.debug('{} from {} time difference: {}'.format(
-                    msg.get('Message'), msg.get('From'), time_diff))
-                exp_time = float(self.settings.get('MessageExpireTime'))
-                threashold = 1
-                if time_diff >= exp_time and time_diff <= exp_time + threashold:
-                    # Give a WARNING on 1 second before discard
-                    logger.warning(
-                        'Nearly expired ({} seconds) message {}.'.format(
-                            time_diff, json.dumps(msg, indent=4)))
-                elif time_diff > exp_time + threashold:
-                    logger.error(
-                        'Discarding expired ({} seconds) message {}.'.format(
-                            time_diff, json.dumps(msg, indent=4)))
-                    # Next message please...
-                    continue
+                poller.poll()
+                control = []
+                if self.control_sub_socket is not None:
+                    control = zlane.recv_batch(
+                        self.control_sub_socket,
+                        self.settings.get('ReceiveBatch'), copy=False)
+                data = zlane.recv_batch(
+                    self.sub_socket, self.settings.get('ReceiveBatch'),
+                    copy=False)
+            except zmq.ZMQError as e:
+                logger.exception(e)
+                gevent.sleep(0.1)
+                continue
+            # Stamped as manager_in on traced messages of the batch.
+            self.batch_clock = ztrace.clock()
+            # A bad message must not hold up the rest of the batch.
+            for frames in control:
+                try:
+                    self.forward_control(frames)
+                except Exception as e:
+                    logger.exception(e)
+            for frames in data:
+                try:
+                    priority = zenvelope.priority(frames[1].bytes) \
+                        if len(frames) > 1 else 0
+                except IndexError:
+                    priority = 0 # Malformed, receive() tells.
+                drain.put(priority, frames)
+            for frames in drain:
+                try:
+                    self.receive(frames)
+                except Exception as e:
+                    logger.exception(e)
+
 
-                self.pub_socket.send_multipart(['|{}|'.format(msg.get('To')),
-                                          json.dumps(msg)])
+    def receive(self, frames):
+        if len(frames) == 1:
+            # Actor without envelope, the whole message is JSON.
+            if not self.shard or self.shard[0] == 0:
+                self.forward_json(frames[0].bytes)
+        else:
+            self.forward(frames)
 
+
+    def forward_control(self, frames):
+        # Control lane, XPUB drops what a busy actor cannot take.
+        for unit in zenvelope.units(frames, lambda frame: frame.bytes):
+            try:
+                self.forward_control_unit(unit)
+            except zenvelope.UnsupportedVersion as e:
+                self.stat_unsupported.inc(e.version)
             except Exception as e:
                 logger.exception(e)
 
 
+    def forward_control_unit(self, unit):
+        key = unit[0].bytes
+        envelope = zenvelope.unpack(unit[1].bytes)
+        self.stat_control.inc(envelope.message)
+        if key == self.key:
+            self.handle(decode(envelope, unit[2].bytes))
+        elif not self.control_routes.match(key):
+            # Not on the control lane, e.g. an actor without one or a
+            # work queue, the data lane may still have a route.
+            if self.check_unit(unit):
+                self.send(key, unit)
+        elif self.is_expired(
+                abs(self.batch_clock[1] - envelope.send_time),
+                envelope.expire_time, envelope.message):
+            self.stat_expired.inc(envelope.message)
+        else:
+            try:
+                self.control_pub_socket.send_multipart(unit, zmq.NOBLOCK)
+            except zmq.Again:
+                self.stat_control_dropped.inc()
+
+
+    def control_xpub_receive(self):
+        logger.debug('Starting control subscription receiver.')
+        while True:
+            try:
+                self.control_routes.update(self.control_pub_socket.recv())
+            except Exception as e:
+                logger.exception(e)
+
+
+    def xpub_receive(self):
+        # Track live subscriptions, first subscribe and last unsubscribe
+        # of every topic come from XPUB.
+        logger.debug('Starting subscription receiver.')
+        while True:
+            try:
+                subscribed, topic = self.routes.update(self.pub_socket.recv())
+                logger.debug('{} {}.'.format(
+                    'Subscribed' if subscribed else 'Unsubscribed', topic))
+                if self.peer_sub_socket is not None:
+                    # Peers send us what our actors want.
+                    self.peer_sub_socket.setsockopt(
+                        zmq.SUBSCRIBE if subscribed else zmq.UNSUBSCRIBE,
+                        topic)
+            except Exception as e:
+                logger.exception(e)
+
+
+    def peer_xpub_receive(self):
+        # Keys actors behind peers subscribe for.
+        logger.debug('Starting peer subscription receiver.')
+        while True:
+            try:
+                subscribed, topic = self.peer_routes.update(
+                    self.peer_pub_socket.recv())
+                logger.debug('Peer {} {}.'.format(
+                    'subscribed' if subscribed else 'unsubscribed', topic))
+            except Exception as e:
+                logger.exception(e)
+
+
+    def peer_receive(self):
+        # Messages from peers for our actors.
+        logger.debug('Starting peer receiver.')
+        while True:
+            try:
+                frames = self.peer_sub_socket.recv_multipart(copy=False)
+                self.batch_clock = ztrace.clock()
+                self.stat_peer_received.inc()
+                self.forward(frames)
+            except Exception as e:
+                logger.exception(e)
+
+
+    def send_peers(self, unit):
+        # One copy to the peers with subscribers of the key, flagged so it
+        # never comes back or goes further. XPUB drops beyond PeerHWM.
+        self.peer_pub_socket.send_multipart([
+            unit[0],
+            zenvelope.add_flags(unit[1].bytes, zenvelope.FORWARDED)
+        ] + list(unit[2:]))
+        self.stat_peer_sent.inc()
+
+
+    def has_route(self, key):
+        return self.routes.match(key) or (
+            self.peer_pub_socket is not None and self.peer_routes.match(key))
+
+
+    def forward(self, frames):
+        # Route and expire by the envelope only, the body and attachments
+        # are not decoded.
+        try:
+            units = list(zenvelope.units(frames, lambda frame: frame.bytes))
+        except ValueError as e:
+            logger.error('Discarding malformed message of {} frames: {}'.format(
+                len(frames), e))
+            return
+        if len(units) == 1:
+            if self.accept(units[0]):
+                self.send(frames[0].bytes, units[0])
+            return
+        # A batch of units, units for the same destination are published
+        # together.
+        batches = {}
+        for unit in units:
+            if self.accept(unit):
+                batch = batches.setdefault(unit[0].bytes, [0, []])
+                batch[0] += 1
+                batch[1].extend(unit)
+        for key, (count, batch) in batches.items():
+            self.send(key, batch, count)
+
+
+    def send(self, key, frames, count=1):
+        # Publish count units with PubOverflow policy, returns False if
+        # dropped for a peer at SndHWM.
+        # Received zmq.Frame objects are passed on without a copy.
+        policy = self.settings.get('PubOverflow')
+        if policy == 'block':
+            self.write(frames)
+            return True
+        # NODROP only when the key has one subscriber, the others must not
+        # lose what a slow one cannot take. Without it libzmq drops for
+        # the full pipe only and never fails the send.
+        peer = self.peer_of(key) if policy == 'drop' else None
+        self.set_nodrop(peer is not None)
+        try:
+            self.pub_socket.send_multipart(frames, zmq.NOBLOCK)
+            return True
+        except zmq.Again:
+            self.slow_consumer(peer, count)
+            return False
+
+
+    def write(self, frames):
+        # Publish, waiting for the socket if need be.
+        with self.pub_lock:
+            if self.settings.get('PubOverflow') != 'drop':
+                # block waits here, lossy never does.
+                self.pub_socket.send_multipart(frames)
+                return
+            # Replay waits for a slow asker, sends meanwhile may switch
+            # NODROP off.
+            while True:
+                self.set_nodrop(True)
+                try:
+                    self.pub_socket.send_multipart(frames, zmq.NOBLOCK)
+                    return
+                except zmq.Again:
+                    gevent.sleep(0.01)
+
+
+    def set_nodrop(self, nodrop):
+        # libzmq reads XPUB_NODROP on every send.
+        if nodrop != self.pub_nodrop:
+            self.pub_socket.setsockopt(zmq.XPUB_NODROP, int(nodrop))
+            self.pub_nodrop = nodrop
+
+
+    def peer_of(self, key):
+        # UID of the only subscriber of key by the subscription data, None
+        # if there may be more: key must be the exact '|uid|' of an actor
+        # we got messages from, not a group name, and no prefix matches.
+        # Behind the shard proxy there is one subscriber, the proxy.
+        if self.shard or key not in self.routes.exact or \
+                self.routes.match_prefix(key):
+            return None
+        uid = key[1:-1]
+        if uid not in self.stat_senders.values:
+            return None
+        return uid
+
+
+    def slow_consumer(self, peer, count):
+        # peer is at SndHWM, count and warn now and then.
+        now = self.batch_clock[1]
+        self.stat_dropped.inc(peer, count)
+        self.slow_consumers[peer] = now
+        if now - self.slow_warned.get(peer, 0) > \
+                self.settings.get('SlowConsumerWarning'):
+            self.slow_warned[peer] = now
+            logger.warning('Slow consumer {}, {} messages dropped.'.format(
+                peer, self.stat_dropped.values[peer]))
+
+
+    def accept(self, unit):
+        # check_unit, a unit of an envelope version we cannot read is
+        # counted and dropped, not the rest of its batch.
+        try:
+            return self.check_unit(unit)
+        except zenvelope.UnsupportedVersion as e:
+            self.stat_unsupported.inc(e.version)
+            return False
+
+
+    def check_unit(self, unit):
+        # Returns True if unit should be published.
+        # Shards only receive keys they own, and batches of the first one.
+        key = unit[0].bytes
+        if key == self.key and not self.is_owner(key):
+            if self.log is not None:
+                # Every shard serves Replay from its own log.
+                envelope = zenvelope.unpack(unit[1].bytes)
+                if envelope.message == 'Replay':
+                    spawn(self.replay, decode(envelope, unit[2].bytes), False)
+            return False
+        if self.log is not None and key != self.key:
+            # Logged before the route check, missed messages of actors
+            # away right now are what replay is for.
+            self.log.append([frame.bytes for frame in unit])
+            self.stat_logged.inc()
+        queued = self.work is not None and key in self.work
+        if key != self.key and not queued and not self.has_route(key):
+            # Nobody listens, drop before any other work.
+            self.stat_unroutable.inc()
+            envelope = zenvelope.unpack(unit[1].bytes)
+            if envelope.flags & zenvelope.NOROUTE and \
+                    not envelope.flags & zenvelope.FORWARDED:
+                # The asker is behind us, not behind a peer.
+                self.no_route(decode(envelope, unit[2].bytes))
+            return False
+        envelope = zenvelope.unpack(unit[1].bytes)
+        if self.settings.get('Trace'):
+            logger.debug('[FORWARD] {} {} from {} ({} bytes)'.format(
+                key, envelope.message, envelope.sender, len(unit[2])))
+        self.stat_senders.inc(envelope.sender)
+        time_diff = self.batch_clock[1] - envelope.send_time
+        if self.is_expired(abs(time_diff), envelope.expire_time,
+                           envelope.message):
+            # Next message please...
+            self.stat_expired.inc(envelope.message)
+            return False
+        if envelope.flags & zenvelope.TRACED:
+            unit[1] = zmq.Frame(unit[1].bytes + ztrace.pack(
+                ztrace.MANAGER_IN, self.batch_clock) + ztrace.pack(
+                ztrace.MANAGER_OUT))
+        if key == self.key:
+            # Addressed to the manager itself.
+            self.handle(decode(envelope, unit[2].bytes))
+            return False
+        if queued:
+            # One member gets it, not the subscribers.
+            self.stat_queued.inc(envelope.message)
+            self.deliver(self.work.dispatch(key, unit))
+            return False
+        self.stat_forwarded.inc(envelope.message)
+        self.stat_forward_latency.observe(max(time_diff, 0))
+        if self.peer_pub_socket is None:
+            return True
+        if not envelope.flags & zenvelope.FORWARDED and \
+                self.peer_routes.match(key):
+            self.send_peers(unit)
+        return self.routes.match(key)
+
+
+    def queue_receive(self):
+        # Heartbeats, acks and leaves of work queue members.
+        logger.debug('Starting work queue receiver.')
+        while True:
+            try:
+                frames = self.queue_socket.recv_multipart()
+                identity, command, args = frames[0], frames[1], frames[2:]
+                now = time.time()
+                if command == 'ACK':
+                    self.deliver(self.work.ack(identity, args[0],
+                                               int(args[1]), now))
+                elif command == 'HEARTBEAT':
+                    self.deliver(self.work.heartbeat(
+                        identity, int(args[0]),
+                        [zenvelope.routing_key(name) for name in args[1:]],
+                        now))
+                elif command == 'LEAVE':
+                    logger.info('{} left {}.'.format(identity, args))
+                    self.deliver(self.work.leave(identity, [
+                        zenvelope.routing_key(name) for name in args]))
+                else:
+                    logger.error('Unknown work queue command {} from '
+                                 '{}.'.format(command, identity))
+            except Exception as e:
+                logger.exception(e)
+
+
+    def queue_expire(self):
+        while True:
+            gevent.sleep(1)
+            self.deliver(self.work.expire(time.time()))
+
+
+    def deliver(self, deliveries):
+        # Send work to queue members, a member we cannot reach is gone
+        # and its work goes to the others.
+        while deliveries:
+            identity, tag, frames, redelivered = deliveries.pop(0)
+            if redelivered:
+                frames = [frames[0], zenvelope.add_flags(
+                    frames[1].bytes, zenvelope.REDELIVERED)] + frames[2:]
+            try:
+                self.queue_socket.send_multipart(
+                    [identity, 'WORK', tag] + list(frames), zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                logger.warning('Work queue member {} is gone: {}'.format(
+                    identity, e))
+                deliveries.extend(self.work.leave(identity))
+
+
+    def forward_json(self, data):
+        msg = json.loads(data)
+        if self.settings.get('Trace'):
+            if msg.get('ReplyToId'):
+                logger.debug('[REPLIED] {}'.format(
+                    json.dumps(msg, indent=4)))
+            else:
+                logger.debug('[RECEIVED] {}'.format(
+                    json.dumps(msg, indent=4)))
+        # Check expiration
+        time_diff = abs(self.batch_clock[1] - msg.get('SendTime', 0))
+        self.stat_senders.inc(msg.get('From'))
+        if self.is_expired(time_diff, None, msg.get('Message')):
+            # Next message please...
+            self.stat_expired.inc(msg.get('Message'))
+            return
+        key = zenvelope.routing_key(msg.get('To'))
+        if key == self.key:
+            self.handle(msg)
+            return
+        if not self.has_route(key):
+            self.stat_unroutable.inc()
+            if msg.get('ReplyTo'):
+                self.no_route(msg)
+            return
+        self.stat_forwarded.inc(msg.get('Message'))
+        self.send(key, [key, json.dumps(msg)])
+
+
+    def is_expired(self, time_diff, expire_time, message):
+        # Sender's expire time from the envelope wins over our own. Time
+        # is of the batch, expired messages are logged as a summary.
+        return self.expiry.check(
+            time_diff,
+            float(expire_time or self.settings.get('MessageExpireTime')),
+            message, self.batch_clock[1])
+
+
+    def handle(self, msg):
+        logger.debug('{} received from {}.'.format(
+            msg.get('Message'), msg.get('From')))
+        if msg.get('Message') == 'Stats':
+            if self.shard:
+                spawn(self.reply_shard_stats, msg)
+            else:
+                self.reply(msg, self.stats.as_dict())
+        elif msg.get('Message') == 'Presence':
+            # UIDs with a live subscription.
+            self.reply(msg, {'UIDs': self.routes.uids(),
+                             'PeerUIDs': self.peer_routes.uids()})
+        elif msg.get('Message') == 'Replay':
+            if self.log is not None:
+                spawn(self.replay, msg)
+            else:
+                self.reply(msg, {'Error': 'NoLog'})
+
+
+    def serve_shard_stats(self):
+        logger.debug('Serving shard stats.')
+        while True:
+            try:
+                self.shard_stats_socket.recv()
+                self.shard_stats_socket.send(json.dumps(self.stats.as_dict()))
+            except Exception as e:
+                logger.exception(e)
+
+
+    def reply_shard_stats(self, msg):
+        # Stats of all shards summed up, a shard that does not answer in a
+        # second is left out.
+        index, count = self.shard
+        stats = [self.stats.as_dict()]
+        for other in range(count):
+            if other == index:
+                continue
+            socket = self.context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.settings.get('ShardStatsAddr').format(other))
+            try:
+                socket.send(b'STATS')
+                if socket.poll(1000):
+                    stats.append(json.loads(socket.recv()))
+                else:
+                    logger.warning('No stats from shard {}.'.format(other))
+            finally:
+                socket.close()
+        res = zstats.merge(stats)
+        res['Shards'] = len(stats)
+        self.reply(msg, res)
+
+
+    def replay(self, msg, reply=True):
+        # Publish logged units again on the asker's key, in batches.
+        to = zenvelope.routing_key(msg.get('From'))
+        keys = set([to, zenvelope.routing_key('*')] + [
+            zenvelope.routing_key(key) for key in msg.get('Keys') or []])
+        sender = msg.get('SinceSender')
+        sequence = msg.get('SinceSequence') or 0
+        batch_size = self.settings.get('ReplayBatchSize')
+        count = 0
+        batch = []
+        batch_units = 0
+        for record_time, frames in self.log.replay(msg.get('Since'), keys):
+            envelope = frames[1]
+            if sender:
+                try:
+                    header = zenvelope.unpack(envelope)
+                except zenvelope.UnsupportedVersion:
+                    continue
+                if header.sender != sender:
+                    continue
+                if sequence and decode(header, frames[2]).get(
+                        'Sequence', 0) < sequence:
+                    continue
+            # Attachments follow the body as they are.
+            batch.extend([to, zenvelope.add_flags(envelope, zenvelope.REPLAY)])
+            batch.extend(frames[2:])
+            batch_units += 1
+            count += 1
+            if batch_units >= batch_size:
+                # Waits for a slow asker, in this greenlet only.
+                self.write(batch)
+                batch = []
+                batch_units = 0
+                gevent.sleep(0) # Let forwarding go on.
+        if batch:
+            self.write(batch)
+        self.stat_replayed.inc(value=count)
+        logger.info('Replayed {} messages to {}.'.format(count, to))
+        if reply:
+            self.reply(msg, {'Count': count})
+
+
+    def retain_log(self):
+        # Age limit must apply without traffic too.
+        while True:
+            gevent.sleep(60)
+            self.log.retain()
+
+
+    def no_route(self, msg):
+        # Fail the ask now instead of letting the asker wait for timeout.
+        logger.debug('No route for {} from {} to {}.'.format(
+            msg.get('Message'), msg.get('From'), msg.get('To')))
+        self.reply(msg, {'Error': 'NoRoute'})
+
+
+    def reply(self, msg, res):
+        for to in msg.get('ReplyTo') or []:
+            reply = dict(res)
+            reply.update({
+                'To': to,
+                'Message': '{}Reply'.format(msg.get('Message')),
+                'ReplyToId': msg['Id'],
+            })
+            self.publish(reply)
+
+
+    def publish(self, msg, control=False):
+        # Publish a message from the manager itself, on the control lane
+        # if asked and there is one.
+        now = time.time()
+        msg.update({
+            'From': self.settings.get('UID'),
+            'SendTime': now,
+            'SendTimeHuman': datetime.strftime(datetime.fromtimestamp(now),
+                                               '%Y-%m-%d %H:%M:%S')
+        })
+        key = zenvelope.routing_key(msg.get('To'))
+        frames = [
+            key,
+            zenvelope.pack(now, self.settings.get('MessageExpireTime'),
+                           codec=self.codec.tag,
+                           sender=self.settings.get('UID'),
+                           message=msg.get('Message')),
+            self.codec.encode(msg)]
+        if control and self.control_pub_socket is not None:
+            try:
+                self.control_pub_socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                self.stat_control_dropped.inc()
+        else:
+            self.send(key, frames)
+
+
     def do_KeepAlive(self):
         # Periodic keep alive message to all connected actors
         if not self.settings.get('KeepAlive'):
@@ -104,13 +962,10 @@ class ZManager(object):
             self.settings.get('KeepAlive')))
         while True:
             logger.debug('Publishing KeepAlive.')
-            msg = {
+            self.publish({
                 'Message': 'KeepAlive',
-                'SendTime': time.time(),
-                'SendTimeHuman': datetime.strftime(datetime.now(),
-                                                   '%Y-%m-%d %H:%M:%S')
-            }
-            self.pub_socket.send_multipart(['|*|', json.dumps(msg)])
+                'To': '*',
+            }, control=True)
             gevent.sleep(self.settings.get('KeepAlive'))
 
 
@@ -125,3 +980,116 @@ class ZManager(object):
             logger.debug('Loaded settings.local.')
         except Exception as e:
             logger.warning('Cannot load settings.local: {}'.format(e))
+
+
+class Subscriptions(object):
+    # Live subscriptions of an XPUB socket, it reports the first subscribe
+    # and the last unsubscribe of every topic.
+
+    def __init__(self):
+        # Exact '|uid|' topics are looked up directly, anything else (like
+        # b'' for everything) is matched as a prefix.
+        self.exact = set()
+        self.prefixes = set()
+        # Distinct prefix lengths, topic patterns share a few prefixes.
+        self.prefix_lengths = []
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes)
+
+    def update(self, event):
+        # Applies an XPUB event, returns (subscribed, topic).
+        subscribed, topic = event[0] == '\x01', event[1:]
+        if topic.startswith('|') and topic.endswith('|') and len(topic) > 1:
+            topics = self.exact
+        else:
+            topics = self.prefixes
+        if subscribed:
+            topics.add(topic)
+        else:
+            topics.discard(topic)
+        self.prefix_lengths = sorted(set(
+            len(prefix) for prefix in self.prefixes))
+        return subscribed, topic
+
+    def match(self, key):
+        return key in self.exact or self.match_prefix(key)
+
+    def match_prefix(self, key):
+        for length in self.prefix_lengths:
+            if key[:length] in self.prefixes:
+                return True
+        return False
+
+    def uids(self):
+        return sorted(topic[1:-1] for topic in self.exact)
+
+
+def decode(envelope, data):
+    # Body of a unit for the manager itself, only those are decoded.
+    return zcodec.get_codec_by_tag(envelope.codec).decode(
+        zcompress.decompress(envelope.flags, data))
+
+
+def bind(socket, addrs, mode=None):
+    # Bind to every given address, ipc socket files get mode if set.
+    for addr in addrs:
+        if not addr:
+            continue
+        socket.bind(addr)
+        if mode is not None and addr.startswith('ipc://'):
+            if not isinstance(mode, int):
+                mode = int(mode, 8) # '0770' from settings file.
+            os.chmod(addr[len('ipc://'):], mode)
+
+
+def set_heartbeat(socket, interval, timeout):
+    # ZMTP PING / PONG in libzmq I/O threads, needs libzmq 4.2+.
+    if not interval or not hasattr(native_zmq, 'HEARTBEAT_IVL'):
+        return
+    socket.setsockopt(native_zmq.HEARTBEAT_IVL, int(interval * 1000))
+    socket.setsockopt(native_zmq.HEARTBEAT_TIMEOUT, int(timeout * 1000))
+    socket.setsockopt(native_zmq.HEARTBEAT_TTL,
+                      int((interval + timeout) * 1000))
+
+
+def shard_of(key, count):
+    # Index of the shard owning routing key '|name|', by the first two bytes
+    # of the name so that a shard can subscribe to all of its keys.
+    return (zlib.crc32(key[:SHARD_PREFIX]) & 0xffffffff) % count
+
+
+def shard_prefixes(index, count):
+    # Routing key prefixes of shard index, all of them are owned by one.
+    for first in range(256):
+        for second in range(256):
+            prefix = b'|' + chr(first) + chr(second)
+            if shard_of(prefix, count) == index:
+                yield prefix
+
+
+def run_proxy(in_addrs, out_addrs, ipc_mode=None, heartbeat=(None, None),
+              split=False):
+    # Native libzmq forwarder between XSUB and XPUB, runs in own process.
+    # With split, a PUB filters by the subscriptions of the shards, which
+    # are not passed on to the actors, and XSUB takes everything.
+    setproctitle.setproctitle('zmanager proxy {} -> {}'.format(
+        in_addrs[0], out_addrs[0]))
+    context = native_zmq.Context()
+    xsub = context.socket(native_zmq.XSUB)
+    set_heartbeat(xsub, *heartbeat)
+    bind(xsub, in_addrs, ipc_mode)
+    if split:
+        xsub.send(b'\x01')
+        xpub = context.socket(native_zmq.PUB)
+        xpub.setsockopt(native_zmq.RCVHWM, 0)
+    else:
+        xpub = context.socket(native_zmq.XPUB)
+    set_heartbeat(xpub, *heartbeat)
+    bind(xpub, out_addrs, ipc_mode)
+    native_zmq.proxy(xsub, xpub)
+
+
+def run_shard(settings, index, count):
+    setproctitle.setproctitle('zmanager shard {}/{}'.format(index + 1, count))
+    ZManager(settings, shard=(index, count)).run()
@@ -0,0 +1,170 @@
+"""
+Work queues.
+
+Actors join a queue over a DEALER socket to ZManager's ROUTER on
+QueueAddr. A message to the queue name goes to one member only, picked
+round robin or the least loaded one, instead of being published to all
+subscribers. Members ack every message when its handler is done and
+report their load with acks and heartbeats. A member that stops sending
+heartbeats or leaves has its unacked messages given to other members.
+
+Frames, member to manager:
+
+    [b'HEARTBEAT', load, queue, ...] join queues and stay alive
+    [b'LEAVE', queue, ...]
+    [b'ACK', tag, load]
+
+manager to member:
+
+    [b'WORK', tag, key, envelope, body, attachment, ...]
+
+WorkQueues keeps the state and decides, ZManager does the I/O.
+"""
+import collections
+import itertools
+
+
+class Member(object):
+    __slots__ = ('identity', 'queues', 'unacked', 'reported', 'seen')
+
+    def __init__(self, identity, now):
+        self.identity = identity
+        self.queues = set()
+        self.unacked = {} # tag: (key, frames)
+        self.reported = 0 # Load the member told us.
+        self.seen = now
+
+    def load(self):
+        # Handlers busy or waiting there, what we sent counts until acked.
+        return max(len(self.unacked), self.reported)
+
+
+class WorkQueue(object):
+    __slots__ = ('key', 'members', 'backlog', 'turn')
+
+    def __init__(self, key):
+        self.key = key
+        self.members = []
+        self.backlog = collections.deque() # (frames, redelivered)
+        self.turn = 0 # Round robin position.
+
+
+class WorkQueues(object):
+    # Methods return deliveries, (identity, tag, frames, redelivered)
+    # for the caller to send.
+
+    def __init__(self, policy='least_loaded', prefetch=10, backlog=10000,
+                 timeout=6):
+        self.policy = policy # least_loaded or round_robin
+        self.prefetch = prefetch # Unacked messages per member.
+        self.backlog_size = backlog # Messages waiting for a member.
+        self.timeout = timeout # Seconds without heartbeat to be dead.
+        self.queues = {} # WorkQueue by routing key.
+        self.members = {} # Member by identity.
+        self.tags = itertools.count(1)
+        self.dropped = 0
+        self.redelivered = 0
+
+    def __contains__(self, key):
+        return key in self.queues
+
+    def heartbeat(self, identity, load, keys, now):
+        member = self.members.get(identity)
+        if member is None:
+            member = self.members[identity] = Member(identity, now)
+        member.seen = now
+        member.reported = load
+        deliveries = []
+        for key in keys:
+            if key in member.queues:
+                continue
+            member.queues.add(key)
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = WorkQueue(key)
+            queue.members.append(member)
+            deliveries.extend(self._drain(queue))
+        return deliveries
+
+    def leave(self, identity, keys=None):
+        # Leave queues, all of them if keys is None. Unacked messages of
+        # the queues left are given to other members.
+        member = self.members.get(identity)
+        if member is None:
+            return []
+        keys = set(member.queues if keys is None else keys) & member.queues
+        member.queues -= keys
+        for key in keys:
+            queue = self.queues[key]
+            queue.members.remove(member)
+        deliveries = []
+        for tag, (key, frames) in list(member.unacked.items()):
+            if key in keys:
+                del member.unacked[tag]
+                self.redelivered += 1
+                self.queues[key].backlog.appendleft((frames, True))
+        if not member.queues:
+            del self.members[identity]
+        for key in keys:
+            queue = self.queues[key]
+            deliveries.extend(self._drain(queue))
+            if not queue.members and not queue.backlog:
+                del self.queues[key]
+        return deliveries
+
+    def ack(self, identity, tag, load, now):
+        member = self.members.get(identity)
+        if member is None:
+            return []
+        member.seen = now
+        member.reported = load
+        work = member.unacked.pop(tag, None)
+        if work is None:
+            return []
+        return self._drain(self.queues[work[0]])
+
+    def dispatch(self, key, frames):
+        queue = self.queues[key]
+        if len(queue.backlog) >= self.backlog_size:
+            # Nobody takes them, the oldest goes.
+            queue.backlog.popleft()
+            self.dropped += 1
+        queue.backlog.append((frames, False))
+        return self._drain(queue)
+
+    def expire(self, now):
+        # Members without heartbeat for timeout are gone.
+        deliveries = []
+        for member in list(self.members.values()):
+            if now - member.seen > self.timeout:
+                deliveries.extend(self.leave(member.identity))
+        return deliveries
+
+    def pending(self):
+        return sum(len(queue.backlog) for queue in self.queues.values())
+
+    def unacked(self):
+        return sum(len(member.unacked) for member in self.members.values())
+
+    def _drain(self, queue):
+        deliveries = []
+        while queue.backlog:
+            member = self._pick(queue)
+            if member is None:
+                break
+            frames, redelivered = queue.backlog.popleft()
+            tag = str(next(self.tags))
+            member.unacked[tag] = (queue.key, frames)
+            deliveries.append((member.identity, tag, frames, redelivered))
+        return deliveries
+
+    def _pick(self, queue):
+        # Member to take the next message, None if all have prefetch.
+        members = [member for member in queue.members
+                   if len(member.unacked) < self.prefetch]
+        if not members:
+            return None
+        if self.policy == 'round_robin':
+            queue.turn += 1
+            return members[queue.turn % len(members)]
+        return min(members, key=Member.load)
@@ -0,0 +1,129 @@
+"""
+Sequence windows.
+
+Senders number messages per destination (DestSequence) and keep recent
+ones in SendBuffer. Receivers keep a SequenceWindow per sender and
+destination: the next expected number and the out of order numbers seen
+above it. A number below the window or already seen is a duplicate, a
+jump over missing numbers is a gap that can be asked for again.
+
+Numbers start over when a sender restarts. Messages carry the
+SequenceEpoch of the sender's run, a new one starts a new window.
+
+Replayed messages go through the windows too. Those without numbers are
+told from ones received before by their Id, see RecentIds.
+"""
+from collections import OrderedDict, deque
+import numbers
+
+
+def is_sequence(value):
+    # Numbers come from the wire, anything else is not ours to compare.
+    return isinstance(value, numbers.Integral) and \
+        not isinstance(value, bool) and value >= 0
+
+
+class SequenceWindow(object):
+    __slots__ = ('next', 'high', 'seen', 'size', 'epoch')
+
+    def __init__(self, seq, size=1024, epoch=None):
+        self.next = seq + 1 # Everything below was received.
+        self.high = seq # Highest number received.
+        self.seen = set() # Received numbers above next.
+        self.size = size
+        self.epoch = epoch # SequenceEpoch of the sender.
+
+    def receive(self, seq):
+        # Returns (new, gap), gap is (first, last) of numbers found
+        # missing by this one or None.
+        if seq < self.next or seq in self.seen:
+            return False, None
+        if seq == self.next:
+            self.next += 1
+            self._advance()
+            self.high = max(self.high, seq)
+            return True, None
+        gap = None
+        if seq > self.high + 1:
+            gap = (self.high + 1, seq - 1)
+        self.high = max(self.high, seq)
+        self.seen.add(seq)
+        return True, gap
+
+    def skip(self, first, last):
+        # Stop waiting for numbers in range, returns how many were missing.
+        if last < self.next:
+            return 0
+        if first <= self.next:
+            # Window moves past last at once, big gaps are cheap.
+            above = set(seq for seq in self.seen if seq > last)
+            lost = last + 1 - self.next - (len(self.seen) - len(above))
+            self.seen = above
+            self.next = last + 1
+            self._advance()
+            return lost
+        lost = 0
+        for seq in range(first, last + 1):
+            if seq not in self.seen:
+                self.seen.add(seq)
+                lost += 1
+        return lost
+
+    def overflow(self):
+        # Too many numbers out of order, give up waiting for the oldest
+        # gap. Returns how many numbers were given up.
+        if len(self.seen) <= self.size:
+            return 0
+        return self.skip(self.next, min(self.seen) - 1)
+
+    def _advance(self):
+        while self.next in self.seen:
+            self.seen.remove(self.next)
+            self.next += 1
+
+
+class SendBuffer(object):
+    # Per sender and destination numbering and the last size sent
+    # messages. Senders are many for a zhost.
+
+    def __init__(self, size, epoch=None):
+        self.size = size
+        self.epoch = epoch # Tells our run from earlier ones.
+        self.sequences = {}
+        self.messages = OrderedDict() # (From, To, DestSequence): msg
+
+    def stamp(self, msg):
+        stream = (msg.get('From'), msg.get('To'))
+        seq = self.sequences.get(stream, 0) + 1
+        self.sequences[stream] = seq
+        msg['DestSequence'] = seq
+        msg['SequenceEpoch'] = self.epoch
+        # A copy, callers may reuse msg for the next one.
+        self.messages[stream + (seq,)] = dict(msg)
+        if len(self.messages) > self.size:
+            self.messages.popitem(last=False)
+
+    def get(self, sender, to, seq):
+        return self.messages.get((sender, to, seq))
+
+
+class RecentIds(object):
+    # Ids of the last size messages received.
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, msg_id):
+        # Returns False if msg_id is there already.
+        if msg_id in self.ids:
+            return False
+        self.ids.add(msg_id)
+        self.order.append(msg_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
@@ -0,0 +1,190 @@
+"""
+Hot path metrics.
+
+Counters and histograms are plain Python objects with preallocated
+buckets, cheap enough to stay enabled under load. Stats renders them in
+Prometheus text format for the HTTP endpoint and as a dict for Stats
+bus replies.
+"""
+from bisect import bisect_left
+from gevent import pywsgi
+import logging
+import os
+import resource
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def process_cpu_seconds():
+    return sum(os.times()[:2])
+
+
+def process_resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # No procfs, peak RSS is better than nothing.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+class Counter(object):
+    __slots__ = ('name', 'label', 'values')
+
+    def __init__(self, name, label=None):
+        self.name = name
+        self.label = label # Optional label name, values are by label value.
+        self.values = {}
+
+    def inc(self, label_value=None, value=1):
+        self.values[label_value] = self.values.get(label_value, 0) + value
+
+    def render(self, prefix):
+        name = '{}_{}'.format(prefix, self.name)
+        lines = ['# TYPE {} counter'.format(name)]
+        for label_value, value in sorted(self.values.items()):
+            if self.label:
+                lines.append('{}{{{}="{}"}} {}'.format(
+                    name, self.label, _escape(label_value), value))
+            else:
+                lines.append('{} {}'.format(name, value))
+        return lines
+
+    def as_dict(self):
+        if not self.label:
+            return self.values.get(None, 0)
+        return dict((str(k), v) for k, v in self.values.items())
+
+
+class Histogram(object):
+    __slots__ = ('name', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, prefix):
+        name = '{}_{}'.format(prefix, self.name)
+        lines = ['# TYPE {} histogram'.format(name)]
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+    def as_dict(self):
+        return {
+            'Buckets': list(self.buckets),
+            'Counts': list(self.counts),
+            'Sum': self.sum,
+            'Count': self.count,
+        }
+
+
+class Gauge(object):
+    __slots__ = ('name', 'func')
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func # Evaluated only when stats are collected.
+
+    def render(self, prefix):
+        name = '{}_{}'.format(prefix, self.name)
+        return ['# TYPE {} gauge'.format(name),
+                '{} {}'.format(name, self.func())]
+
+    def as_dict(self):
+        return self.func()
+
+
+def merge(stats):
+    # Sums up Stats.as_dict() results, e.g. of ZManager shards.
+    res = {}
+    for values in stats:
+        for name, value in values.items():
+            res[name] = _merge(res[name], value) if name in res else value
+    return res
+
+
+def _merge(a, b):
+    if not isinstance(b, dict):
+        return a + b
+    if 'Buckets' in b:
+        # Histogram, buckets are the same.
+        return dict(a, Sum=a['Sum'] + b['Sum'], Count=a['Count'] + b['Count'],
+                    Counts=[x + y for x, y in zip(a['Counts'], b['Counts'])])
+    res = dict(a)
+    for label, value in b.items():
+        res[label] = res.get(label, 0) + value
+    return res
+
+
+class Stats(object):
+
+    def __init__(self, prefix='pyzbus'):
+        self.prefix = prefix
+        self.metrics = []
+        self.gauge('process_cpu_seconds_total', process_cpu_seconds)
+        self.gauge('process_resident_memory_bytes',
+                   process_resident_memory_bytes)
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, label=None):
+        return self._add(Counter(name, label))
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, buckets))
+
+    def gauge(self, name, func):
+        return self._add(Gauge(name, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(self.prefix))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        return dict((metric.name, metric.as_dict())
+                    for metric in self.metrics)
+
+    def wsgi_app(self, environ, start_response):
+        if environ.get('PATH_INFO') not in ('/', '/metrics'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        body = self.render().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def serve(self, addr):
+        # addr is 'host:port', returns started WSGIServer.
+        host, port = addr.rsplit(':', 1)
+        server = pywsgi.WSGIServer((host, int(port)), self.wsgi_app,
+                                   log=None)
+        server.start()
+        logger.info('Serving stats on http://{}/metrics.'.format(addr))
+        return server
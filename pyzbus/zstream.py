@@ -0,0 +1,70 @@
+"""
+Streaming replies.
+
+ask_stream sends a request with a number of credits. The responder sends
+one chunk per credit and waits when it runs out. The asker grants more
+credits as it consumes chunks and cancels the stream if it stops early.
+Chunks in flight never exceed the credits, so neither end buffers more
+than that.
+"""
+from gevent.event import Event
+from gevent.queue import Empty, Queue
+
+from .zask import AskTimeout
+
+
+class Consumer(object):
+    # Asker side of a stream.
+    __slots__ = ('queue', 'window', 'unacked', 'ended')
+
+    def __init__(self, window):
+        self.queue = Queue()
+        self.window = window
+        self.unacked = 0
+        self.ended = False
+
+    def put(self, chunk):
+        self.queue.put(chunk)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            raise AskTimeout('No stream chunk for {} seconds.'.format(timeout))
+
+    def consumed(self):
+        # Returns credits to grant now, in steps of half the window.
+        self.unacked += 1
+        if self.unacked < max(1, self.window // 2):
+            return 0
+        credits, self.unacked = self.unacked, 0
+        return credits
+
+
+class Producer(object):
+    # Responder side of a stream.
+    __slots__ = ('credits', 'cancelled', 'event')
+
+    def __init__(self, credits):
+        self.credits = credits
+        self.cancelled = False
+        self.event = Event()
+
+    def grant(self, credits):
+        self.credits += credits
+        self.event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.event.set()
+
+    def take(self, timeout=None):
+        # Waits for a credit, False if cancelled or none came in time.
+        while self.credits <= 0 and not self.cancelled:
+            self.event.clear()
+            if not self.event.wait(timeout):
+                return False
+        if self.cancelled:
+            return False
+        self.credits -= 1
+        return True
@@ -0,0 +1,124 @@
+"""
+Hierarchical topics.
+
+Topic names are dot separated, like orders.eu.fr. Actors subscribe to
+names or to patterns where * is exactly one segment and # is any number
+of segments, none too: orders.eu.*, orders.*.fr, orders.#. A lone * is
+not a pattern but the broadcast address.
+
+libzmq filters by prefix only, so a pattern is subscribed by its literal
+segments before the first wildcard and TopicTrie drops what the rest of
+the pattern does not match. Patterns that start with a wildcard get
+everything from the manager and are matched locally only.
+"""
+SEPARATOR = '.'
+ONE = '*'
+MANY = '#'
+
+
+def is_pattern(topic):
+    segments = topic.split(SEPARATOR)
+    return topic == MANY or (
+        len(segments) > 1 and (ONE in segments or MANY in segments))
+
+
+def subscription_prefix(pattern):
+    # libzmq subscription covering every topic the pattern matches.
+    literal = []
+    for segment in pattern.split(SEPARATOR):
+        if segment in (ONE, MANY):
+            break
+        literal.append(segment)
+    prefix = '|' + SEPARATOR.join(literal)
+    if literal and segment == ONE:
+        # One more segment must follow, # matches orders itself.
+        prefix += SEPARATOR
+    return prefix
+
+
+class Node(object):
+    __slots__ = ('children', 'pattern')
+
+    def __init__(self):
+        self.children = {}
+        self.pattern = None # Pattern ending here.
+
+
+class TopicTrie(object):
+    # Patterns by segment, a match walks the topic once and branches
+    # only on wildcards, however many patterns there are.
+
+    def __init__(self):
+        self.root = Node()
+        self.counts = {} # Subscriptions by pattern.
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, pattern):
+        return pattern in self.counts
+
+    def patterns(self):
+        return list(self.counts)
+
+    def add(self, pattern):
+        # Returns True if pattern is new.
+        self.counts[pattern] = self.counts.get(pattern, 0) + 1
+        if self.counts[pattern] > 1:
+            return False
+        node = self.root
+        for segment in pattern.split(SEPARATOR):
+            node = node.children.setdefault(segment, Node())
+        node.pattern = pattern
+        return True
+
+    def remove(self, pattern):
+        # Returns True if the last subscription of pattern is gone.
+        count = self.counts.get(pattern)
+        if not count:
+            return False
+        if count > 1:
+            self.counts[pattern] = count - 1
+            return False
+        del self.counts[pattern]
+        path = [self.root]
+        segments = pattern.split(SEPARATOR)
+        for segment in segments:
+            path.append(path[-1].children[segment])
+        path[-1].pattern = None
+        # Prune nodes left without patterns.
+        for depth in range(len(segments), 0, -1):
+            node = path[depth]
+            if node.children or node.pattern is not None:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+        return True
+
+    def match(self, topic):
+        for _ in self._matches(topic.split(SEPARATOR)):
+            return True
+        return False
+
+    def matches(self, topic):
+        # Patterns matching topic.
+        return sorted(set(self._matches(topic.split(SEPARATOR))))
+
+    def _matches(self, segments):
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            many = node.children.get(MANY)
+            if many is not None:
+                # # takes none up to all of the remaining segments.
+                for j in range(i, len(segments) + 1):
+                    stack.append((many, j))
+            if i == len(segments):
+                if node.pattern is not None:
+                    yield node.pattern
+                continue
+            child = node.children.get(segments[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            one = node.children.get(ONE)
+            if one is not None:
+                stack.append((one, i + 1))
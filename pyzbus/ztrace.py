@@ -0,0 +1,167 @@
+"""
+Sampled tracing.
+
+A share of asks and tells (TraceSampleRate), or any message sent with
+msg['Hops'] = [], carries time stamps of every hop on its way:
+
+    send           actor sends it
+    manager_in     ZManager has read the batch it came in
+    manager_out    ZManager publishes it
+    receive        receiving actor has decoded it
+    handler_start  on_* handler starts, after waiting for a greenlet
+    handler_end    handler is done, check_reply sends the reply
+    resolve        asker got the reply
+
+A reply carries the hops of its request, so the asker sees the round
+trip. Hops are [name, monotonic, wall clock] in msg['Hops']. Stamps
+added on the wire go to the envelope (TRACED flag), ZManager appends its
+own without decoding the body. Unsampled messages only cost a check.
+
+Tracer sums up traces by message type into per segment latencies,
+monotonic within a process and wall clock between processes, and keeps
+the last ones for a timeline in Chrome trace format (chrome://tracing,
+Perfetto).
+"""
+import collections
+import struct
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = time.time # Not monotonic, but better than nothing.
+
+SEND = 'send'
+MANAGER_IN = 'manager_in'
+MANAGER_OUT = 'manager_out'
+RECEIVE = 'receive'
+HANDLER_START = 'handler_start'
+HANDLER_END = 'handler_end'
+RESOLVE = 'resolve'
+HOPS = [SEND, MANAGER_IN, MANAGER_OUT, RECEIVE, HANDLER_START, HANDLER_END,
+        RESOLVE]
+
+# Hop code, monotonic and wall clock time in the envelope.
+HOP = struct.Struct('!Bdd')
+
+# Segments within one process, measured by the monotonic clock.
+LOCAL = frozenset([
+    (MANAGER_IN, MANAGER_OUT), (RECEIVE, HANDLER_START),
+    (HANDLER_START, HANDLER_END), (HANDLER_END, SEND), (RECEIVE, RESOLVE)])
+
+
+def clock():
+    return monotonic(), time.time()
+
+
+def stamp(hop, now=None):
+    mono, wall = now or clock()
+    return [hop, mono, wall]
+
+
+def pack(hop, now=None):
+    mono, wall = now or clock()
+    return HOP.pack(HOPS.index(hop), mono, wall)
+
+
+def unpack(data):
+    return [[HOPS[code], mono, wall] for code, mono, wall in (
+        HOP.unpack_from(data, offset)
+        for offset in range(0, len(data), HOP.size))]
+
+
+def segments(hops):
+    # (name, seconds) of every pair of consecutive hops.
+    for (a, mono_a, wall_a), (b, mono_b, wall_b) in zip(hops, hops[1:]):
+        if (a, b) in LOCAL:
+            yield '{}>{}'.format(a, b), mono_b - mono_a
+        else:
+            yield '{}>{}'.format(a, b), wall_b - wall_a
+
+
+class Summary(object):
+    __slots__ = ('count', 'sum', 'max', 'recent')
+
+    def __init__(self, samples):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=samples) # For percentiles.
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, p):
+        values = sorted(self.recent)
+        return values[min(int(len(values) * p), len(values) - 1)]
+
+    def as_dict(self):
+        return {
+            'Count': self.count,
+            'Mean': self.sum / self.count,
+            'P50': self.percentile(0.5),
+            'P99': self.percentile(0.99),
+            'Max': self.max,
+        }
+
+
+class Tracer(object):
+
+    def __init__(self, keep=100, samples=1000):
+        self.samples = samples
+        # Message type: (total Summary, [(segment, Summary)] by position).
+        self.types = {}
+        self.traces = collections.deque(maxlen=keep) # (message, hops)
+
+    def record(self, message, hops):
+        if len(hops) < 2:
+            return
+        entry = self.types.get(message)
+        if entry is None:
+            entry = self.types[message] = (Summary(self.samples), [])
+        total, positions = entry
+        total.observe(hops[-1][2] - hops[0][2])
+        for i, (name, seconds) in enumerate(segments(hops)):
+            if i == len(positions):
+                positions.append((name, Summary(self.samples)))
+            elif positions[i][0] != name:
+                # Took another way, e.g. local delivery, not comparable.
+                continue
+            positions[i][1].observe(seconds)
+        self.traces.append((message, hops))
+
+    def as_dict(self):
+        res = {}
+        for message, (total, positions) in self.types.items():
+            segments = []
+            for name, summary in positions:
+                segment = summary.as_dict()
+                segment['Segment'] = name
+                segments.append(segment)
+            res[message] = {'Total': total.as_dict(), 'Segments': segments}
+        return res
+
+    def chrome_trace(self):
+        # Every trace is a process of the timeline, the whole message on
+        # top and its segments below.
+        events = []
+        for pid, (message, hops) in enumerate(self.traces, 1):
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                           'args': {'name': '{} #{}'.format(message, pid)}})
+            start = hops[0][2]
+            events.append({'ph': 'X', 'name': message, 'pid': pid, 'tid': 0,
+                           'ts': start * 1e6,
+                           'dur': (hops[-1][2] - start) * 1e6})
+            at = start
+            for name, seconds in segments(hops):
+                events.append({'ph': 'X', 'name': name, 'pid': pid,
+                               'tid': 0, 'ts': at * 1e6,
+                               'dur': max(seconds, 0) * 1e6})
+                at += max(seconds, 0)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -20,5 +20,11 @@ setup(
     install_requires=[
         'gevent',
         'zmq',
-    ]
+    ],
+    extras_require={
+        'msgpack': ['msgpack'],
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+        'monotonic': ['monotonic'], # ztrace clock on Python 2.
+    }
 )
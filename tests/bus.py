@@ -0,0 +1,53 @@
+"""
+Managers and actors of the test process, over inproc.
+"""
+import unittest
+
+import gevent
+import zmq.green as zmq
+
+from pyzbus.zmanager import ZManager
+
+
+class BusTest(unittest.TestCase):
+
+    def setUp(self):
+        # Own context, inproc names of one test don't clash with others.
+        self.context = zmq.Context()
+        self.managers = []
+        self.actors = []
+
+    def tearDown(self):
+        for actor in self.actors:
+            if not actor.sub_socket.closed: # Not stopped by the test.
+                actor.stop(exit=False)
+            actor.handler_pool.kill()
+            gevent.killall(actor.greenlets)
+        for manager in self.managers:
+            gevent.killall(manager.greenlets)
+        self.context.destroy(linger=0)
+
+    def manager(self, uid='ZManager', **settings):
+        manager = ZManager(dict({
+            'UID': uid,
+            'PubAddr': 'inproc://{}-pub'.format(uid),
+            'SubAddr': 'inproc://{}-sub'.format(uid),
+            'KeepAlive': 0,
+            'ExpiryReportInterval': 0,
+        }, **settings), self.context)
+        self.managers.append(manager)
+        return manager
+
+    def actor(self, cls, uid, manager=None, **settings):
+        # Connected to manager, the first one by default.
+        manager = manager or self.managers[0]
+        actor = cls(settings=dict({
+            'UID': uid,
+            'PubAddr': manager.settings['SubAddr'],
+            'SubAddr': manager.settings['PubAddr'],
+            'ManagerUID': manager.settings['UID'],
+            'IdleTimeout': 0,
+            'ExpiryReportInterval': 0,
+        }, **settings), context=self.context)
+        self.actors.append(actor)
+        return actor
@@ -0,0 +1,164 @@
+import json
+
+import gevent
+
+from pyzbus.zactor import ZActor, check_reply
+
+from bus import BusTest
+
+
+class Recorder(ZActor):
+
+    def __init__(self, *args, **kwargs):
+        self.received = []
+        super(Recorder, self).__init__(*args, **kwargs)
+
+    @check_reply
+    def on_Echo(self, msg):
+        self.received.append(msg)
+        return {'Text': msg.get('Text')}
+
+
+class SubscribeTest(BusTest):
+
+    def setUp(self):
+        super(SubscribeTest, self).setUp()
+        self.manager()
+        self.sender = self.actor(ZActor, 'sender')
+        self.receiver = self.actor(Recorder, 'receiver')
+
+    def test_names(self):
+        # Byte names are taken as they are, unicode ones from JSON are
+        # encoded.
+        self.receiver.subscribe('caf\xc3\xa9')
+        self.receiver.subscribe(u'caf\xe9')
+        self.receiver.subscribe('menu.\xc3\xa9t\xc3\xa9.*')
+        self.assertEqual(self.receiver.subscribed(),
+                         ['*', 'caf\xc3\xa9', 'menu.\xc3\xa9t\xc3\xa9.*',
+                          'receiver'])
+        gevent.sleep(0.1)
+        self.sender.tell({'Message': 'Echo', 'To': 'caf\xc3\xa9'})
+        gevent.sleep(0.1)
+        self.assertEqual(len(self.receiver.received), 1)
+        self.receiver.unsubscribe(u'caf\xe9')
+        self.receiver.unsubscribe('menu.\xc3\xa9t\xc3\xa9.*')
+        self.assertEqual(self.receiver.subscribed(), ['*', 'receiver'])
+
+
+class SequenceTest(BusTest):
+
+    def setUp(self):
+        super(SequenceTest, self).setUp()
+        self.manager()
+        self.sender = self.actor(ZActor, 'sender')
+        self.receiver = self.actor(Recorder, 'receiver')
+
+    def test_bad_sequence(self):
+        # Not ours to check, delivered as they are.
+        for seq in ('abc', None, 1.5, -1):
+            self.sender.tell({'Message': 'Echo', 'To': 'receiver',
+                              'DestSequence': seq, 'SequenceEpoch': 'x'})
+        res = self.sender.ask({'Message': 'Echo', 'To': 'receiver',
+                               'Text': 'hi'}, timeout=1)
+        self.assertEqual(res.get('Text'), 'hi')
+        self.assertEqual(len(self.receiver.received), 5)
+
+    def test_bad_retransmit(self):
+        for request in ({'First': 1}, {'First': '1', 'Last': 2},
+                        {'First': 3, 'Last': 2}):
+            res = self.sender.ask(dict(request, Message='Retransmit',
+                                       To='receiver'), timeout=1)
+            self.assertEqual(res.get('Error'), 'BadRange')
+
+
+class Responder(ZActor):
+
+    delay = 0
+    asked = 0
+
+    @check_reply
+    def on_Get(self, msg):
+        self.asked += 1
+        gevent.sleep(self.delay)
+        return {'Uid': self.uid}
+
+
+class AskManyTest(BusTest):
+
+    def setUp(self):
+        super(AskManyTest, self).setUp()
+        self.manager()
+        self.fast = self.actor(Responder, 'fast')
+        self.fast.delay = 0.2
+        self.slow = self.actor(Responder, 'slow')
+        self.slow.delay = 0.4
+        self.asker = self.actor(ZActor, 'asker', AskCacheSize=10,
+                                AskCache={'Get': 0})
+
+    def test_quorum(self):
+        replies = self.asker.ask_many({'Message': 'Get'}, ['fast', 'slow'],
+                                      quorum=1, timeout=2)
+        self.assertEqual(list(replies), ['fast'])
+        # Nobody else waits for slow, its request is cancelled.
+        self.assertEqual(len(self.asker.ask_pool), 0)
+        gevent.sleep(0.01)
+        self.assertFalse(self.asker.asks_in_flight)
+
+    def test_shared_request_goes_on(self):
+        # An ask joining the request to slow still gets its reply after
+        # ask_many has stopped waiting for it.
+        shared = []
+        gevent.spawn_later(0.05, lambda: shared.append(self.asker.ask(
+            {'Message': 'Get', 'To': 'slow'}, timeout=2)))
+        replies = self.asker.ask_many({'Message': 'Get'}, ['fast', 'slow'],
+                                      quorum=1, timeout=2)
+        self.assertEqual(list(replies), ['fast'])
+        gevent.sleep(0.4)
+        self.assertEqual([res.get('Uid') for res in shared], ['slow'])
+        self.assertEqual(self.slow.asked, 1)
+
+
+class SendOverflowTest(BusTest):
+    # The manager stops reading, sends fill the PUB pipe and the queue.
+
+    def fill(self, policy, count=100):
+        self.zmanager = self.manager(RcvHWM=5)
+        self.sender = self.actor(ZActor, 'sender', SndHWM=5, SendQueueSize=5,
+                                 SendOverflow=policy)
+        gevent.killall(self.zmanager.greenlets)
+        for n in range(count):
+            self.sender.tell({'Message': 'Echo', 'To': '*', 'N': n})
+
+    def fill_more(self):
+        for _ in range(100):
+            self.sender.tell({'Message': 'Echo', 'To': '*'})
+
+    def queued(self):
+        return [json.loads(frames[2])['N']
+                for frames in self.sender.send_queue.queue]
+
+    def dropped(self):
+        return self.sender.stats.as_dict()['messages_send_dropped_total']
+
+    def test_drop_newest(self):
+        self.fill('drop_newest')
+        queued = self.queued()
+        self.assertEqual(len(queued), 5)
+        self.assertEqual(self.dropped(), {'drop_newest': 99 - queued[-1]})
+
+    def test_drop_oldest(self):
+        self.fill('drop_oldest')
+        self.assertEqual(self.queued(), range(95, 100))
+        self.assertGreater(self.dropped().get('drop_oldest'), 0)
+
+    def test_block(self):
+        self.fill('block', 0)
+        telling = gevent.spawn(self.fill_more)
+        gevent.sleep(0.1)
+        self.assertFalse(telling.ready())
+        # Sent on as the manager reads again.
+        self.zmanager.greenlets.append(
+            gevent.spawn(self.zmanager.sub_receive))
+        telling.join(1)
+        self.assertTrue(telling.ready())
+        self.assertEqual(self.dropped(), {})
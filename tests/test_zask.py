@@ -0,0 +1,69 @@
+import unittest
+
+from pyzbus.zask import (AskCancelled, AskPool, AskTimeout, NoRoute,
+                         TimerWheel)
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_expire_due_only(self):
+        expired = []
+        wheel = TimerWheel(expired.append, resolution=0.1)
+        wheel.schedule('a', 0)
+        wheel.schedule('b', 60)
+        deadline, slot = wheel.deadlines['a']
+        wheel.expire(wheel.slots[slot], deadline)
+        self.assertEqual(expired, ['a'])
+        self.assertEqual(list(wheel.deadlines), ['b'])
+
+    def test_cancel(self):
+        expired = []
+        wheel = TimerWheel(expired.append)
+        wheel.schedule('a', 0)
+        slot = wheel.deadlines['a'][1]
+        wheel.cancel('a')
+        wheel.expire(wheel.slots[slot], float('inf'))
+        self.assertEqual(expired, [])
+        self.assertEqual(len(wheel), 0)
+
+
+class AskPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resent = []
+        self.pool = AskPool(self.resent.append)
+
+    def test_resolve(self):
+        result = self.pool.add({'Id': '1'}, 2, 5)
+        self.assertIsNotNone(self.pool.resolve({'ReplyToId': '1', 'X': 1}))
+        self.assertEqual(result.get(block=False)['X'], 1)
+        self.assertIsNone(self.pool.resolve({'ReplyToId': '1'}))
+        self.assertEqual(len(self.pool), 0)
+
+    def test_reject(self):
+        result = self.pool.add({'Id': '1'}, 2, 5)
+        self.pool.reject({'ReplyToId': '1'}, NoRoute('1'))
+        self.assertRaises(NoRoute, result.get, block=False)
+
+    def test_attempts(self):
+        msg = {'Id': '1'}
+        result = self.pool.add(msg, 2, 5)
+        self.pool.expire('1')
+        self.assertEqual(self.resent, [msg])
+        self.assertFalse(result.ready())
+        self.pool.expire('1')
+        self.assertRaises(AskTimeout, result.get, block=False)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_fail_all(self):
+        results = [self.pool.add({'Id': str(i)}, 1, 5) for i in range(3)]
+        self.assertEqual(self.pool.fail_all(NoRoute()), 3)
+        for result in results:
+            self.assertRaises(NoRoute, result.get, block=False)
+
+    def test_cancel(self):
+        result = self.pool.add({'Id': '1'}, 2, 5)
+        self.assertTrue(self.pool.cancel('1'))
+        self.assertRaises(AskCancelled, result.get, block=False)
+        self.assertFalse(self.pool.cancel('1'))
+        self.assertEqual(len(self.pool.wheel), 0)
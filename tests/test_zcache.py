@@ -0,0 +1,49 @@
+import unittest
+
+from pyzbus.zcache import ReplyCache, request_key
+
+
+class RequestKeyTest(unittest.TestCase):
+
+    def test_headers_ignored(self):
+        msg = {'Message': 'GetConfig', 'To': 'srv', 'Name': 'a'}
+        sent = dict(msg, Id='1', From='cli', ReplyTo=['cli'], SendTime=1.0,
+                    Sequence=7, DestSequence=3, SequenceEpoch='e1',
+                    Priority=2, Hops=[['send', 1.0, 1.0]])
+        self.assertEqual(request_key(sent), request_key(msg))
+
+    def test_body_differs(self):
+        self.assertNotEqual(
+            request_key({'Message': 'GetConfig', 'Name': 'a'}),
+            request_key({'Message': 'GetConfig', 'Name': 'b'}))
+
+    def test_sender(self):
+        # Replies to LightActors of a host may differ.
+        msg = {'Message': 'GetConfig', 'To': 'srv'}
+        self.assertNotEqual(request_key(msg, 'a'), request_key(msg, 'b'))
+        self.assertEqual(request_key(dict(msg, From='a'), 'a'),
+                         request_key(msg, 'a'))
+
+    def test_attachments(self):
+        self.assertIsNone(request_key(
+            {'Message': 'GetConfig', 'Attachments': [b'x']}))
+
+
+class ReplyCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = ReplyCache(10)
+        cache.put('k', {'Value': 1}, 5, now=100)
+        self.assertEqual(cache.get('k', now=104), {'Value': 1})
+        self.assertIsNone(cache.get('k', now=105))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = ReplyCache(2)
+        cache.put('a', 1, 60, now=100)
+        cache.put('b', 2, 60, now=100)
+        cache.get('a', now=101)
+        self.assertEqual(cache.put('c', 3, 60, now=101), 1)
+        self.assertIsNone(cache.get('b', now=102))
+        self.assertEqual(cache.get('a', now=102), 1)
+        self.assertEqual(cache.evicted, 1)
@@ -0,0 +1,28 @@
+import unittest
+import zlib
+
+from pyzbus import zcompress
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        body = b'{"Message": "Report", "Rows": []}' * 100
+        for name, compressor in zcompress.compressors_by_name.items():
+            flags = zcompress.envelope_flags(compressor)
+            self.assertEqual(zcompress.decompress(
+                flags, compressor.compress(body)), body, name)
+
+    def test_flags(self):
+        zlib_flags = zcompress.envelope_flags(zcompress.get_compressor('zlib'))
+        self.assertEqual(zlib_flags & ~zcompress.MASK, 0)
+        # Other flag bits don't matter.
+        self.assertEqual(zcompress.decompress(
+            zlib_flags | 0x01, zlib.compress(b'body')), b'body')
+        self.assertEqual(zcompress.decompress(0x01, b'body'), b'body')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, zcompress.get_compressor, 'brotli')
+        if zcompress.zstandard is None:
+            # Sent by a peer that has it.
+            self.assertRaises(ValueError, zcompress.decompress, 0x30, b'x')
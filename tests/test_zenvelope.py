@@ -0,0 +1,80 @@
+import struct
+import unittest
+
+from pyzbus import zenvelope
+
+
+class EnvelopeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = zenvelope.pack(100.5, 5, codec=1, flags=zenvelope.NOROUTE,
+                              sender='actor', message='GetConfig',
+                              priority=2)
+        envelope = zenvelope.unpack(data)
+        self.assertEqual(envelope.codec, 1)
+        self.assertEqual(envelope.flags, zenvelope.NOROUTE)
+        self.assertEqual(envelope.send_time, 100.5)
+        self.assertEqual(envelope.expire_time, 5)
+        self.assertEqual(envelope.sender, 'actor')
+        self.assertEqual(envelope.message, 'GetConfig')
+        self.assertEqual(envelope.priority, 2)
+        self.assertIsNone(envelope.trace)
+        self.assertEqual(zenvelope.priority(data), 2)
+
+    def test_defaults(self):
+        envelope = zenvelope.unpack(zenvelope.pack(1, None))
+        self.assertEqual((envelope.codec, envelope.flags, envelope.sender,
+                          envelope.message, envelope.expire_time),
+                         (0, 0, '', '', 0))
+
+    def test_add_flags(self):
+        data = zenvelope.pack(1, 5, flags=zenvelope.NOROUTE, sender='a',
+                              message='Ping')
+        envelope = zenvelope.unpack(
+            zenvelope.add_flags(data, zenvelope.REPLAY))
+        self.assertEqual(envelope.flags, zenvelope.NOROUTE | zenvelope.REPLAY)
+        self.assertEqual(envelope.message, 'Ping')
+
+    def test_routing_key(self):
+        self.assertEqual(zenvelope.routing_key('actor'), '|actor|')
+
+
+    def test_older_versions(self):
+        # 3 without attachments, 4 without priority.
+        v3 = struct.pack('!BBBdf', 3, 1, zenvelope.NOROUTE, 100.5, 5) + \
+            'actor\x00Ping'
+        v4 = struct.pack('!BBBdfH', 4, 1, 0, 100.5, 5, 2) + 'actor\x00Ping'
+        for data, attachments in ((v3, 0), (v4, 2)):
+            envelope = zenvelope.unpack(data)
+            self.assertEqual((envelope.codec, envelope.send_time,
+                              envelope.sender, envelope.message,
+                              envelope.attachments, envelope.priority),
+                             (1, 100.5, 'actor', 'Ping', attachments, 0))
+            self.assertEqual(zenvelope.attachment_count(data), attachments)
+            self.assertEqual(zenvelope.priority(data), 0)
+        self.assertEqual(zenvelope.unpack(v3).flags, zenvelope.NOROUTE)
+
+    def test_unsupported_version(self):
+        data = struct.pack('!BBdf', 1, 0, 100.5, 5)
+        with self.assertRaises(zenvelope.UnsupportedVersion) as context:
+            zenvelope.unpack(data)
+        self.assertEqual(context.exception.version, 1)
+        self.assertRaises(ValueError, zenvelope.unpack, chr(7) + data[1:])
+
+class UnitsTest(unittest.TestCase):
+
+    def unit(self, to, attachments=()):
+        return [zenvelope.routing_key(to),
+                zenvelope.pack(1, 5, attachments=len(attachments)),
+                'body'] + list(attachments)
+
+    def test_attachments(self):
+        first = self.unit('a', ['x', 'y'])
+        second = self.unit('b')
+        self.assertEqual(list(zenvelope.units(first + second)),
+                         [first, second])
+        self.assertEqual(zenvelope.unpack(first[1]).attachments, 2)
+
+    def test_truncated(self):
+        frames = self.unit('a', ['x', 'y'])[:-1]
+        self.assertRaises(ValueError, list, zenvelope.units(frames))
@@ -0,0 +1,106 @@
+import gevent
+
+from pyzbus.zactor import ZActor, check_reply
+from pyzbus.zhost import LightActor, ZHost
+
+from bus import BusTest
+
+
+class Device(LightActor):
+    # With __dict__, tests keep what it has handled.
+
+    def __init__(self, host, uid):
+        super(Device, self).__init__(host, uid)
+        self.handled = []
+
+    @check_reply
+    def on_Alert(self, msg):
+        self.handled.append(msg)
+        return {'Device': self.uid}
+
+
+class Server(ZActor):
+    asked = 0
+
+    @check_reply
+    def on_WhoAmI(self, msg):
+        self.asked += 1
+        return {'Asker': msg.get('From')}
+
+
+class HostTest(BusTest):
+
+    def setUp(self):
+        super(HostTest, self).setUp()
+        self.manager()
+        self.host = self.actor(ZHost, 'host')
+        self.devices = [Device(self.host, 'd{}'.format(i)) for i in range(3)]
+        self.sender = self.actor(Server, 'sender')
+
+    def send(self, to, **msg):
+        gevent.sleep(0.1) # Subscriptions reach the manager.
+        self.sender.tell(dict(msg, Message='Alert', To=to))
+        gevent.sleep(0.1)
+
+    def handled(self):
+        return [len(device.handled) for device in self.devices]
+
+    def test_fan_out(self):
+        # Names from JSON are unicode.
+        self.devices[0].subscribe('alerts')
+        self.devices[1].subscribe(u'alerts')
+        self.devices[2].subscribe('alerts.\xc3\xa9u.*')
+        self.send('alerts', Hops=[])
+        self.assertEqual(self.handled(), [1, 1, 0])
+        # Own copies.
+        first, second = [device.handled[0] for device in self.devices[:2]]
+        self.assertIsNot(first, second)
+        self.assertIsNot(first['Hops'], second['Hops'])
+        self.send('alerts.\xc3\xa9u.de')
+        self.assertEqual(self.handled(), [1, 1, 1])
+        self.send('*')
+        self.assertEqual(self.handled(), [2, 2, 2])
+
+    def test_to_uid(self):
+        self.send('d1')
+        self.assertEqual(self.handled(), [0, 1, 0])
+
+    def test_replies(self):
+        # Asks of every actor go out from its UID and the reply comes back
+        # to it.
+        results = [device.ask_async({'Message': 'WhoAmI', 'To': 'sender'},
+                                    timeout=1) for device in self.devices]
+        self.assertEqual([result.get().get('Asker') for result in results],
+                         ['d0', 'd1', 'd2'])
+        res = self.sender.ask({'Message': 'Alert', 'To': 'd2'}, timeout=1)
+        self.assertEqual(res.get('Device'), 'd2')
+        self.assertEqual(self.handled(), [0, 0, 1])
+
+    def test_stop(self):
+        device = self.devices[0]
+        device.subscribe('alerts')
+        device.subscribe('alerts.#')
+        self.devices[1].subscribe('alerts')
+        device.stop()
+        self.assertNotIn('d0', self.host.actors)
+        self.assertEqual(self.host.subscribed(), ['*', 'alerts', 'host'])
+        self.send('alerts')
+        self.send('d0')
+        self.assertEqual(self.handled(), [0, 1, 0])
+        self.devices[1].stop()
+        self.assertEqual(self.host.subscribed(), ['*', 'host'])
+
+    def test_cache_by_actor(self):
+        host = self.actor(ZHost, 'cached', AskCacheSize=10,
+                          AskCache={'WhoAmI': 60})
+        first, second = Device(host, 'c0'), Device(host, 'c1')
+        msg = {'Message': 'WhoAmI', 'To': 'sender'}
+        # In flight at once and one after the other.
+        results = [first.ask_async(dict(msg), timeout=1),
+                   second.ask_async(dict(msg), timeout=1)]
+        self.assertEqual([result.get().get('Asker') for result in results],
+                         ['c0', 'c1'])
+        self.assertEqual(second.ask(dict(msg), timeout=1).get('Asker'),
+                         'c1')
+        self.assertEqual(first.ask(dict(msg), timeout=1).get('Asker'), 'c0')
+        self.assertEqual(self.sender.asked, 2)
@@ -0,0 +1,63 @@
+import unittest
+
+from pyzbus.zlane import Expiry, priority
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def error(self, line):
+        self.lines.append(('error', line))
+
+    def warning(self, line):
+        self.lines.append(('warning', line))
+
+
+class ExpiryTest(unittest.TestCase):
+
+    def test_check(self):
+        expiry = Expiry(Logger(), interval=10)
+        expiry.reported = 100
+        self.assertFalse(expiry.check(1, 5, 'Get', 100))
+        self.assertFalse(expiry.check(5.5, 5, 'Get', 100))
+        self.assertTrue(expiry.check(7, 5, 'Get', 100))
+        self.assertEqual(expiry.nearly, {'Get': 1})
+        self.assertEqual(expiry.expired, {'Get': 1})
+
+    def test_summary(self):
+        logger = Logger()
+        expiry = Expiry(logger, interval=10)
+        expiry.reported = 100
+        for i in range(3):
+            expiry.check(60, 5, 'Get', 101)
+        self.assertEqual(logger.lines, [])
+        expiry.check(60, 5, 'Put', 110)
+        self.assertEqual(len(logger.lines), 1)
+        self.assertIn('Discarded 4 expired messages', logger.lines[0][1])
+        self.assertFalse(expiry.expired)
+
+    def test_flush(self):
+        # Counts of a burst are reported without a later check.
+        logger = Logger()
+        expiry = Expiry(logger, interval=10)
+        expiry.reported = 100
+        expiry.check(60, 5, 'Get', 101)
+        expiry.flush(105)
+        self.assertEqual(logger.lines, [])
+        expiry.flush(111)
+        self.assertEqual(len(logger.lines), 1)
+        expiry.flush(130)
+        self.assertEqual(len(logger.lines), 1)
+
+
+class PriorityTest(unittest.TestCase):
+
+    def test_priority(self):
+        self.assertEqual(priority(None), 0)
+        self.assertEqual(priority(2.7), 2)
+        self.assertEqual(priority(-1), 0)
+        self.assertEqual(priority(1000), 255)
+        self.assertRaises(ValueError, priority, 'high')
+        self.assertRaises(ValueError, priority, [1])
@@ -0,0 +1,37 @@
+import shutil
+import tempfile
+import unittest
+
+from pyzbus.zlog import ReplayLog
+
+
+class ReplayLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = ReplayLog(self.directory, segment_size=4096,
+                             retention_bytes=3 * 4096)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        self.log.append([b'|a|', b'envelope', b'body'], now=10)
+        self.log.append([b'|b|', b'envelope', b'body'], now=11)
+        self.assertEqual(list(self.log.replay(keys=set([b'|a|']))),
+                         [(10, [b'|a|', b'envelope', b'body'])])
+
+    def test_retention_during_replay(self):
+        for _ in range(50):
+            self.log.append([b'|a|', b'envelope', b'x' * 100])
+        replaying = list(self.log.segments)
+        replay = self.log.replay(keys=set([b'|a|']))
+        _, frames = next(replay)
+        self.assertEqual(frames[2], b'x' * 100)
+        # Rolls segments over the size limit, the ones we read go.
+        for _ in range(200):
+            self.log.append([b'|a|', b'envelope', b'y' * 100])
+        self.assertTrue(all(segment.removed for segment in replaying))
+        # Scanning stops at the removed segments, their maps are closed.
+        self.assertEqual(list(replay), [])
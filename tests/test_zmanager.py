@@ -0,0 +1,222 @@
+import time
+import unittest
+
+import gevent
+import gevent.event
+import zmq
+
+from pyzbus import zenvelope
+from pyzbus.zactor import ZActor
+from pyzbus.zask import NoRoute
+from pyzbus.zmanager import (Subscriptions, ZManager, shard_of,
+                             shard_prefixes)
+
+from bus import BusTest
+
+
+class SettingsTest(BusTest):
+
+    def test_own_settings(self):
+        # Two brokers of one process, e.g. for peering tests.
+        first = self.manager('first', SndHWM=10)
+        second = self.manager('second')
+        self.assertEqual(first.settings['UID'], 'first')
+        self.assertEqual(first.settings['SndHWM'], 10)
+        self.assertEqual(second.settings['UID'], 'second')
+        self.assertEqual(second.settings['SndHWM'], 10000)
+        self.assertEqual(ZManager.settings['UID'], 'ZManager')
+        self.assertFalse(set(first.greenlets) & set(second.greenlets))
+        self.assertEqual(ZManager.greenlets, [])
+
+
+class SubscriptionsTest(unittest.TestCase):
+
+    def test_exact_and_prefix(self):
+        routes = Subscriptions()
+        routes.update(b'\x01|a|')
+        routes.update(b'\x01|orders.eu.')
+        self.assertTrue(routes.match(b'|a|'))
+        self.assertFalse(routes.match(b'|ab|'))
+        self.assertTrue(routes.match(b'|orders.eu.de|'))
+        self.assertFalse(routes.match(b'|orders.us|'))
+        self.assertEqual(routes.uids(), ['a'])
+        self.assertEqual(len(routes), 2)
+
+    def test_unsubscribe(self):
+        routes = Subscriptions()
+        routes.update(b'\x01|orders.')
+        routes.update(b'\x01|orders.eu.')
+        self.assertEqual(routes.update(b'\x00|orders.'),
+                         (False, b'|orders.'))
+        self.assertTrue(routes.match(b'|orders.eu.de|'))
+        self.assertFalse(routes.match(b'|orders.us|'))
+        self.assertEqual(routes.prefix_lengths, [len(b'|orders.eu.')])
+
+    def test_everything(self):
+        routes = Subscriptions()
+        routes.update(b'\x01')
+        self.assertTrue(routes.match(b'|anything|'))
+
+
+class RoutesTest(BusTest):
+    # Routes as subscriptions of actors come and go.
+
+    def setUp(self):
+        super(RoutesTest, self).setUp()
+        self.zmanager = self.manager()
+        self.first = self.actor(ZActor, 'first')
+        self.second = self.actor(ZActor, 'second')
+
+    def has_route(self, name):
+        gevent.sleep(0.1) # Subscriptions reach the manager.
+        return self.zmanager.has_route(b'|{}|'.format(name))
+
+    def test_shared_subscription(self):
+        # XPUB reports the first subscribe and the last unsubscribe.
+        self.assertFalse(self.has_route('news'))
+        self.first.subscribe('news')
+        self.second.subscribe('news')
+        self.assertTrue(self.has_route('news'))
+        self.first.unsubscribe('news')
+        self.assertTrue(self.has_route('news'))
+        self.second.unsubscribe('news')
+        self.assertFalse(self.has_route('news'))
+
+    def test_patterns(self):
+        self.first.subscribe('orders.eu.*')
+        self.assertTrue(self.has_route('orders.eu.de'))
+        self.assertFalse(self.has_route('orders.us.ny'))
+        self.first.unsubscribe('orders.eu.*')
+        self.assertFalse(self.has_route('orders.eu.de'))
+
+    def test_actor_gone(self):
+        self.assertTrue(self.has_route('second'))
+        self.second.stop(exit=False)
+        self.assertFalse(self.has_route('second'))
+        self.assertTrue(self.has_route('first'))
+
+    def test_no_route(self):
+        # Asks nobody can receive fail at once, tells are dropped.
+        result = self.first.ask_async({'Message': 'Get', 'To': 'nobody'},
+                                      timeout=5)
+        self.assertRaises(NoRoute, result.get, timeout=1)
+        self.first.tell({'Message': 'Get', 'To': 'nobody'})
+        gevent.sleep(0.1)
+        self.assertEqual(self.zmanager.stat_unroutable.as_dict(), 2)
+        self.second.subscribe('nobody')
+        gevent.sleep(0.1)
+        self.first.tell({'Message': 'Get', 'To': 'nobody'})
+        gevent.sleep(0.1)
+        self.assertEqual(self.zmanager.stat_unroutable.as_dict(), 2)
+
+
+class ShardTest(BusTest):
+    # A shard of two behind a proxy PUB, receives only the keys it owns.
+    count = 2
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self.proxy = self.context.socket(zmq.PUB)
+        self.proxy.bind('inproc://shard-in')
+        self.out = self.context.socket(zmq.XSUB)
+        self.out.bind('inproc://shard-out')
+        self.shard = ZManager({
+            'ShardInAddr': 'inproc://shard-in',
+            'ShardOutAddr': 'inproc://shard-out',
+            'ShardStatsAddr': 'inproc://shard-{}-stats',
+            'KeepAlive': 0,
+            'ExpiryReportInterval': 0,
+        }, self.context, shard=(0, self.count))
+        self.managers.append(self.shard)
+        gevent.sleep(0.1) # Prefix subscriptions reach the proxy.
+
+    def names(self, index):
+        return [name for name in ('n{}'.format(i) for i in range(100))
+                if shard_of(b'|{}|'.format(name), self.count) == index]
+
+    def test_prefixes(self):
+        prefixes = [set(shard_prefixes(index, self.count))
+                    for index in range(self.count)]
+        self.assertFalse(prefixes[0] & prefixes[1])
+        self.assertEqual(len(prefixes[0] | prefixes[1]), 256 * 256)
+        self.assertIn(b'|or', prefixes[shard_of(b'|orders|', self.count)])
+
+    def test_owned_keys(self):
+        # Nobody subscribes, what the shard receives is unroutable.
+        ours, theirs = self.names(0), self.names(1)
+        self.assertTrue(ours and theirs)
+        for name in ours + theirs:
+            self.proxy.send_multipart([
+                zenvelope.routing_key(name),
+                zenvelope.pack(time.time(), 5, sender='test',
+                               message='Get'),
+                b'{}'])
+        gevent.sleep(0.1)
+        self.assertEqual(self.shard.stat_unroutable.as_dict(), len(ours))
+
+
+class Held(ZActor):
+    # Handles Hold one at a time until released, the receive loop stops
+    # reading meanwhile and messages to it pile up in the manager.
+
+    def __init__(self, *args, **kwargs):
+        self.release = gevent.event.Event()
+        self.held = 0
+        super(Held, self).__init__(*args, **kwargs)
+
+    def on_Hold(self, msg):
+        self.release.wait()
+        self.held += 1
+
+
+class PubOverflowTest(BusTest):
+    count = 200
+
+    def start(self, policy):
+        self.zmanager = self.manager(PubOverflow=policy, SndHWM=5)
+        self.slow = self.actor(Held, 'slow', RcvHWM=5, HandlerPoolSize=1)
+        self.fast = self.actor(Held, 'fast')
+        self.fast.release.set()
+        self.sender = self.actor(ZActor, 'sender')
+        # Manager knows slow is one peer when it has sent something.
+        self.slow.tell({'Message': 'Hello', 'To': 'sender'})
+        gevent.sleep(0.1)
+        for _ in range(self.count):
+            self.sender.tell({'Message': 'Hold', 'To': 'slow'})
+        self.sender.tell({'Message': 'Hold', 'To': 'fast'})
+        gevent.sleep(0.5)
+
+    def dropped(self):
+        return self.zmanager.stats.as_dict()['messages_dropped_total']
+
+    @unittest.skipIf(zmq.zmq_version_info() < (4, 3, 3),
+                     'PubOverflow drop needs libzmq 4.3.3+.')
+    def test_drop(self):
+        # Dropped for slow only, and counted.
+        self.start('drop')
+        self.assertEqual(self.fast.held, 1)
+        dropped = self.dropped().get('slow')
+        self.assertTrue(dropped)
+        self.slow.release.set()
+        gevent.sleep(0.5)
+        self.assertEqual(self.slow.held + dropped, self.count)
+        self.assertEqual(self.zmanager.stats.as_dict()['slow_consumers'], 1)
+
+    def test_block(self):
+        # Nothing is lost, everybody waits for slow.
+        self.start('block')
+        self.assertEqual(self.fast.held, 0)
+        self.slow.release.set()
+        gevent.sleep(0.5)
+        self.assertEqual(self.slow.held, self.count)
+        self.assertEqual(self.fast.held, 1)
+        self.assertEqual(self.dropped(), {})
+
+    def test_lossy(self):
+        # libzmq drops, nothing is counted.
+        self.start('lossy')
+        self.assertEqual(self.fast.held, 1)
+        self.slow.release.set()
+        gevent.sleep(0.5)
+        self.assertLess(self.slow.held, self.count)
+        self.assertEqual(self.dropped(), {})
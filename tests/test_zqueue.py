@@ -0,0 +1,67 @@
+import unittest
+
+from pyzbus.zqueue import WorkQueues
+
+KEY = '|jobs|'
+
+
+class WorkQueuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = WorkQueues(prefetch=2, backlog=3, timeout=6)
+
+    def join(self, identity, load=0, now=0):
+        return self.work.heartbeat(identity, load, [KEY], now)
+
+    def test_prefetch(self):
+        self.join('a')
+        deliveries = [self.work.dispatch(KEY, [i]) for i in range(3)]
+        self.assertEqual([len(d) for d in deliveries], [1, 1, 0])
+        self.assertEqual(self.work.pending(), 1)
+        tag = deliveries[0][0][1]
+        # An ack makes room for the waiting one.
+        self.assertEqual(self.work.ack('a', tag, 0, 1),
+                         [('a', '3', [2], False)])
+        self.assertEqual(self.work.unacked(), 2)
+
+    def test_least_loaded(self):
+        self.join('a', load=5)
+        self.join('b', load=0)
+        identity = self.work.dispatch(KEY, ['x'])[0][0]
+        self.assertEqual(identity, 'b')
+
+    def test_round_robin(self):
+        self.work = WorkQueues('round_robin', prefetch=10)
+        self.join('a')
+        self.join('b')
+        identities = [self.work.dispatch(KEY, [i])[0][0] for i in range(4)]
+        self.assertEqual(sorted(identities), ['a', 'a', 'b', 'b'])
+        self.assertNotEqual(identities[0], identities[1])
+
+    def test_expire_redelivers(self):
+        self.join('a', now=0)
+        self.work.dispatch(KEY, ['x'])
+        self.join('b', load=1, now=5)
+        deliveries = self.work.expire(10)
+        self.assertEqual(deliveries, [('b', '2', ['x'], True)])
+        self.assertNotIn('a', self.work.members)
+        self.assertEqual(self.work.redelivered, 1)
+
+    def test_leave_redelivers(self):
+        self.join('a')
+        self.work.dispatch(KEY, ['x'])
+        self.assertEqual(self.work.leave('a'), [])
+        self.assertEqual(self.work.pending(), 1)
+        deliveries = self.join('b')
+        self.assertEqual(deliveries, [('b', '2', ['x'], True)])
+
+    def test_backlog_overflow(self):
+        self.join('a')
+        for i in range(6):
+            self.work.dispatch(KEY, [i])
+        # Two went to the member, the oldest waiting one was dropped.
+        self.assertEqual(self.work.unacked(), 2)
+        self.assertEqual(self.work.pending(), 3)
+        self.assertEqual(self.work.dropped, 1)
+        self.assertEqual([frames for frames, _ in
+                          self.work.queues[KEY].backlog], [[3], [4], [5]])
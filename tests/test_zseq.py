@@ -0,0 +1,89 @@
+import unittest
+
+from pyzbus.zseq import RecentIds, SendBuffer, SequenceWindow, is_sequence
+
+
+class SequenceWindowTest(unittest.TestCase):
+
+    def test_in_order(self):
+        window = SequenceWindow(1)
+        self.assertEqual(window.receive(2), (True, None))
+        self.assertEqual(window.receive(3), (True, None))
+        self.assertEqual(window.next, 4)
+
+    def test_duplicate(self):
+        window = SequenceWindow(1)
+        window.receive(2)
+        self.assertEqual(window.receive(2), (False, None))
+        self.assertEqual(window.receive(1), (False, None))
+
+    def test_gap_filled(self):
+        window = SequenceWindow(1)
+        self.assertEqual(window.receive(5), (True, (2, 4)))
+        self.assertEqual(window.receive(7), (True, (6, 6)))
+        for seq in (2, 3, 4, 6):
+            self.assertEqual(window.receive(seq), (True, None))
+        self.assertEqual(window.next, 8)
+        self.assertFalse(window.seen)
+
+    def test_skip(self):
+        window = SequenceWindow(1)
+        window.receive(5)
+        self.assertEqual(window.skip(2, 4), 3)
+        self.assertEqual(window.next, 6)
+        self.assertEqual(window.skip(2, 4), 0)
+
+    def test_overflow(self):
+        window = SequenceWindow(1, size=2)
+        for seq in (3, 4, 5):
+            window.receive(seq)
+        self.assertEqual(window.overflow(), 1)
+        self.assertEqual(window.next, 6)
+
+    def test_is_sequence(self):
+        self.assertTrue(is_sequence(1))
+        self.assertTrue(is_sequence(2 ** 64))
+        for value in ('1', None, 1.0, True, -1):
+            self.assertFalse(is_sequence(value))
+
+
+class SendBufferTest(unittest.TestCase):
+
+    def test_numbers_by_stream(self):
+        buffer = SendBuffer(10, epoch='run')
+        first = {'From': 'a', 'To': 'b'}
+        other = {'From': 'a', 'To': 'c'}
+        buffer.stamp(first)
+        buffer.stamp(other)
+        self.assertEqual(first['DestSequence'], 1)
+        self.assertEqual(other['DestSequence'], 1)
+        self.assertEqual(first['SequenceEpoch'], 'run')
+
+    def test_keeps_copies(self):
+        buffer = SendBuffer(10)
+        msg = {'From': 'a', 'To': 'b', 'N': 1}
+        buffer.stamp(msg)
+        msg['N'] = 2
+        buffer.stamp(msg)
+        self.assertEqual(buffer.get('a', 'b', 1)['N'], 1)
+        self.assertEqual(buffer.get('a', 'b', 1)['DestSequence'], 1)
+        self.assertEqual(buffer.get('a', 'b', 2)['N'], 2)
+
+    def test_size(self):
+        buffer = SendBuffer(2)
+        for _ in range(3):
+            buffer.stamp({'From': 'a', 'To': 'b'})
+        self.assertIsNone(buffer.get('a', 'b', 1))
+        self.assertIsNotNone(buffer.get('a', 'b', 3))
+
+
+class RecentIdsTest(unittest.TestCase):
+
+    def test_add(self):
+        ids = RecentIds(2)
+        self.assertTrue(ids.add('a'))
+        self.assertFalse(ids.add('a'))
+        ids.add('b')
+        ids.add('c')
+        self.assertEqual(len(ids), 2)
+        self.assertTrue(ids.add('a'))
@@ -0,0 +1,56 @@
+import unittest
+
+from pyzbus.zstats import Stats, merge
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = Stats()
+        self.sent = self.stats.counter('messages_sent_total', 'message')
+        self.errors = self.stats.counter('errors_total')
+        self.latency = self.stats.histogram('latency_seconds', (0.1, 1))
+        self.stats.gauge('queue_depth', lambda: 3)
+
+    def test_as_dict(self):
+        self.sent.inc('Ping')
+        self.sent.inc('Ping', 2)
+        self.errors.inc()
+        self.latency.observe(0.5)
+        self.latency.observe(5)
+        res = self.stats.as_dict()
+        self.assertEqual(res['messages_sent_total'], {'Ping': 3})
+        self.assertEqual(res['errors_total'], 1)
+        self.assertEqual(res['latency_seconds']['Counts'], [0, 1, 1])
+        self.assertEqual(res['latency_seconds']['Sum'], 5.5)
+        self.assertEqual(res['queue_depth'], 3)
+
+    def test_render(self):
+        self.sent.inc('Say "hi"')
+        self.errors.inc()
+        self.latency.observe(0.05)
+        lines = self.stats.render().splitlines()
+        self.assertIn('# TYPE pyzbus_messages_sent_total counter', lines)
+        self.assertIn('pyzbus_messages_sent_total{message="Say \\"hi\\""} 1',
+                      lines)
+        self.assertIn('pyzbus_errors_total 1', lines)
+        self.assertIn('pyzbus_latency_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('pyzbus_queue_depth 3', lines)
+
+    def test_merge(self):
+        self.sent.inc('Ping')
+        self.errors.inc()
+        self.latency.observe(0.5)
+        other = Stats()
+        other.counter('messages_sent_total', 'message').inc('Pong', 2)
+        other.counter('errors_total').inc()
+        other.histogram('latency_seconds', (0.1, 1)).observe(0.05)
+        res = merge([self.stats.as_dict(), other.as_dict()])
+        self.assertEqual(res['messages_sent_total'], {'Ping': 1, 'Pong': 2})
+        self.assertEqual(res['errors_total'], 2)
+        self.assertEqual(res['latency_seconds']['Counts'], [1, 1, 0])
+        self.assertEqual(res['latency_seconds']['Count'], 2)
+        self.assertEqual(res['queue_depth'], 3)
+        # Inputs are left as they are.
+        self.assertEqual(self.stats.as_dict()['messages_sent_total'],
+                         {'Ping': 1})
@@ -0,0 +1,83 @@
+import gc
+import unittest
+
+import gevent
+
+from pyzbus.zactor import ZActor, stream_reply
+from pyzbus.zask import AskTimeout
+from pyzbus.zstream import Consumer, Producer
+
+from bus import BusTest
+
+
+class ConsumerTest(unittest.TestCase):
+
+    def test_credits_by_half_window(self):
+        consumer = Consumer(4)
+        self.assertEqual(consumer.consumed(), 0)
+        self.assertEqual(consumer.consumed(), 2)
+        self.assertEqual(consumer.consumed(), 0)
+
+    def test_window_of_one(self):
+        consumer = Consumer(1)
+        self.assertEqual(consumer.consumed(), 1)
+
+    def test_timeout(self):
+        consumer = Consumer(4)
+        consumer.put({'StreamChunk': 0})
+        self.assertEqual(consumer.get(0.01), {'StreamChunk': 0})
+        self.assertRaises(AskTimeout, consumer.get, 0.01)
+
+
+class ProducerTest(unittest.TestCase):
+
+    def test_credits(self):
+        producer = Producer(1)
+        self.assertTrue(producer.take(0.01))
+        self.assertFalse(producer.take(0.01))
+        producer.grant(2)
+        self.assertTrue(producer.take(0.01))
+        self.assertTrue(producer.take(0.01))
+        self.assertEqual(producer.credits, 0)
+
+    def test_cancel(self):
+        producer = Producer(5)
+        producer.cancel()
+        self.assertFalse(producer.take(0.01))
+
+
+class Numbers(ZActor):
+    asked = 0
+
+    @stream_reply
+    def on_Count(self, msg):
+        self.asked += 1
+        for i in range(msg.get('Count')):
+            yield {'N': i}
+
+
+class AskStreamTest(BusTest):
+
+    def setUp(self):
+        super(AskStreamTest, self).setUp()
+        self.manager()
+        self.producer = self.actor(Numbers, 'numbers')
+        self.asker = self.actor(ZActor, 'asker')
+
+    def test_chunks(self):
+        chunks = self.asker.ask_stream(
+            {'Message': 'Count', 'To': 'numbers', 'Count': 5}, credits=2,
+            timeout=1)
+        self.assertEqual([chunk['N'] for chunk in chunks], range(5))
+        self.assertFalse(self.asker.streams)
+
+    def test_dropped_unstarted(self):
+        # Nothing is sent before the first chunk is asked for.
+        chunks = self.asker.ask_stream(
+            {'Message': 'Count', 'To': 'numbers', 'Count': 5}, timeout=1)
+        self.assertFalse(self.asker.streams)
+        del chunks
+        gc.collect()
+        gevent.sleep(0.1)
+        self.assertEqual(self.producer.asked, 0)
+        self.assertFalse(self.producer.producers)
@@ -0,0 +1,48 @@
+import unittest
+
+from pyzbus.ztopic import TopicTrie, is_pattern, subscription_prefix
+
+
+class PatternTest(unittest.TestCase):
+
+    def test_is_pattern(self):
+        self.assertTrue(is_pattern('orders.*'))
+        self.assertTrue(is_pattern('orders.#'))
+        self.assertTrue(is_pattern('#'))
+        self.assertFalse(is_pattern('*'))
+        self.assertFalse(is_pattern('orders.eu'))
+
+    def test_subscription_prefix(self):
+        self.assertEqual(subscription_prefix('orders.eu.*'), '|orders.eu.')
+        self.assertEqual(subscription_prefix('orders.#'), '|orders')
+        self.assertEqual(subscription_prefix('*.fr'), '|')
+
+
+class TopicTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = TopicTrie()
+        for pattern in ('orders.*', 'orders.#', 'orders.*.fr', '#.fr'):
+            self.trie.add(pattern)
+
+    def test_matches(self):
+        self.assertEqual(self.trie.matches('orders.eu'),
+                         ['orders.#', 'orders.*'])
+        self.assertEqual(self.trie.matches('orders.eu.fr'),
+                         ['#.fr', 'orders.#', 'orders.*.fr'])
+        self.assertEqual(self.trie.matches('orders'), ['orders.#'])
+        self.assertFalse(self.trie.match('invoices.eu'))
+
+    def test_refcount(self):
+        self.assertFalse(self.trie.add('orders.*'))
+        self.assertFalse(self.trie.remove('orders.*'))
+        self.assertTrue(self.trie.match('orders.eu'))
+        self.assertTrue(self.trie.remove('orders.*'))
+        self.assertEqual(self.trie.matches('orders.eu'), ['orders.#'])
+
+    def test_remove_prunes(self):
+        trie = TopicTrie()
+        trie.add('a.b.c')
+        trie.remove('a.b.c')
+        self.assertEqual(trie.root.children, {})
+        self.assertEqual(len(trie), 0)
@@ -0,0 +1,41 @@
+import unittest
+
+from pyzbus import ztrace
+
+
+class HopsTest(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        data = ztrace.pack(ztrace.MANAGER_IN, (1.0, 100.0)) + \
+            ztrace.pack(ztrace.MANAGER_OUT, (1.5, 100.5))
+        self.assertEqual(ztrace.unpack(data),
+                         [[ztrace.MANAGER_IN, 1.0, 100.0],
+                          [ztrace.MANAGER_OUT, 1.5, 100.5]])
+
+    def test_segments(self):
+        hops = [ztrace.stamp(ztrace.SEND, (0.0, 100.0)),
+                ztrace.stamp(ztrace.MANAGER_IN, (50.0, 100.25)),
+                ztrace.stamp(ztrace.MANAGER_OUT, (50.5, 100.75))]
+        # Wall clock between processes, monotonic within one.
+        self.assertEqual(list(ztrace.segments(hops)),
+                         [('send>manager_in', 0.25),
+                          ('manager_in>manager_out', 0.5)])
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_record(self):
+        tracer = ztrace.Tracer(keep=1)
+        for wall in (1.0, 3.0):
+            tracer.record('Get', [
+                ztrace.stamp(ztrace.SEND, (0.0, 100.0)),
+                ztrace.stamp(ztrace.RECEIVE, (0.0, 100.0 + wall))])
+        tracer.record('Get', [ztrace.stamp(ztrace.SEND)]) # Too short.
+        res = tracer.as_dict()['Get']
+        self.assertEqual(res['Total']['Count'], 2)
+        self.assertEqual(res['Total']['Mean'], 2.0)
+        self.assertEqual(res['Total']['Max'], 3.0)
+        self.assertEqual(res['Segments'][0]['Segment'], 'send>receive')
+        self.assertEqual(len(tracer.traces), 1)
+        events = tracer.chrome_trace()['traceEvents']
+        self.assertEqual([event['ph'] for event in events], ['M', 'X', 'X'])